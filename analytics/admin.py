@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import PageView, Event, BotVisit
+from .models import PageView, Event, BotVisit, TrafficRollup, Visit, Funnel, FunnelResult
 
 
 @admin.register(BotVisit)
@@ -20,6 +20,7 @@ class PageViewAdmin(admin.ModelAdmin):
     list_display = ('path', 'user', 'ip_address', 'browser', 'device', 'timestamp')
     list_filter = ('browser', 'device', 'os', 'timestamp')
     search_fields = ('path', 'url', 'ip_address', 'user__username')
+    raw_id_fields = ('user', 'page', 'agent', 'referrer_host')
     readonly_fields = ('timestamp',)
     date_hierarchy = 'timestamp'
 
@@ -31,3 +32,53 @@ class EventAdmin(admin.ModelAdmin):
     search_fields = ('event_name', 'page_url', 'user__username')
     readonly_fields = ('timestamp',)
     date_hierarchy = 'timestamp'
+
+
+@admin.register(TrafficRollup)
+class TrafficRollupAdmin(admin.ModelAdmin):
+    list_display = ('granularity', 'bucket', 'dimension', 'value', 'count', 'sessions')
+    list_filter = ('granularity', 'dimension')
+    search_fields = ('value', 'label')
+    date_hierarchy = 'bucket'
+    
+    def has_add_permission(self, request):
+        # Rollups are maintained by analytics.rollups only
+        return False
+
+
+@admin.register(Visit)
+class VisitAdmin(admin.ModelAdmin):
+    list_display = ('session_key', 'start', 'duration', 'page_count', 'entry_path', 'exit_path', 'country')
+    list_filter = ('country',)
+    search_fields = ('session_key', 'entry_path', 'exit_path', 'referrer_domain')
+    date_hierarchy = 'start'
+    
+    def has_add_permission(self, request):
+        # Visits are built by analytics.visits only
+        return False
+
+
+@admin.register(Funnel)
+class FunnelAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'is_active', 'evaluated_through')
+    list_filter = ('is_active',)
+    prepopulated_fields = {'slug': ('name',)}
+    readonly_fields = ('evaluated_through', 'created_at')
+    
+    def save_model(self, request, obj, form, change):
+        if 'steps' in form.changed_data:
+            # Results for the old steps are stale; shown as pending until build_funnels backfills them
+            obj.evaluated_through = None
+        super().save_model(request, obj, form, change)
+
+
+@admin.register(FunnelResult)
+class FunnelResultAdmin(admin.ModelAdmin):
+    list_display = ('funnel', 'day', 'dimension', 'value', 'step', 'visitors')
+    list_filter = ('funnel', 'dimension')
+    date_hierarchy = 'day'
+    
+    def has_add_permission(self, request):
+        # Results are maintained by analytics.funnels only
+        return False
+
@@ -0,0 +1,223 @@
+"""
+Client-side collection endpoint (``POST /analytics/collect/``).
+
+static/js/analytics.js queues events in the browser and sends them as one
+``navigator.sendBeacon`` request per batch. The body is a JSON array of items:
+
+    {"type": "click", "name": "CTA clicked", "data": {...}, "url": "https://..."}
+    {"type": "timing", "path": "/blog/some-post/", "seconds": 42}
+
+Event items (``type`` is one of Event.EVENT_TYPES) are validated with cheap
+type/length checks and written with a single ``bulk_create``. Timing items set
+PageView.time_on_page on the visitor's latest view of that path. Invalid items
+are dropped and counted; a body that isn't a JSON array is rejected.
+
+Bots, staff and opted-out visitors are ignored, as in AnalyticsMiddleware.
+Bot beacons are dropped without a BotVisit: the middleware already logged
+the crawler's request for the page itself.
+
+With ``ANALYTICS_TRACKING_MODE = 'beacon'`` the collector also reports each
+page view (``/analytics/pageview/``: a JSON object sent with sendBeacon, or
+the same fields as query parameters on a 1x1 GIF request). The middleware
+then only logs bots, so pages can be served from a full-page cache and still
+be counted. The visitor ID travels in the signed visitor cookie sent with the
+beacon, never in the payload. Beacon page views go through the same path
+exclusions, bot detection and PageView fields as server-side tracking.
+"""
+import base64
+import json
+
+from django.conf import settings
+
+from . import matching
+from .middleware import BEACON, AnalyticsMiddleware, get_tracking_mode
+from .models import Event, PageView
+
+TIMING = 'timing'
+EVENT_TYPES = {value for value, _ in Event.EVENT_TYPES}
+
+MAX_NAME_LENGTH = 200
+MAX_URL_LENGTH = 500
+MAX_DATA_LENGTH = 2000  # serialized event_data
+MAX_TIME_ON_PAGE = 4 * 3600
+
+# Transparent 1x1 GIF returned by the pixel form of the page view beacon
+PIXEL_GIF = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+# Query parameter names for the pixel form
+PIXEL_FIELDS = {'p': 'path', 'u': 'url', 't': 'title', 'r': 'referrer'}
+
+# The middleware's helpers (UA classification, client IP) are shared
+_tracker = AnalyticsMiddleware(lambda request: None)
+
+
+class BeaconError(ValueError):
+    """The request body can't be processed at all"""
+
+
+def get_max_events():
+    return max(1, int(getattr(settings, 'ANALYTICS_COLLECT_MAX_EVENTS', 50) or 1))
+
+
+def get_max_bytes():
+    return max(1, int(getattr(settings, 'ANALYTICS_COLLECT_MAX_BYTES', 65536) or 1))
+
+
+def parse_batch(body):
+    """List of raw items from a request body, or BeaconError"""
+    if len(body) > get_max_bytes():
+        raise BeaconError('payload too large')
+    try:
+        items = json.loads(body)
+    except (UnicodeDecodeError, ValueError):
+        raise BeaconError('body must be a JSON array')
+    if not isinstance(items, list):
+        raise BeaconError('body must be a JSON array')
+    if len(items) > get_max_events():
+        raise BeaconError(f'at most {get_max_events()} items per batch')
+    return items
+
+
+def clean_event(item):
+    """(event_type, name, data, url) for a valid event item, else None"""
+    name = item.get('name')
+    data = item.get('data')
+    url = item.get('url', '')
+    if not isinstance(name, str) or not name.strip() or not isinstance(url, str):
+        return None
+    if data is not None:
+        if not isinstance(data, (dict, list)):
+            return None
+        if len(json.dumps(data, separators=(',', ':'))) > MAX_DATA_LENGTH:
+            return None
+    return item['type'], name.strip()[:MAX_NAME_LENGTH], data, url[:MAX_URL_LENGTH]
+
+
+def clean_timing(item):
+    """(path, seconds) for a valid timing item, else None"""
+    path = item.get('path')
+    seconds = item.get('seconds')
+    if not isinstance(path, str) or not path.startswith('/'):
+        return None
+    if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds < 0:
+        return None
+    return path[:MAX_URL_LENGTH], min(int(seconds), MAX_TIME_ON_PAGE)
+
+
+def is_ignored(request):
+    """Requests the collector drops without looking at the body"""
+    if _tracker.is_excluded_visitor(request):
+        return True
+    user_agent = request.META.get('HTTP_USER_AGENT', '')
+    return _tracker.classify_user_agent(user_agent)[0]
+
+
+def store_batch(request, items, visitor_id):
+    """Write a parsed batch for one visitor; returns (accepted, rejected)"""
+    user = request.user if request.user.is_authenticated else None
+    ip_address = _tracker.get_client_ip(request)
+    default_url = request.META.get('HTTP_REFERER', '')[:MAX_URL_LENGTH]
+
+    events = []
+    timings = {}
+    rejected = 0
+    for item in items:
+        item_type = item.get('type') if isinstance(item, dict) else None
+        if item_type == TIMING:
+            cleaned = clean_timing(item)
+            if cleaned is not None:
+                path, seconds = cleaned
+                timings[path] = seconds  # the latest reading for a page wins
+                continue
+        elif item_type in EVENT_TYPES:
+            cleaned = clean_event(item)
+            if cleaned is not None:
+                event_type, name, data, url = cleaned
+                events.append(Event(
+                    event_type=event_type,
+                    event_name=name,
+                    event_data=data,
+                    user=user,
+                    session_key=visitor_id,
+                    ip_address=ip_address,
+                    page_url=url or default_url,
+                ))
+                continue
+        rejected += 1
+
+    if events:
+        Event.objects.bulk_create(events)
+    for path, seconds in timings.items():
+        latest = (
+            PageView.objects.filter(session_key=visitor_id, path=path)
+            .order_by('-timestamp', '-id')
+            .values_list('id', flat=True)[:1]
+        )
+        PageView.objects.filter(id__in=list(latest)).update(time_on_page=seconds)
+
+    return len(items) - rejected, rejected
+
+
+def clean_pageview(data):
+    """(path, url, title, referrer) for a valid page view beacon, else None"""
+    if not isinstance(data, dict):
+        return None
+    path = data.get('path')
+    fields = [data.get(name, '') for name in ('url', 'title', 'referrer')]
+    if not isinstance(path, str) or not path.startswith('/'):
+        return None
+    if not all(isinstance(value, str) for value in fields):
+        return None
+    url, title, referrer = fields
+    return (
+        path[:MAX_URL_LENGTH],
+        url[:MAX_URL_LENGTH],
+        ' '.join(title.split())[:200],
+        referrer[:MAX_URL_LENGTH],
+    )
+
+
+def parse_pageview(request):
+    """Page view fields from a beacon request (JSON body or pixel query), or BeaconError"""
+    if request.method == 'GET':
+        data = {field: request.GET.get(param, '') for param, field in PIXEL_FIELDS.items()}
+    else:
+        if len(request.body) > get_max_bytes():
+            raise BeaconError('payload too large')
+        try:
+            data = json.loads(request.body)
+        except (UnicodeDecodeError, ValueError):
+            raise BeaconError('body must be a JSON object')
+    cleaned = clean_pageview(data)
+    if cleaned is None:
+        raise BeaconError('path must be a string starting with /')
+    return cleaned
+
+
+def record_pageview(request, path, url, title, referrer):
+    """
+    Record one beacon page view like AnalyticsMiddleware would.
+    Returns the analytics Visitor, or None if nothing was counted.
+    """
+    if get_tracking_mode() != BEACON:
+        return None  # the middleware already counts page views
+    if matching.get_excluded_paths().matches(path) or _tracker.is_excluded_visitor(request):
+        return None
+
+    user_agent = request.META.get('HTTP_USER_AGENT', '')
+    is_bot, _, browser, device, os_name = _tracker.classify_user_agent(user_agent)
+    if is_bot:
+        # JS-running crawler; its HTML request was already logged by the middleware
+        return None
+
+    return _tracker.record_page_view(
+        request,
+        path=path,
+        url=url or request.build_absolute_uri(path),
+        page_title=title,
+        referrer=referrer,
+        user_agent=user_agent,
+        browser=browser,
+        device=device,
+        os_name=os_name,
+    )
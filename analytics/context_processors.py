@@ -0,0 +1,6 @@
+from .middleware import BEACON, get_tracking_mode
+
+
+def tracking(request):
+    """Tells base.html whether static/js/analytics.js should report page views"""
+    return {'analytics_beacon_pageviews': get_tracking_mode() == BEACON}
@@ -0,0 +1,184 @@
+"""
+Interned PageView dimensions.
+
+Repeated strings are stored once in the UserAgent, Path and ReferrerDomain
+tables, and each PageView carries integer keys to them (``agent``, ``page``,
+``referrer_host``). Only the full user-agent string, by far the largest
+repeated value, is then cleared from the row: rollups, visits, funnels and
+beacon timings still read and filter on ``path`` and ``referrer_domain``,
+and ``url`` / ``referrer`` carry query strings no dimension holds.
+
+Interning never runs in the request:
+
+- with ANALYTICS_INGEST_MODE=buffered, the background flush interns each
+  batch just before its INSERT (intern_rows)
+- anything written without keys (sync mode, or a flush whose interning
+  failed) is picked up by intern_pending(), run by ``rollup_analytics``
+  before each rollup pass behind an AggregationWatermark
+
+Each batch's distinct values cost one lookup and one INSERT per table, and
+IDs are kept in a bounded per-process cache, only once the row is known to
+be committed, so a rolled-back transaction can't leave a dangling ID behind.
+Rows older than the dimension tables are backfilled by migration 0008, which
+also moves the watermark past them.
+"""
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+from .models import AggregationWatermark, PageView, Path, ReferrerDomain, UserAgent
+from .useragent import UserAgentCache
+
+
+def get_cache_size():
+    return max(0, int(getattr(settings, 'ANALYTICS_DIMENSION_CACHE_SIZE', 10000) or 0))
+
+
+def user_agent_digest(user_agent):
+    return UserAgentCache.key(user_agent).hex()
+
+
+class InternCache:
+    """value -> id map for one dimension table; emptied when it fills up"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def get(self, value):
+        return self._ids.get(value)
+
+    def put(self, value, pk):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if len(self._ids) >= self.maxsize:
+                self._ids.clear()
+            self._ids[value] = pk
+
+    def put_on_commit(self, value, pk):
+        transaction.on_commit(lambda: self.put(value, pk))
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def __len__(self):
+        return len(self._ids)
+
+
+user_agents = InternCache(get_cache_size())
+paths = InternCache(get_cache_size())
+referrer_domains = InternCache(get_cache_size())
+
+
+WATERMARK = 'dimensions:pageview'
+
+# Chunk size for ``__in`` lookups (stays under SQLite's variable limit)
+IN_CHUNK = 500
+
+
+def get_batch_size():
+    return max(1, int(getattr(settings, 'ANALYTICS_ROLLUP_BATCH_SIZE', 5000) or 1))
+
+
+def _intern(model, field, values, intern_cache, defaults=None):
+    """{value: id} for one dimension table, creating missing rows with one INSERT"""
+    ids, missing = {}, []
+    for value in set(values):
+        pk = intern_cache.get(value)
+        if pk is None:
+            missing.append(value)
+        else:
+            ids[value] = pk
+    if not missing:
+        return ids
+    found = {}
+    for i in range(0, len(missing), IN_CHUNK):
+        found.update(model.objects.filter(**{f'{field}__in': missing[i:i + IN_CHUNK]}).values_list(field, 'id'))
+    new = [value for value in missing if value not in found]
+    if new:
+        model.objects.bulk_create(
+            [model(**{field: value}, **(defaults(value) if defaults else {})) for value in new],
+            ignore_conflicts=True,
+        )
+        for i in range(0, len(new), IN_CHUNK):
+            found.update(model.objects.filter(**{f'{field}__in': new[i:i + IN_CHUNK]}).values_list(field, 'id'))
+    for value, pk in found.items():
+        intern_cache.put_on_commit(value, pk)
+    ids.update(found)
+    return ids
+
+
+def intern_rows(rows):
+    """Point unsaved-key PageView instances at their dimension rows and drop their user-agent strings"""
+    agents = {}
+    for row in rows:
+        if row.user_agent:
+            agents.setdefault(user_agent_digest(row.user_agent), row)
+    path_ids = _intern(Path, 'path', (row.path[:500] for row in rows if row.path), paths)
+    domain_ids = _intern(
+        ReferrerDomain, 'domain', (row.referrer_domain[:200] for row in rows if row.referrer_domain), referrer_domains
+    )
+    agent_ids = _intern(
+        UserAgent, 'digest', agents, user_agents,
+        defaults=lambda digest: {
+            'user_agent': agents[digest].user_agent,
+            'browser': agents[digest].browser,
+            'device': agents[digest].device,
+            'os': agents[digest].os,
+        },
+    )
+    for row in rows:
+        row.page_id = path_ids.get(row.path[:500])
+        row.referrer_host_id = domain_ids.get(row.referrer_domain[:200])
+        if row.user_agent:
+            row.agent_id = agent_ids[user_agent_digest(row.user_agent)]
+            row.user_agent = ''
+
+
+def intern_pending(batch_size=None, max_batches=None):
+    """
+    Fill in the dimension keys of page views recorded since the last run, in
+    id order and bounded batches. Returns rows processed.
+    """
+    batch_size = batch_size or get_batch_size()
+    processed = batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            watermark, _ = AggregationWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+            rows = list(
+                PageView.objects.filter(id__gt=watermark.last_id)
+                .only('id', 'path', 'user_agent', 'browser', 'device', 'os', 'referrer_domain', 'page', 'agent')
+                .order_by('id')[:batch_size]
+            )
+            if not rows:
+                break
+            # Rows backfilled by migration 0008 already have their keys
+            pending = [row for row in rows if row.agent_id is None and row.page_id is None]
+            intern_rows(pending)
+            PageView.objects.bulk_update(pending, ['page', 'referrer_host', 'agent', 'user_agent'])
+            watermark.last_id = rows[-1].id
+            watermark.save(update_fields=['last_id', 'updated_at'])
+        processed += len(rows)
+        batches += 1
+        if len(rows) < batch_size:
+            break
+    return processed
+
+
+def clear_caches():
+    for intern_cache in (user_agents, paths, referrer_domains):
+        intern_cache.clear()
+
+
+@receiver(setting_changed)
+def _resize_caches(setting, **kwargs):
+    if setting == 'ANALYTICS_DIMENSION_CACHE_SIZE':
+        for intern_cache in (user_agents, paths, referrer_domains):
+            intern_cache.maxsize = get_cache_size()
+        clear_caches()
@@ -0,0 +1,226 @@
+"""
+Geo enrichment outside the request cycle.
+
+With ``ANALYTICS_GEO_MODE = 'deferred'`` AnalyticsMiddleware stores page views
+with empty geo fields. ``manage.py enrich_geo --loop`` then picks up the new
+rows in id order, resolves each distinct IP of a batch once through the
+configured resolver, and writes the results with ``bulk_update``. Its
+progress is the ``geo:pageview`` AggregationWatermark, and the page view
+rollup only folds rows up to it, so country/city rollups never see rows that
+haven't been enriched yet.
+
+Resolvers take a set of IPs and return ``{ip: geo dict}`` for those they know
+(set ANALYTICS_GEO_RESOLVER to a dotted path to swap them). When a lookup
+fails rather than finding nothing (an HTTP error, an outage) they raise
+GeoLookupError; the job then stops its watermark before the first affected
+row, and the next run retries from there. Resolvers whose
+``uses_network`` is false may also run inside the dashboard request:
+
+- OfflineResolver: the local range database (analytics.geo), plus the batch
+  HTTP API for misses when ANALYTICS_GEO_HTTP_FALLBACK is on
+- BatchHTTPResolver: ip-api.com's batch endpoint, 100 IPs per request
+- StubResolver: fixed answers from ANALYTICS_GEO_STUB, for local development
+  and tests
+"""
+import logging
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import geo
+from .models import AggregationWatermark, PageView
+
+logger = logging.getLogger(__name__)
+
+INLINE = 'inline'
+DEFERRED = 'deferred'
+
+WATERMARK = 'geo:pageview'
+GEO_FIELDS = ['country', 'country_code', 'city', 'region']
+EMPTY_GEO = dict.fromkeys(GEO_FIELDS, '')
+
+DEFAULT_RESOLVER = 'analytics.enrich.OfflineResolver'
+GEO_CACHE_TIMEOUT = 86400
+
+
+def get_geo_mode():
+    mode = (getattr(settings, 'ANALYTICS_GEO_MODE', INLINE) or INLINE).lower()
+    return mode if mode in (INLINE, DEFERRED) else INLINE
+
+
+def get_batch_size():
+    return max(1, int(getattr(settings, 'ANALYTICS_GEO_BATCH_SIZE', 1000) or 1))
+
+
+def get_resolver():
+    return import_string(getattr(settings, 'ANALYTICS_GEO_RESOLVER', '') or DEFAULT_RESOLVER)()
+
+
+class GeoLookupError(Exception):
+    """Some IPs couldn't be looked up right now; ``found`` holds the answers for the rest"""
+
+    def __init__(self, found, failed):
+        super().__init__(f'Geo lookup failed for {len(failed)} IPs')
+        self.found = found
+        self.failed = set(failed)
+
+
+class BatchHTTPResolver:
+    """ip-api.com batch API (free tier: 15 batch requests/minute, 100 IPs each)"""
+
+    url = 'http://ip-api.com/batch'
+    uses_network = True
+    chunk_size = 100
+    timeout = 5
+
+    def __init__(self, url=None):
+        self.url = url or getattr(settings, 'ANALYTICS_GEO_BATCH_URL', '') or self.url
+
+    def resolve(self, ips):
+        found = {}
+        missing = []
+        failed = []
+        for ip in ips:
+            # Shares the 24h cache with the middleware's single-IP fallback
+            cached = cache.get(f'geo_{ip}')
+            if cached:
+                found[ip] = cached
+            else:
+                missing.append(ip)
+
+        for start in range(0, len(missing), self.chunk_size):
+            chunk = missing[start:start + self.chunk_size]
+            try:
+                response = requests.post(
+                    self.url,
+                    json=[{'query': ip, 'fields': 'status,query,country,countryCode,city,regionName'} for ip in chunk],
+                    timeout=self.timeout,
+                )
+                response.raise_for_status()
+                results = response.json()
+            except Exception:
+                logger.warning('Geo batch lookup failed for %d IPs', len(chunk), exc_info=True)
+                failed.extend(chunk)
+                continue
+            for item in results:
+                if item.get('status') != 'success':
+                    continue
+                geo_data = {
+                    'country': item.get('country', ''),
+                    'country_code': item.get('countryCode', ''),
+                    'city': item.get('city', ''),
+                    'region': item.get('regionName', ''),
+                }
+                found[item.get('query')] = geo_data
+                cache.set(f"geo_{item.get('query')}", geo_data, GEO_CACHE_TIMEOUT)
+        if failed:
+            raise GeoLookupError(found, failed)
+        return found
+
+
+class OfflineResolver:
+    """Local range database first, optionally the batch HTTP API for the rest"""
+
+    @property
+    def uses_network(self):
+        return bool(getattr(settings, 'ANALYTICS_GEO_HTTP_FALLBACK', False))
+
+    def resolve(self, ips):
+        found = {}
+        for ip in ips:
+            geo_data = geo.lookup(ip)
+            if geo_data is not None:
+                found[ip] = geo_data
+        if getattr(settings, 'ANALYTICS_GEO_HTTP_FALLBACK', False):
+            remaining = [ip for ip in ips if ip not in found]
+            if remaining:
+                try:
+                    found.update(BatchHTTPResolver().resolve(remaining))
+                except GeoLookupError as e:
+                    raise GeoLookupError({**found, **e.found}, e.failed)
+        return found
+
+
+class StubResolver:
+    """Answers from settings.ANALYTICS_GEO_STUB ({ip: geo dict}); never hits the network"""
+
+    uses_network = False
+
+    def resolve(self, ips):
+        table = getattr(settings, 'ANALYTICS_GEO_STUB', {}) or {}
+        found = {ip: dict(table[ip]) for ip in ips if ip in table}
+        found.update({ip: dict(geo.LOCAL_GEO) for ip in ips if ip not in found and geo.is_local_ip(ip)})
+        return found
+
+
+def enriched_max_id():
+    """Highest PageView id the enrichment job has processed"""
+    return AggregationWatermark.objects.filter(name=WATERMARK).values_list('last_id', flat=True).first() or 0
+
+
+def enrich_batch(resolver, batch_size):
+    """
+    Resolve and store geo for the next batch of page views.
+    Returns (rows processed, rows updated).
+    """
+    watermark, _ = AggregationWatermark.objects.get_or_create(name=WATERMARK)
+    start_id = watermark.last_id
+    rows = list(
+        PageView.objects.filter(id__gt=start_id).order_by('id').only('id', 'ip_address', *GEO_FIELDS)[:batch_size]
+    )
+    if not rows:
+        return 0, 0
+
+    # Rows recorded inline (or enriched before) already have their location
+    pending = [row for row in rows if not row.country and not row.city]
+    ips = {row.ip_address for row in pending if row.ip_address}
+    try:
+        resolved = resolver.resolve(ips) if ips else {}
+    except GeoLookupError as e:
+        # Keep the rows before the first failed lookup; the rest are retried next run
+        resolved = e.found
+        stop = next(row.id for row in pending if row.ip_address in e.failed)
+        rows = [row for row in rows if row.id < stop]
+        pending = [row for row in pending if row.id < stop]
+        if not rows:
+            return 0, 0
+
+    updated = []
+    for row in pending:
+        geo_data = resolved.get(row.ip_address)
+        if not geo_data:
+            continue
+        for field in GEO_FIELDS:
+            setattr(row, field, (geo_data.get(field) or '')[:PageView._meta.get_field(field).max_length])
+        updated.append(row)
+
+    with transaction.atomic():
+        watermark = AggregationWatermark.objects.select_for_update().get(name=WATERMARK)
+        if watermark.last_id != start_id:
+            return 0, 0  # another worker took this batch
+        PageView.objects.bulk_update(updated, GEO_FIELDS)
+        watermark.last_id = rows[-1].id
+        watermark.save(update_fields=['last_id', 'updated_at'])
+    return len(rows), len(updated)
+
+
+def enrich_pageviews(batch_size=None, max_batches=None, resolver=None):
+    """
+    Enrich page views past the watermark (``max_batches`` bounds the work).
+    Returns {'processed': rows, 'updated': rows}.
+    """
+    batch_size = batch_size or get_batch_size()
+    resolver = resolver or get_resolver()
+    totals = {'processed': 0, 'updated': 0}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        processed, updated = enrich_batch(resolver, batch_size)
+        totals['processed'] += processed
+        totals['updated'] += updated
+        batches += 1
+        if processed < batch_size:
+            break
+    return totals
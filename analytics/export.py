@@ -0,0 +1,185 @@
+"""
+Streaming export of raw analytics rows as CSV or NDJSON.
+
+Rows are read in id order with ``QuerySet.iterator(chunk_size=...)``, which
+uses a server-side cursor on PostgreSQL (and ``fetchmany`` elsewhere), and
+are encoded and yielded one chunk at a time, optionally through an
+incremental gzip compressor. Memory use depends on the chunk size, not on
+the size of the date range. Used by the staff export endpoint and the
+``export_analytics`` command.
+"""
+import csv
+import datetime
+import json
+import zlib
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import BotVisit, Event, PageView
+from .retention import fill_user_agents, json_default
+
+SOURCES = {
+    'pageview': PageView,
+    'event': Event,
+    'botvisit': BotVisit,
+}
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+FORMATS = {
+    CSV: 'text/csv',
+    NDJSON: 'application/x-ndjson',
+}
+
+# Encoded output is yielded in pieces of about this size
+WRITE_BUFFER = 64 * 1024
+
+
+class ExportError(ValueError):
+    """Invalid export parameters (unknown source, column or format)"""
+
+
+def get_chunk_size():
+    return max(1, int(getattr(settings, 'ANALYTICS_EXPORT_CHUNK_SIZE', 2000) or 1))
+
+
+def get_model(source):
+    try:
+        return SOURCES[source]
+    except KeyError:
+        raise ExportError(f'Unknown source {source!r}; choose from {", ".join(SOURCES)}')
+
+
+def available_columns(source):
+    return [field.attname for field in get_model(source)._meta.concrete_fields]
+
+
+def parse_columns(source, columns=None):
+    """Requested columns (list or comma-separated string) checked against the model; all by default"""
+    available = available_columns(source)
+    if not columns:
+        return available
+    if isinstance(columns, str):
+        columns = [column.strip() for column in columns.split(',') if column.strip()]
+    unknown = [column for column in columns if column not in available]
+    if unknown:
+        raise ExportError(f'Unknown column(s) for {source}: {", ".join(unknown)}')
+    return list(dict.fromkeys(columns))
+
+
+def date_bounds(start=None, end=None):
+    """Aware [since, until) datetimes covering the local dates ``start``..``end`` (either may be None)"""
+    if start and end and start > end:
+        raise ExportError('start must not be after end')
+
+    def midnight(day):
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+    since = midnight(start) if start else None
+    until = midnight(end + datetime.timedelta(days=1)) if end else None
+    return since, until
+
+
+def iter_rows(source, columns, since=None, until=None, chunk_size=None):
+    """Yield row dicts with ``columns``, oldest first, holding one chunk in memory at a time"""
+    model = get_model(source)
+    chunk_size = chunk_size or get_chunk_size()
+    # Page views keep the user agent in the UserAgent table; fetch the key to fill it in
+    fill_agents = model is PageView and 'user_agent' in columns
+    fields = list(columns) + (['agent_id'] if fill_agents and 'agent_id' not in columns else [])
+
+    qs = model.objects.order_by('id')
+    if since is not None:
+        qs = qs.filter(timestamp__gte=since)
+    if until is not None:
+        qs = qs.filter(timestamp__lt=until)
+
+    chunk = []
+    for row in qs.values(*fields).iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield from _finish_chunk(chunk, columns, fill_agents)
+            chunk = []
+    if chunk:
+        yield from _finish_chunk(chunk, columns, fill_agents)
+
+
+def _finish_chunk(rows, columns, fill_agents):
+    if fill_agents:
+        fill_user_agents(rows)
+        if 'agent_id' not in columns:
+            for row in rows:
+                row.pop('agent_id', None)
+    return rows
+
+
+class _Echo:
+    """File-like object whose write() returns the text instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=json_default)
+    return value
+
+
+def encode_csv(rows, columns):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([_csv_value(row[column]) for column in columns])
+
+
+def encode_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, default=json_default, separators=(',', ':')) + '\n'
+
+
+def _buffered(lines):
+    """Join encoded lines into bytes pieces of about WRITE_BUFFER"""
+    buffer, size = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= WRITE_BUFFER:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _gzipped(pieces):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for piece in pieces:
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(source, fmt=CSV, columns=None, start=None, end=None, compress=False, chunk_size=None):
+    """
+    Bytes chunks of an export; raises ExportError for bad parameters before
+    any row is read.
+    """
+    if fmt not in FORMATS:
+        raise ExportError(f'Unknown format {fmt!r}; choose from {", ".join(FORMATS)}')
+    columns = parse_columns(source, columns)
+    since, until = date_bounds(start, end)
+    rows = iter_rows(source, columns, since, until, chunk_size)
+    lines = encode_csv(rows, columns) if fmt == CSV else encode_ndjson(rows)
+    pieces = _buffered(lines)
+    return _gzipped(pieces) if compress else pieces
+
+
+def filename(source, fmt, start=None, end=None, compress=False):
+    dates = '-'.join(day.isoformat() for day in (start, end) if day)
+    name = f'{source}-{dates}' if dates else source
+    return f'{name}.{fmt}' + ('.gz' if compress else '')
@@ -0,0 +1,298 @@
+"""
+Conversion funnels evaluated incrementally, one day at a time.
+
+A visitor (``session_key``) goes through a Funnel's steps in order within one
+day: each step must match at or after the previous one. Steps match page
+views (exact path or prefix), Events (type, optionally name) or payments
+(a PaymentTransaction created by payments-prepare, or one marked
+successful). Payments belong to a user, so they count for the sessions that
+user viewed pages from on the same day.
+
+update_funnels() works out which days received raw rows since its last run
+and recomputes only those days for every active funnel, replacing their
+FunnelResult rows:
+
+- ``funnel:pageview`` / ``funnel:event`` hold the last PageView / Event id seen
+- ``funnel:payment`` holds the newest PaymentTransaction.updated_at seen (as
+  epoch microseconds), since status changes don't add rows
+
+New funnels, and funnels whose steps were edited (``evaluated_through``
+empty), have their results dropped and are backfilled for
+ANALYTICS_FUNNEL_BACKFILL_DAYS days by the scheduled ``build_funnels`` run;
+until then the dashboard shows them as pending. Older days can be rebuilt with
+``manage.py build_funnels --rebuild --days N`` while their raw rows still
+exist. The dashboard only reads FunnelResult.
+"""
+import datetime
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min, Sum
+from django.utils import timezone
+
+from . import enrich
+from .models import AggregationWatermark, Event, Funnel, FunnelResult, PageView
+
+PAGEVIEW_WATERMARK = 'funnel:pageview'
+EVENT_WATERMARK = 'funnel:event'
+PAYMENT_WATERMARK = 'funnel:payment'
+
+SITE = 'site'
+BREAKDOWNS = ('country', 'device')
+
+# Chunk size for __in lookups (stays under SQLite's variable limit)
+IN_CHUNK = 500
+
+
+def get_backfill_days():
+    return max(1, int(getattr(settings, 'ANALYTICS_FUNNEL_BACKFILL_DAYS', 30) or 1))
+
+
+def payment_model():
+    return apps.get_model('payments', 'PaymentTransaction')
+
+
+def day_range(day):
+    """[start, end) of a local calendar day"""
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+def _days_between(first, last):
+    day, last_day = timezone.localtime(first).date(), timezone.localtime(last).date()
+    while day <= last_day:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def _to_micros(ts):
+    return int(ts.timestamp() * 1_000_000)
+
+
+def _from_micros(value):
+    return datetime.datetime.fromtimestamp(value / 1_000_000, tz=datetime.timezone.utc)
+
+
+# Evaluation -----------------------------------------------------------------
+
+def _sessions_for_users(user_ids, start, end):
+    """(user id, session_key) pairs for users who viewed pages in [start, end)"""
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), IN_CHUNK):
+        yield from (
+            PageView.objects.filter(timestamp__gte=start, timestamp__lt=end, user_id__in=user_ids[i:i + IN_CHUNK])
+            .values_list('user_id', 'session_key')
+            .distinct()
+        )
+
+
+def step_matches(funnel, start, end):
+    """{session_key: [(timestamp, step index)]} for every row matching a step in [start, end)"""
+    matches = defaultdict(list)
+    by_user = defaultdict(list)
+    for index, step in enumerate(funnel.steps):
+        kind, value = step['kind'], step.get('value', '')
+        if kind in (Funnel.PATH, Funnel.PATH_PREFIX):
+            lookup = {'path': value} if kind == Funnel.PATH else {'path__startswith': value}
+            rows = PageView.objects.filter(timestamp__gte=start, timestamp__lt=end, **lookup)
+        elif kind == Funnel.EVENT:
+            event_type, _, event_name = value.partition(':')
+            rows = Event.objects.filter(timestamp__gte=start, timestamp__lt=end, event_type=event_type)
+            if event_name:
+                rows = rows.filter(event_name=event_name)
+        else:
+            payments = payment_model().objects
+            if kind == Funnel.PAYMENT_PREPARED:
+                paid = payments.filter(created_at__gte=start, created_at__lt=end).values_list('student_id', 'created_at')
+            else:
+                paid = payments.filter(
+                    status=payment_model().Status.SUCCESS, updated_at__gte=start, updated_at__lt=end
+                ).values_list('student_id', 'updated_at')
+            for user_id, ts in paid:
+                by_user[user_id].append((ts, index))
+            continue
+        for session_key, ts in rows.values_list('session_key', 'timestamp').iterator():
+            matches[session_key].append((ts, index))
+
+    for user_id, session_key in _sessions_for_users(by_user, start, end):
+        matches[session_key].extend(by_user[user_id])
+    return matches
+
+
+def furthest_step(matches, step_count):
+    """Index of the last step reached in order (-1 = not even the first)"""
+    reached = -1
+    for _, index in sorted(matches):
+        if index == reached + 1:
+            reached = index
+            if reached == step_count - 1:
+                break
+    return reached
+
+
+def _visitor_attributes(session_keys, start, end):
+    """{session_key: (country, device)} from each visitor's first page view of the day"""
+    keys = list(session_keys)
+    attributes = {}
+    for i in range(0, len(keys), IN_CHUNK):
+        rows = (
+            PageView.objects.filter(timestamp__gte=start, timestamp__lt=end, session_key__in=keys[i:i + IN_CHUNK])
+            .order_by('-timestamp')
+            .values_list('session_key', 'country', 'device')
+        )
+        for session_key, country, device in rows:
+            attributes[session_key] = (country, device)  # earliest view is written last
+    return attributes
+
+
+def evaluate_day(funnel, day):
+    """Recompute one funnel's results for one day; returns visitors who entered it"""
+    start, end = day_range(day)
+    reached = {}
+    for session_key, matches in step_matches(funnel, start, end).items():
+        furthest = furthest_step(matches, len(funnel.steps))
+        if furthest >= 0:
+            reached[session_key] = furthest
+    attributes = _visitor_attributes(reached, start, end)
+
+    counts = defaultdict(int)
+    for session_key, furthest in reached.items():
+        country, device = attributes.get(session_key, ('', ''))
+        for step in range(furthest + 1):
+            counts[(SITE, '', step)] += 1
+            counts[('country', country[:100], step)] += 1
+            counts[('device', device[:100], step)] += 1
+
+    with transaction.atomic():
+        FunnelResult.objects.filter(funnel=funnel, day=day).delete()
+        FunnelResult.objects.bulk_create([
+            FunnelResult(funnel=funnel, day=day, dimension=dimension, value=value, step=step, visitors=visitors)
+            for (dimension, value, step), visitors in counts.items()
+        ])
+    return len(reached)
+
+
+def changed_days():
+    """(local days with raw rows newer than the funnel watermarks, {watermark: new position})"""
+    marks = dict(
+        AggregationWatermark.objects.filter(
+            name__in=[PAGEVIEW_WATERMARK, EVENT_WATERMARK, PAYMENT_WATERMARK]
+        ).values_list('name', 'last_id')
+    )
+    days, positions = set(), {}
+
+    for name, model in ((PAGEVIEW_WATERMARK, PageView), (EVENT_WATERMARK, Event)):
+        qs = model.objects.filter(id__gt=marks.get(name, 0))
+        if model is PageView and enrich.get_geo_mode() == enrich.DEFERRED:
+            qs = qs.filter(id__lte=enrich.enriched_max_id())  # wait for country
+        span = qs.aggregate(first=Min('timestamp'), last=Max('timestamp'), last_id=Max('id'))
+        if span['last_id']:
+            days.update(_days_between(span['first'], span['last']))
+            positions[name] = span['last_id']
+
+    payments = payment_model().objects.filter(updated_at__gt=_from_micros(marks.get(PAYMENT_WATERMARK, 0)))
+    span = payments.aggregate(first=Min('created_at'), last=Max('updated_at'))
+    if span['last']:
+        days.update(_days_between(min(span['first'], span['last']), span['last']))
+        positions[PAYMENT_WATERMARK] = _to_micros(span['last'])
+    return days, positions
+
+
+def update_funnels(today=None, backfill=True):
+    """
+    Re-evaluate active funnels for the days that changed since the last run.
+
+    New or edited funnels are backfilled over ANALYTICS_FUNNEL_BACKFILL_DAYS
+    days, or skipped until a run with ``backfill=True``. Returns funnel-days
+    evaluated.
+    """
+    today = today or timezone.localdate()
+    oldest = today - datetime.timedelta(days=get_backfill_days() - 1)
+    days, positions = changed_days()
+    # Older days are only rebuilt on request (their raw rows may be archived)
+    days = sorted(day for day in days if oldest <= day <= today)
+
+    evaluated = 0
+    for funnel in Funnel.objects.filter(is_active=True):
+        if funnel.evaluated_through is None:
+            if not backfill:
+                continue
+            # Results for older days were counted against the previous steps
+            FunnelResult.objects.filter(funnel=funnel).delete()
+            funnel_days = [oldest + datetime.timedelta(days=i) for i in range((today - oldest).days + 1)]
+        else:
+            funnel_days = days
+        for day in funnel_days:
+            evaluate_day(funnel, day)
+            evaluated += 1
+        funnel.evaluated_through = today
+        funnel.save(update_fields=['evaluated_through'])
+
+    for name, position in positions.items():
+        AggregationWatermark.objects.update_or_create(name=name, defaults={'last_id': position})
+    return evaluated
+
+
+def rebuild_funnels(days, today=None, funnels=None):
+    """Recompute the last ``days`` days for the given (default: active) funnels"""
+    today = today or timezone.localdate()
+    funnels = list(funnels if funnels is not None else Funnel.objects.filter(is_active=True))
+    for funnel in funnels:
+        for i in range(days):
+            evaluate_day(funnel, today - datetime.timedelta(days=i))
+        funnel.evaluated_through = today
+        funnel.save(update_fields=['evaluated_through'])
+    return len(funnels) * days
+
+
+# Read helpers ---------------------------------------------------------------
+
+def _rate(part, whole):
+    return round(part / whole * 100, 1) if whole else 0
+
+
+def funnel_report(funnel, since, until=None, breakdown_limit=5):
+    """
+    Conversion per step plus per-country/device conversion, summed over days
+    (a visitor converting on two days counts twice). New or edited funnels
+    not evaluated yet come back as ``pending``, without numbers.
+    """
+    if funnel.evaluated_through is None:
+        return {'funnel': funnel, 'pending': True, 'steps': [{'label': label} for label in funnel.step_labels()]}
+    qs = FunnelResult.objects.filter(funnel=funnel, day__gte=since)
+    if until is not None:
+        qs = qs.filter(day__lte=until)
+    totals = defaultdict(lambda: defaultdict(int))
+    for row in qs.values('dimension', 'value', 'step').annotate(total=Sum('visitors')):
+        totals[(row['dimension'], row['value'])][row['step']] = row['total']
+
+    last = len(funnel.steps) - 1
+    site = totals.get((SITE, ''), {})
+    entered = site.get(0, 0)
+    steps = []
+    for index, label in enumerate(funnel.step_labels()):
+        visitors = site.get(index, 0)
+        steps.append({
+            'label': label,
+            'visitors': visitors,
+            'step_rate': _rate(visitors, site.get(index - 1, 0)) if index else 100 if visitors else 0,
+            'overall_rate': _rate(visitors, entered),
+        })
+
+    report = {'funnel': funnel, 'pending': False, 'steps': steps, 'conversion_rate': _rate(site.get(last, 0), entered)}
+    for dimension in BREAKDOWNS:
+        rows = [
+            {
+                'value': value or 'Unknown',
+                'entered': counts.get(0, 0),
+                'converted': counts.get(last, 0),
+                'rate': _rate(counts.get(last, 0), counts.get(0, 0)),
+            }
+            for (dim, value), counts in totals.items()
+            if dim == dimension
+        ]
+        rows.sort(key=lambda row: (-row['entered'], row['value']))
+        report[f'by_{dimension}'] = rows[:breakdown_limit]
+    return report
@@ -0,0 +1,233 @@
+"""
+Offline IP-to-geo lookups.
+
+``manage.py build_geoip`` turns an IP-range CSV into a compact binary file:
+
+    header   b'AGEO' | version (u16) | v4 count (u32) | v6 count (u32) | locations length (u32)
+    v4       starts (u32 each) | ends (u32 each) | location index (u32 each)
+    v6       starts (u128 each) | ends (u128 each) | location index (u32 each)
+    trailer  JSON list of [country, country_code, city, region]
+
+All integers are big-endian so the file is portable. Ranges are sorted and
+non-overlapping, so a lookup is a bisect over the memory-mapped ``starts``
+column followed by one ``ends`` comparison. Only the (small, deduplicated)
+location table is loaded into memory.
+"""
+import bisect
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+
+MAGIC = b'AGEO'
+VERSION = 1
+HEADER = struct.Struct('>4sHIII')
+INDEX_WIDTH = 4
+FAMILY_WIDTHS = {4: 4, 6: 16}
+
+LOCAL_GEO = {
+    'country': 'Local',
+    'country_code': 'XX',
+    'city': 'Local',
+    'region': 'Local',
+}
+
+
+def is_local_ip(ip_address):
+    """Loopback and private-network addresses never resolve to a real location"""
+    if ip_address in ('0.0.0.0', 'localhost'):
+        return True
+    try:
+        ip = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return False
+    return ip.is_private or ip.is_loopback or ip.is_unspecified or ip.is_link_local
+
+
+class _Column:
+    """Read-only sequence of fixed-width big-endian integers inside a buffer"""
+
+    def __init__(self, buf, offset, count, width):
+        self._buf = buf
+        self._offset = offset
+        self._count = count
+        self._width = width
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        start = self._offset + i * self._width
+        return int.from_bytes(self._buf[start:start + self._width], 'big')
+
+
+class GeoDatabase:
+    """Memory-mapped IP range table produced by :func:`write_database`"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, v4_count, v6_count, loc_len = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError(f'{self.path} is not a geo database (version {VERSION})')
+
+        offset = HEADER.size
+        self._families = {}
+        for family, count in ((4, v4_count), (6, v6_count)):
+            width = FAMILY_WIDTHS[family]
+            starts = _Column(self._mm, offset, count, width)
+            offset += count * width
+            ends = _Column(self._mm, offset, count, width)
+            offset += count * width
+            locations = _Column(self._mm, offset, count, INDEX_WIDTH)
+            offset += count * INDEX_WIDTH
+            self._families[family] = (starts, ends, locations)
+
+        self._locations = [
+            dict(zip(('country', 'country_code', 'city', 'region'), row))
+            for row in json.loads(self._mm[offset:offset + loc_len].decode('utf-8'))
+        ]
+
+    def __len__(self):
+        return sum(len(starts) for starts, _, _ in self._families.values())
+
+    def lookup(self, ip_address):
+        """Return the geo dict for ``ip_address`` or None if no range covers it"""
+        try:
+            ip = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+
+        starts, ends, locations = self._families[ip.version]
+        value = int(ip)
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        return dict(self._locations[locations[i]])
+
+    def close(self):
+        self._mm.close()
+
+
+def write_database(path, ranges):
+    """
+    Write ``ranges`` — iterable of (start_ip, end_ip, geo_dict) — to ``path``.
+
+    Ranges are sorted per address family; a range overlapping the previous
+    one is dropped. Returns a dict with the v4/v6 range counts written.
+    """
+    rows = {4: [], 6: []}
+    for start, end, geo in ranges:
+        start, end = ipaddress.ip_address(start), ipaddress.ip_address(end)
+        if start.version != end.version or int(end) < int(start):
+            continue
+        rows[start.version].append((int(start), int(end), geo))
+
+    location_ids = {}
+    location_table = []
+    columns = {}
+    for family, family_rows in rows.items():
+        family_rows.sort(key=lambda row: row[0])
+        starts, ends, indexes = [], [], []
+        last_end = -1
+        for start, end, geo in family_rows:
+            if start <= last_end:
+                continue
+            key = (
+                geo.get('country', ''), geo.get('country_code', ''),
+                geo.get('city', ''), geo.get('region', ''),
+            )
+            if key not in location_ids:
+                location_ids[key] = len(location_table)
+                location_table.append(list(key))
+            starts.append(start)
+            ends.append(end)
+            indexes.append(location_ids[key])
+            last_end = end
+        columns[family] = (starts, ends, indexes)
+
+    loc_blob = json.dumps(location_table, separators=(',', ':')).encode('utf-8')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(HEADER.pack(MAGIC, VERSION, len(columns[4][0]), len(columns[6][0]), len(loc_blob)))
+        for family in (4, 6):
+            width = FAMILY_WIDTHS[family]
+            starts, ends, indexes = columns[family]
+            fh.write(b''.join(v.to_bytes(width, 'big') for v in starts))
+            fh.write(b''.join(v.to_bytes(width, 'big') for v in ends))
+            fh.write(b''.join(v.to_bytes(INDEX_WIDTH, 'big') for v in indexes))
+        fh.write(loc_blob)
+    os.replace(tmp_path, path)
+    return {'ipv4': len(columns[4][0]), 'ipv6': len(columns[6][0])}
+
+
+# Seconds between checks of the database file for a new build (or a first one)
+RECHECK_INTERVAL = 60
+
+_database = None
+_database_lock = threading.Lock()
+_database_stamp = None
+_checked_at = None
+
+
+def _file_stamp(path):
+    try:
+        return os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        return None
+
+
+def get_database():
+    """
+    Process-wide database from ``settings.ANALYTICS_GEOIP_PATH`` (None if absent).
+    The file is re-checked every RECHECK_INTERVAL seconds, so a database built
+    or rebuilt with ``build_geoip`` is picked up without a restart.
+    """
+    global _database, _database_stamp, _checked_at
+    checked_at = _checked_at
+    if checked_at is not None and time.monotonic() - checked_at < RECHECK_INTERVAL:
+        return _database
+    with _database_lock:
+        if _checked_at is None or time.monotonic() - _checked_at >= RECHECK_INTERVAL:
+            path = getattr(settings, 'ANALYTICS_GEOIP_PATH', '')
+            stamp = _file_stamp(path)
+            if _checked_at is None or stamp != _database_stamp:
+                try:
+                    # The old mapping is left to the garbage collector: other threads may still read it
+                    _database = GeoDatabase(path) if stamp is not None else None
+                except (OSError, ValueError, struct.error):
+                    _database = None
+                _database_stamp = stamp
+            _checked_at = time.monotonic()
+    return _database
+
+
+def reset_database():
+    """Forget the loaded database so the next lookup reopens the file"""
+    global _database, _database_stamp, _checked_at
+    with _database_lock:
+        if _database is not None:
+            _database.close()
+        _database = None
+        _database_stamp = None
+        _checked_at = None
+
+
+def lookup(ip_address):
+    """Resolve ``ip_address`` from the local database; None when unknown"""
+    if is_local_ip(ip_address):
+        return dict(LOCAL_GEO)
+    database = get_database()
+    if database is None:
+        return None
+    return database.lookup(ip_address)
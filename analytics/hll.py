@@ -0,0 +1,89 @@
+"""
+HyperLogLog distinct counter.
+
+With the default precision of 12 a sketch has 4096 one-byte registers (4 KB
+serialized) and estimates cardinality with a standard error of
+1.04 / sqrt(4096) ~= 1.6%; about 95% of estimates fall within +/-3.3% of the
+true count. Small cardinalities use linear counting and are close to exact.
+Sketches with the same precision merge losslessly (register-wise max), so a
+date range is answered by merging its per-day sketches.
+"""
+import hashlib
+import math
+
+DEFAULT_PRECISION = 12
+HASH_BITS = 64
+
+_INVERSE_POWERS = [2.0 ** -i for i in range(HASH_BITS + 1)]
+
+
+def _hash(value):
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16')
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.size)
+        else:
+            if len(registers) != self.size:
+                raise ValueError('register count does not match precision')
+            self.registers = bytearray(registers)
+
+    @property
+    def relative_error(self):
+        """Standard error of :meth:`count` as a fraction"""
+        return 1.04 / math.sqrt(self.size)
+
+    def add(self, value):
+        x = _hash(value)
+        index = x >> (HASH_BITS - self.precision)
+        rest = x & ((1 << (HASH_BITS - self.precision)) - 1)
+        rank = HASH_BITS - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Fold ``other`` into this sketch (union of the counted sets)"""
+        if other.precision != self.precision:
+            raise ValueError('cannot merge sketches with different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(map(_INVERSE_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if zeros and estimate <= 2.5 * m:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        return cls(precision=data[0], registers=data[1:])
+
+    @classmethod
+    def union(cls, sketches, precision=DEFAULT_PRECISION):
+        result = cls(precision)
+        for sketch in sketches:
+            result.merge(sketch)
+        return result
@@ -0,0 +1,149 @@
+"""
+Write path for analytics records (PageView, BotVisit).
+
+Two modes, picked with ``settings.ANALYTICS_INGEST_MODE``:
+
+- ``sync``: every record is saved inline (one INSERT per tracked hit)
+- ``buffered``: records are queued in-process and written with ``bulk_create``
+  once ``ANALYTICS_BUFFER_SIZE`` records are pending or every
+  ``ANALYTICS_BUFFER_FLUSH_INTERVAL`` seconds, whichever comes first.
+  Whatever is still queued is flushed when the worker exits. Page views are
+  pointed at their interned dimensions on the way (see analytics.dimensions).
+"""
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import dimensions
+from .models import PageView
+
+logger = logging.getLogger(__name__)
+
+SYNC = 'sync'
+BUFFERED = 'buffered'
+
+
+def get_ingest_mode():
+    mode = (getattr(settings, 'ANALYTICS_INGEST_MODE', SYNC) or SYNC).lower()
+    return mode if mode in (SYNC, BUFFERED) else SYNC
+
+
+def get_batch_size():
+    return max(1, int(getattr(settings, 'ANALYTICS_BUFFER_SIZE', 100) or 1))
+
+
+def get_flush_interval():
+    return float(getattr(settings, 'ANALYTICS_BUFFER_FLUSH_INTERVAL', 5) or 0)
+
+
+class IngestBuffer:
+    """Thread-safe in-process queue of unsaved model instances"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def add(self, obj):
+        """Queue an unsaved instance; never touches the database in the request path
+        unless no background flusher is running and the batch is full."""
+        with self._lock:
+            self._pending.append(obj)
+            full = len(self._pending) >= get_batch_size()
+
+        if self._ensure_flusher():
+            if full:
+                self._wake.set()
+        elif full:
+            self.flush()
+
+    def flush(self):
+        """Write everything queued so far, grouped per model. Returns rows written."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+
+        by_model = defaultdict(list)
+        for obj in pending:
+            by_model[type(obj)].append(obj)
+
+        written = 0
+        for model, objs in by_model.items():
+            if model is PageView:
+                try:
+                    dimensions.intern_rows(objs)
+                except Exception:
+                    # Written with their strings; dimensions.intern_pending() retries later
+                    logger.exception('Failed to intern %d page views', len(objs))
+                    for obj in objs:
+                        obj.page_id = obj.agent_id = obj.referrer_host_id = None
+            try:
+                model.objects.bulk_create(objs, batch_size=get_batch_size())
+                written += len(objs)
+            except Exception:
+                # Analytics must never take the site down; drop the batch
+                logger.exception('Failed to flush %d %s records', len(objs), model.__name__)
+        return written
+
+    def shutdown(self):
+        """Stop the flusher thread and write out anything still queued"""
+        self._stop.set()
+        self._wake.set()
+        thread = self._thread
+        if thread and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=10)
+        self._thread = None
+        self.flush()
+
+    def _ensure_flusher(self):
+        interval = get_flush_interval()
+        if interval <= 0:
+            return False
+        if self._thread and self._thread.is_alive():
+            return True
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, args=(interval,), name='analytics-flusher', daemon=True
+                )
+                self._thread.start()
+        return True
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            self._wake.wait(interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+buffer = IngestBuffer()
+atexit.register(buffer.shutdown)
+
+
+def record(obj):
+    """Persist an analytics record according to the configured ingest mode"""
+    if get_ingest_mode() == BUFFERED:
+        buffer.add(obj)
+    else:
+        obj.save()
+
+
+def flush():
+    """Write any buffered records now (no-op in sync mode)"""
+    return buffer.flush()
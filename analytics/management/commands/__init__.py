@@ -0,0 +1,2 @@
+# This file makes this directory a Python package
+
@@ -0,0 +1,45 @@
+"""
+Management command to evaluate conversion funnels for the days that received
+new page views, events or payments since the last run.
+Run with: python manage.py build_funnels [--loop] [--interval 300] [--rebuild --days 30]
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from analytics import funnels
+from analytics.models import Funnel
+
+
+class Command(BaseCommand):
+    help = 'Incrementally evaluates analytics funnels into per-day FunnelResult rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep running, updating every --interval seconds')
+        parser.add_argument('--interval', type=float, default=300, help='Seconds between runs with --loop')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Recompute the last --days days (e.g. after editing a funnel) before updating',
+        )
+        parser.add_argument('--days', type=int, default=None, help='Days to recompute with --rebuild')
+        parser.add_argument('--funnel', default=None, help='Slug of the funnel to rebuild (default: all active)')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            selected = None
+            if options['funnel']:
+                selected = list(Funnel.objects.filter(slug=options['funnel']))
+                if not selected:
+                    raise CommandError(f'No funnel with slug {options["funnel"]!r}')
+            days = options['days'] or funnels.get_backfill_days()
+            evaluated = funnels.rebuild_funnels(days, funnels=selected)
+            self.stdout.write(self.style.WARNING(f'Rebuilt {evaluated} funnel-days'))
+
+        while True:
+            close_old_connections()
+            evaluated = funnels.update_funnels()
+            self.stdout.write(self.style.SUCCESS(f'Evaluated {evaluated} funnel-days'))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,100 @@
+"""
+Management command to build the offline IP-to-geo database used by analytics.
+Run with: python manage.py build_geoip ranges.csv [--output path] [--columns ...]
+
+The CSV holds one IP range per row (IPv4 and IPv6 may be mixed). Range bounds
+may be dotted/colon notation or plain integers (IP2Location LITE style).
+"""
+import csv
+import ipaddress
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics import geo
+
+DEFAULT_COLUMNS = 'start,end,country_code,country,region,city'
+KNOWN_COLUMNS = {'start', 'end', 'country_code', 'country', 'region', 'city'}
+
+
+def parse_ip(value, hint_v6=False):
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        if number > 0xFFFFFFFF or hint_v6:
+            return ipaddress.IPv6Address(number)
+        return ipaddress.IPv4Address(number)
+    return ipaddress.ip_address(value)
+
+
+class Command(BaseCommand):
+    help = 'Builds the memory-mapped IP-to-geo database from an IP range CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_path', help='CSV file with one IP range per row')
+        parser.add_argument(
+            '--output',
+            default=getattr(settings, 'ANALYTICS_GEOIP_PATH', ''),
+            help='Where to write the database (default: ANALYTICS_GEOIP_PATH)',
+        )
+        parser.add_argument(
+            '--columns',
+            default=DEFAULT_COLUMNS,
+            help=f'Comma-separated column names in CSV order; use "_" to skip a column '
+                 f'(default: {DEFAULT_COLUMNS})',
+        )
+        parser.add_argument(
+            '--ipv6', action='store_true',
+            help='Treat integer range bounds as IPv6 (for IP2Location IPv6 files)',
+        )
+        parser.add_argument('--skip-header', action='store_true', help='Ignore the first CSV row')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        if not output:
+            raise CommandError('No output path: pass --output or set ANALYTICS_GEOIP_PATH')
+
+        columns = [c.strip() for c in options['columns'].split(',')]
+        unknown = set(columns) - KNOWN_COLUMNS - {'_'}
+        if unknown or not {'start', 'end'} <= set(columns):
+            raise CommandError(
+                f'--columns must name start and end; unknown columns: {", ".join(sorted(unknown)) or "-"}'
+            )
+
+        skipped = 0
+
+        def ranges():
+            nonlocal skipped
+            with open(options['csv_path'], newline='', encoding='utf-8') as fh:
+                reader = csv.reader(fh)
+                if options['skip_header']:
+                    next(reader, None)
+                for row in reader:
+                    record = {
+                        name: ('' if value.strip() == '-' else value.strip())
+                        for name, value in zip(columns, row) if name != '_'
+                    }
+                    try:
+                        start = parse_ip(record['start'], options['ipv6'])
+                        end = parse_ip(record['end'], options['ipv6'])
+                    except (KeyError, ValueError):
+                        skipped += 1
+                        continue
+                    country_code = record.get('country_code', '')[:2].upper()
+                    yield start, end, {
+                        'country': record.get('country') or country_code,
+                        'country_code': country_code,
+                        'city': record.get('city', ''),
+                        'region': record.get('region', ''),
+                    }
+
+        try:
+            counts = geo.write_database(output, ranges())
+        except OSError as exc:
+            raise CommandError(str(exc))
+        geo.reset_database()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {counts['ipv4']} IPv4 and {counts['ipv6']} IPv6 ranges to {output}"
+            + (f' ({skipped} unparsable rows skipped)' if skipped else '')
+        ))
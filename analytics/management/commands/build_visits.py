@@ -0,0 +1,37 @@
+"""
+Management command to group new page views into visits (30 minutes of
+inactivity ends a visit) for bounce rate, pages per visit and entry/exit pages.
+Run with: python manage.py build_visits [--loop] [--interval 60] [--rebuild]
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from analytics import visits
+
+
+class Command(BaseCommand):
+    help = 'Incrementally sessionizes raw page views into Visit rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Page views per transaction')
+        parser.add_argument('--loop', action='store_true', help='Keep running, updating every --interval seconds')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between runs with --loop')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Drop existing visits and rebuild them from the page views still in the raw table',
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            visits.reset_visits()
+            self.stdout.write(self.style.WARNING('Visits cleared; rebuilding from raw page views'))
+
+        while True:
+            close_old_connections()
+            processed = visits.update_visits(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Sessionized {processed} page views'))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
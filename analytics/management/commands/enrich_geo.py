@@ -0,0 +1,38 @@
+"""
+Management command to fill in country/city for page views recorded with
+ANALYTICS_GEO_MODE = 'deferred', resolving each distinct IP once per batch.
+Run with: python manage.py enrich_geo [--loop] [--interval 30] [--batch-size 1000]
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+from analytics import enrich
+
+
+class Command(BaseCommand):
+    help = 'Resolves geo data for page views stored without it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Page views per batch')
+        parser.add_argument('--loop', action='store_true', help='Keep running, enriching every --interval seconds')
+        parser.add_argument('--interval', type=float, default=30, help='Seconds between runs with --loop')
+        parser.add_argument(
+            '--resolver', default=None,
+            help='Dotted path to a resolver class (default: ANALYTICS_GEO_RESOLVER)',
+        )
+
+    def handle(self, *args, **options):
+        resolver = import_string(options['resolver'])() if options['resolver'] else enrich.get_resolver()
+
+        while True:
+            close_old_connections()
+            totals = enrich.enrich_pageviews(batch_size=options['batch_size'], resolver=resolver)
+            self.stdout.write(self.style.SUCCESS(
+                f"Enriched {totals['updated']} of {totals['processed']} page views"
+            ))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,56 @@
+"""
+Management command to stream raw page views, events or bot visits as CSV or
+NDJSON without loading them into memory.
+Run with: python manage.py export_analytics pageview [--start 2025-01-01] [--end 2025-01-31]
+          [--columns id,timestamp,path] [--format csv|ndjson] [--gzip] [--output file]
+"""
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from analytics import export
+
+
+def _date(value):
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise CommandError(f'{value!r} is not a YYYY-MM-DD date')
+    return day
+
+
+class Command(BaseCommand):
+    help = 'Streams raw analytics rows to a file or stdout as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', choices=sorted(export.SOURCES))
+        parser.add_argument('--start', type=_date, default=None, help='First day (YYYY-MM-DD, local time)')
+        parser.add_argument('--end', type=_date, default=None, help='Last day, inclusive')
+        parser.add_argument('--columns', default=None, help='Comma-separated columns (default: all)')
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default=export.CSV)
+        parser.add_argument('--gzip', action='store_true', help='Compress the output')
+        parser.add_argument('--chunk-size', type=int, default=None, help='Rows fetched per database round trip')
+        parser.add_argument('--output', default=None, help='File to write (default: stdout)')
+
+    def handle(self, *args, **options):
+        try:
+            chunks = export.stream(
+                options['source'], options['format'], options['columns'],
+                options['start'], options['end'], options['gzip'], options['chunk_size'],
+            )
+        except export.ExportError as e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            with open(options['output'], 'wb') as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+            self.stdout.write(self.style.SUCCESS(f'Exported {options["source"]} to {options["output"]}'))
+        else:
+            out = sys.stdout.buffer
+            for chunk in chunks:
+                out.write(chunk)
+            out.flush()
@@ -0,0 +1,229 @@
+"""
+Compiled matchers used by AnalyticsMiddleware on every request.
+
+- SignatureMatcher: Aho-Corasick automaton over lowercase bot signatures. One
+  pass over the user agent finds every signature it contains, so the cost
+  depends on the user-agent length, not on how many signatures are loaded.
+  Short lists (the built-in one) are faster with C-level substring checks,
+  so those skip the automaton.
+- PathPrefixTrie: character trie of excluded paths. Entries ending in "/"
+  exclude the whole subtree, other entries must match the path exactly.
+
+They are built once per process from settings (ANALYTICS_BOT_SIGNATURES,
+ANALYTICS_BOT_SIGNATURES_FILE, ANALYTICS_EXCLUDE_PATHS, ANALYTICS_BOT_ALLOWLIST)
+and rebuilt when those settings change (e.g. under override_settings).
+"""
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Order matters: when several signatures match, the earliest one is reported
+DEFAULT_BOT_SIGNATURES = [
+    'bot', 'crawler', 'spider', 'scraper', 'curl', 'wget',
+    'python-requests', 'java', 'http', 'headless', 'phantom',
+    'selenium', 'playwright', 'puppeteer', 'slurp', 'bingpreview',
+    'googlebot', 'bingbot', 'yandexbot', 'baiduspider', 'facebookexternalhit',
+    'twitterbot', 'linkedinbot', 'whatsapp', 'telegrambot', 'slackbot',
+    'discordbot', 'petalbot', 'ahrefsbot', 'semrushbot', 'mj12bot',
+    'dotbot', 'rogerbot', 'exabot', 'screaming frog', 'archive.org',
+]
+
+DEFAULT_EXCLUDE_PATHS = [
+    '/admin/',
+    '/static/',
+    '/media/',
+    '/api/',
+    '/cms/',
+    '/analytics/',
+    '/favicon.ico',
+    '/app-ads.txt',
+    '/robots.txt',
+]
+
+# Well-behaved crawlers that are never rate limited (see analytics.ratelimit)
+DEFAULT_BOT_ALLOWLIST = [
+    'googlebot', 'bingbot', 'yandexbot', 'baiduspider', 'duckduckbot', 'applebot',
+    'facebookexternalhit', 'twitterbot', 'linkedinbot', 'whatsapp', 'telegrambot',
+    'slackbot', 'discordbot',
+]
+
+# Up to this many signatures a plain `in` scan beats the pure-Python automaton
+LINEAR_SCAN_LIMIT = 64
+
+SETTING_NAMES = {
+    'ANALYTICS_BOT_SIGNATURES', 'ANALYTICS_BOT_SIGNATURES_FILE', 'ANALYTICS_EXCLUDE_PATHS', 'ANALYTICS_BOT_ALLOWLIST',
+}
+
+
+class SignatureMatcher:
+    """Reports the highest-priority signature in a text (Aho-Corasick for long lists)"""
+
+    def __init__(self, signatures):
+        self.signatures = []
+        seen = set()
+        for signature in signatures:
+            signature = signature.strip().lower()
+            if signature and signature not in seen:
+                seen.add(signature)
+                self.signatures.append(signature)
+
+        self._linear = len(self.signatures) <= LINEAR_SCAN_LIMIT
+        if not self._linear:
+            self._build_automaton()
+
+    @property
+    def algorithm(self):
+        """Which search this matcher runs: 'linear scan' or 'Aho-Corasick automaton'"""
+        return 'linear scan' if self._linear else 'Aho-Corasick automaton'
+
+    def _build_automaton(self):
+        # Node 0 is the root; per node: transitions, failure link, best match index
+        self._goto = [{}]
+        self._fail = [0]
+        self._best = [None]
+        for priority, signature in enumerate(self.signatures):
+            node = 0
+            for ch in signature:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._best.append(None)
+                node = nxt
+            if self._best[node] is None:
+                self._best[node] = priority
+
+        # Breadth-first failure links; each node inherits the best output of its fail chain
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                inherited = self._best[self._fail[child]]
+                if inherited is not None and (self._best[child] is None or inherited < self._best[child]):
+                    self._best[child] = inherited
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def search(self, text):
+        """Return the earliest-listed signature contained in ``text`` (None if none)"""
+        if self._linear:
+            text = text.lower()
+            for signature in self.signatures:
+                if signature in text:
+                    return signature
+            return None
+
+        goto, fail, best_at = self._goto, self._fail, self._best
+        node = 0
+        best = None
+        for ch in text.lower():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            found = best_at[node]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0:
+                    break
+        return None if best is None else self.signatures[best]
+
+
+class PathPrefixTrie:
+    """Character trie answering "is this path excluded?" in one walk"""
+
+    _PREFIX = object()
+    _EXACT = object()
+
+    def __init__(self, paths):
+        self._root = {}
+        self.size = 0
+        for path in paths:
+            if not path:
+                continue
+            node = self._root
+            for ch in path:
+                node = node.setdefault(ch, {})
+            node[self._PREFIX if path.endswith('/') else self._EXACT] = True
+            self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def matches(self, path):
+        node = self._root
+        for ch in path:
+            if self._PREFIX in node:
+                return True
+            node = node.get(ch)
+            if node is None:
+                return False
+        return self._PREFIX in node or self._EXACT in node
+
+
+def load_bot_signatures():
+    signatures = list(getattr(settings, 'ANALYTICS_BOT_SIGNATURES', None) or DEFAULT_BOT_SIGNATURES)
+    path = getattr(settings, 'ANALYTICS_BOT_SIGNATURES_FILE', '')
+    if path:
+        # One signature per line; blank lines and "#" comments are ignored
+        with open(path, encoding='utf-8') as fh:
+            signatures.extend(
+                line.strip() for line in fh if line.strip() and not line.lstrip().startswith('#')
+            )
+    return signatures
+
+
+_lock = threading.Lock()
+_bot_matcher = None
+_allowlist_matcher = None
+_path_trie = None
+
+
+def get_bot_matcher():
+    global _bot_matcher
+    if _bot_matcher is None:
+        with _lock:
+            if _bot_matcher is None:
+                _bot_matcher = SignatureMatcher(load_bot_signatures())
+    return _bot_matcher
+
+
+def get_allowlist_matcher():
+    global _allowlist_matcher
+    if _allowlist_matcher is None:
+        with _lock:
+            if _allowlist_matcher is None:
+                signatures = getattr(settings, 'ANALYTICS_BOT_ALLOWLIST', None)
+                _allowlist_matcher = SignatureMatcher(DEFAULT_BOT_ALLOWLIST if signatures is None else signatures)
+    return _allowlist_matcher
+
+
+def get_excluded_paths():
+    global _path_trie
+    if _path_trie is None:
+        with _lock:
+            if _path_trie is None:
+                paths = getattr(settings, 'ANALYTICS_EXCLUDE_PATHS', None) or DEFAULT_EXCLUDE_PATHS
+                _path_trie = PathPrefixTrie(paths)
+    return _path_trie
+
+
+@receiver(setting_changed)
+def _reset_matchers(setting, **kwargs):
+    global _bot_matcher, _allowlist_matcher, _path_trie
+    if setting in SETTING_NAMES:
+        with _lock:
+            _bot_matcher = None
+            _allowlist_matcher = None
+            _path_trie = None
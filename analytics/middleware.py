@@ -1,48 +1,74 @@
+import html
 import re
 import requests
+from django.conf import settings
+from django.http import HttpResponse
 from django.utils.deprecation import MiddlewareMixin
 from django.core.cache import cache
+from django.utils import timezone
 from .models import PageView, BotVisit
+from . import enrich, geo, ingest, matching, ratelimit, realtime, useragent, visitor
+
+TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+
+# Where human page views are recorded: 'server' (this middleware) or 'beacon'
+# (a request from static/js/analytics.js, which also works for cached pages)
+SERVER = 'server'
+BEACON = 'beacon'
+
+
+def get_tracking_mode():
+    mode = (getattr(settings, 'ANALYTICS_TRACKING_MODE', SERVER) or SERVER).lower()
+    return mode if mode in (SERVER, BEACON) else SERVER
 
 
 class AnalyticsMiddleware(MiddlewareMixin):
     """Automatically track page views"""
     
-    # Paths to exclude from tracking
-    EXCLUDE_PATHS = [
-        r'^/admin/',
-        r'^/static/',
-        r'^/media/',
-        r'^/api/',
-        r'^/cms/',
-        r'^/favicon\.ico$',
-        r'^/app-ads\.txt$',
-        r'^/robots\.txt$',
-    ]
+    # Only this much of the body is searched for <title> (it lives in <head>)
+    TITLE_SCAN_BYTES = 8192
+    
+    # Excluded paths and bot signatures are compiled once per process from
+    # settings (see analytics.matching for the defaults and matching rules)
     
     def is_bot(self, user_agent):
         """Detect if the user agent is a bot - returns (is_bot, bot_type)"""
         if not user_agent:
             return True, 'empty-user-agent'
         
-        user_agent_lower = user_agent.lower()
+        pattern = matching.get_bot_matcher().search(user_agent)
+        if pattern:
+            return True, pattern
         
-        # Common bot indicators
-        bot_patterns = [
-            'bot', 'crawler', 'spider', 'scraper', 'curl', 'wget',
-            'python-requests', 'java', 'http', 'headless', 'phantom',
-            'selenium', 'playwright', 'puppeteer', 'slurp', 'bingpreview',
-            'googlebot', 'bingbot', 'yandexbot', 'baiduspider', 'facebookexternalhit',
-            'twitterbot', 'linkedinbot', 'whatsapp', 'telegrambot', 'slackbot',
-            'discordbot', 'petalbot', 'ahrefsbot', 'semrushbot', 'mj12bot',
-            'dotbot', 'rogerbot', 'exabot', 'screaming frog', 'archive.org',
-        ]
+        return False, None
+    
+    def classify_user_agent(self, user_agent):
+        """(is_bot, bot_type, browser, device, os), memoized per distinct user agent"""
+        return useragent.cache.get_or_classify(user_agent, self._classify_user_agent)
+    
+    def _classify_user_agent(self, user_agent):
+        is_bot, bot_type = self.is_bot(user_agent)
+        if is_bot:
+            return is_bot, bot_type, '', '', ''
+        return (is_bot, bot_type) + self.parse_user_agent(user_agent)
+    
+    def process_request(self, request):
+        """Turn away crawlers over ANALYTICS_BOT_BLOCK_RATE (see analytics.ratelimit)"""
+        if not ratelimit.get_block_rate():
+            return None
         
-        for pattern in bot_patterns:
-            if pattern in user_agent_lower:
-                return True, pattern
+        user_agent = request.META.get('HTTP_USER_AGENT', '')
+        if not self.classify_user_agent(user_agent)[0]:
+            return None
+        if request.user.is_authenticated and request.user.is_staff:
+            return None
         
-        return False, None
+        rate = ratelimit.observe(request, self.get_client_ip(request), user_agent)
+        if ratelimit.should_block(user_agent, rate):
+            response = HttpResponse('Too many requests', status=429, content_type='text/plain')
+            response['Retry-After'] = str(ratelimit.WINDOW)
+            return response
+        return None
     
     def process_response(self, request, response):
         # Only track successful GET requests
@@ -51,85 +77,123 @@ class AnalyticsMiddleware(MiddlewareMixin):
         
         # Check if path should be excluded
         path = request.path
-        for pattern in self.EXCLUDE_PATHS:
-            if re.match(pattern, path):
-                return response
-        
-        # Exclude admin/staff users from analytics
-        if request.user.is_authenticated and request.user.is_staff:
-            return response
-        
-        # Check for analytics exclusion cookie
-        if request.COOKIES.get('exclude_analytics') == 'true':
+        if matching.get_excluded_paths().matches(path):
             return response
         
-        # Check for exclusion URL parameter
-        if request.GET.get('exclude_analytics') == 'true':
+        # Staff and opted-out visitors aren't tracked
+        if self.is_excluded_visitor(request):
             return response
         
         # Check for bots and log them separately
         user_agent = request.META.get('HTTP_USER_AGENT', '')
-        is_bot, bot_type = self.is_bot(user_agent)
+        is_bot, bot_type, browser, device, os_name = self.classify_user_agent(user_agent)
         
         if is_bot:
             # Log bot visit for monitoring (don't count in regular analytics)
             try:
-                ip_address = self.get_client_ip(request)
-                BotVisit.objects.create(
-                    path=request.path,
-                    user_agent=user_agent[:500],  # Truncate if too long
-                    ip_address=ip_address,
-                    bot_type=bot_type or 'unknown',
-                )
+                self.record_bot_visit(request, path, user_agent, bot_type)
             except Exception:
                 pass  # Don't break if bot logging fails
             
             return response  # Don't track in regular analytics
         
+        # In beacon mode page views are reported by static/js/analytics.js
+        # instead (see analytics.beacon), so cached pages are counted too
+        if get_tracking_mode() == BEACON:
+            return response
+        
         try:
-            # Get or create session key
-            if not request.session.session_key:
-                request.session.create()
-            
-            # Extract browser/device info from user agent
-            user_agent = request.META.get('HTTP_USER_AGENT', '')
-            browser, device, os_name = self.parse_user_agent(user_agent)
-            
-            # Get referrer info
-            referrer = request.META.get('HTTP_REFERER', '')
-            referrer_domain = self.extract_domain(referrer) if referrer else ''
-            
-            # Get IP address
-            ip_address = self.get_client_ip(request)
-            
-            # Get geographic info
-            geo_data = self.get_geo_data(ip_address)
-            
-            # Create page view record
-            PageView.objects.create(
-                url=request.build_absolute_uri(),
+            analytics_visitor = self.record_page_view(
+                request,
                 path=path,
-                page_title=self.extract_page_title(response),
-                user=request.user if request.user.is_authenticated else None,
-                session_key=request.session.session_key,
-                ip_address=ip_address,
-                country=geo_data.get('country', ''),
-                country_code=geo_data.get('country_code', ''),
-                city=geo_data.get('city', ''),
-                region=geo_data.get('region', ''),
+                url=request.build_absolute_uri(),
+                page_title=self.extract_page_title(response, request),
+                referrer=request.META.get('HTTP_REFERER', ''),
                 user_agent=user_agent,
                 browser=browser,
                 device=device,
-                os=os_name,
-                referrer=referrer,
-                referrer_domain=referrer_domain,
+                os_name=os_name,
             )
+            visitor.set_visitor_cookie(response, analytics_visitor)
         except Exception as e:
             # Silently fail - don't break the site if analytics fails
             pass
         
         return response
     
+    def record_bot_visit(self, request, path, user_agent, bot_type):
+        """Queue a BotVisit (inline or buffered, see analytics.ingest); aggregated during crawl spikes"""
+        ip_address = self.get_client_ip(request)
+        rate = ratelimit.observe(request, ip_address, user_agent)
+        visit = BotVisit(
+            timestamp=timezone.now(),
+            path=path,
+            user_agent=user_agent[:500],  # Truncate if too long
+            ip_address=ip_address,
+            bot_type=bot_type or 'unknown',
+        )
+        for row in ratelimit.visits_to_record(ratelimit.client_key(ip_address, user_agent), rate, visit):
+            ingest.record(row)
+    
+    def record_page_view(self, request, path, url, page_title, referrer, user_agent, browser, device, os_name):
+        """Queue a PageView for a human visitor and return their analytics Visitor"""
+        # Anonymous visitor ID from a signed cookie (no DB session needed)
+        analytics_visitor = visitor.get_visitor(request)
+        
+        # Get referrer info
+        referrer_domain = self.extract_domain(referrer) if referrer else ''
+        
+        # Get IP address
+        ip_address = self.get_client_ip(request)
+        
+        # Get geographic info (or leave it to the enrichment worker)
+        if enrich.get_geo_mode() == enrich.DEFERRED:
+            geo_data = enrich.EMPTY_GEO
+        else:
+            geo_data = self.get_geo_data(ip_address)
+        
+        # Record page view (inline or buffered, see analytics.ingest)
+        ingest.record(PageView(
+            timestamp=timezone.now(),
+            url=url,
+            path=path,
+            page_title=page_title,
+            user=request.user if request.user.is_authenticated else None,
+            session_key=analytics_visitor.id,
+            ip_address=ip_address,
+            country=geo_data.get('country', ''),
+            country_code=geo_data.get('country_code', ''),
+            city=geo_data.get('city', ''),
+            region=geo_data.get('region', ''),
+            browser=browser,
+            device=device,
+            os=os_name,
+            referrer=referrer,
+            referrer_domain=referrer_domain,
+            # Moved onto the interned UserAgent later (analytics.dimensions)
+            user_agent=user_agent,
+        ))
+        
+        # Live "active now" counter (cache only, see analytics.realtime)
+        try:
+            realtime.mark_active(analytics_visitor.id, path)
+        except Exception:
+            pass
+        return analytics_visitor
+    
+    def is_excluded_visitor(self, request):
+        """Staff users and visitors who opted out of analytics"""
+        # Exclude admin/staff users from analytics
+        if request.user.is_authenticated and request.user.is_staff:
+            return True
+        
+        # Check for analytics exclusion cookie
+        if request.COOKIES.get('exclude_analytics') == 'true':
+            return True
+        
+        # Check for exclusion URL parameter
+        return request.GET.get('exclude_analytics') == 'true'
+    
     def get_client_ip(self, request):
         """Extract client IP address"""
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -191,14 +255,18 @@ class AnalyticsMiddleware(MiddlewareMixin):
             return ''
     
     def get_geo_data(self, ip_address):
-        """Get geographic data from IP address using free API"""
-        # Skip for local IPs
-        if ip_address in ['127.0.0.1', '0.0.0.0', 'localhost'] or ip_address.startswith('192.168.'):
+        """Get geographic data from the local IP range database (see analytics.geo)"""
+        geo_data = geo.lookup(ip_address)
+        if geo_data is not None:
+            return geo_data
+        
+        # Optional fallback for addresses the local database doesn't cover
+        if not getattr(settings, 'ANALYTICS_GEO_HTTP_FALLBACK', False):
             return {
-                'country': 'Local',
-                'country_code': 'XX',
-                'city': 'Local',
-                'region': 'Local'
+                'country': '',
+                'country_code': '',
+                'city': '',
+                'region': ''
             }
         
         # Check cache first (cache for 24 hours)
@@ -236,14 +304,34 @@ class AnalyticsMiddleware(MiddlewareMixin):
             'region': ''
         }
     
-    def extract_page_title(self, response):
-        """Try to extract page title from HTML"""
+    def extract_page_title(self, response, request=None):
+        """
+        Page title for the PageView record, cheapest source first:
+        ``response.analytics_title`` set by a view, ``analytics_title`` in a
+        TemplateResponse context, the <title> base.html rendered (its
+        ``{% page_title %}`` tag), then a scan of only the first
+        TITLE_SCAN_BYTES of an HTML body. Streaming responses are skipped.
+        """
+        title = getattr(response, 'analytics_title', None)
+        if title is None:
+            context = getattr(response, 'context_data', None)
+            if isinstance(context, dict):
+                title = context.get('analytics_title')
+        if title is None:
+            title = getattr(request, 'analytics_title', None)
+        if title is not None:
+            return str(title).strip()[:200]
+        
+        if getattr(response, 'streaming', False):
+            return ''
+        if not response.get('Content-Type', '').startswith('text/html'):
+            return ''
         try:
-            if hasattr(response, 'content'):
-                content = response.content.decode('utf-8', errors='ignore')
-                match = re.search(r'<title[^>]*>(.*?)</title>', content, re.IGNORECASE)
-                if match:
-                    return match.group(1).strip()[:200]
-        except:
+            head = response.content[:self.TITLE_SCAN_BYTES]
+            match = TITLE_RE.search(head)
+            if match:
+                title = match.group(1).decode('utf-8', errors='ignore')
+                return html.unescape(' '.join(title.split()))[:200]
+        except Exception:
             pass
         return ''
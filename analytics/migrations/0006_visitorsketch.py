@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0005_trafficrollup_aggregationwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitorSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('path', models.CharField(blank=True, max_length=500)),
+                ('registers', models.BinaryField()),
+            ],
+            options={
+                'ordering': ['-day'],
+                'constraints': [models.UniqueConstraint(fields=('day', 'path'), name='analytics_visitor_sketch_day_path')],
+            },
+        ),
+    ]
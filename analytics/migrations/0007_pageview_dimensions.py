@@ -0,0 +1,69 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0006_visitorsketch'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Path',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReferrerDomain',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domain', models.CharField(max_length=200, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=32, unique=True)),
+                ('user_agent', models.TextField()),
+                ('browser', models.CharField(blank=True, max_length=50)),
+                ('device', models.CharField(blank=True, max_length=50)),
+                ('os', models.CharField(blank=True, max_length=50)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='pageview',
+            name='analytics_p_timesta_cd14c8_idx',
+        ),
+        migrations.AlterField(
+            model_name='pageview',
+            name='user_agent',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='pageview',
+            name='page',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='views', to='analytics.path'),
+        ),
+        migrations.AddField(
+            model_name='pageview',
+            name='referrer_host',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='views', to='analytics.referrerdomain'),
+        ),
+        migrations.AddField(
+            model_name='pageview',
+            name='agent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='views', to='analytics.useragent'),
+        ),
+        migrations.AddIndex(
+            model_name='pageview',
+            index=models.Index(fields=['timestamp', 'page'], name='analytics_p_timesta_ce023d_idx'),
+        ),
+    ]
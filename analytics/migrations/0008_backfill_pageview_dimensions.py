@@ -0,0 +1,92 @@
+import hashlib
+
+from django.db import migrations
+from django.db.models import Max
+
+BATCH_SIZE = 2000
+
+
+def _intern(model, field, values):
+    """{value: id}, creating missing rows in one INSERT"""
+    values = set(values)
+    if not values:
+        return {}
+    model.objects.bulk_create([model(**{field: value}) for value in values], ignore_conflicts=True)
+    return dict(model.objects.filter(**{f'{field}__in': values}).values_list(field, 'id'))
+
+
+def _intern_user_agents(model, rows):
+    by_digest = {}
+    for row in rows:
+        ua = row.user_agent
+        if ua:
+            digest = hashlib.blake2b(ua.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+            by_digest.setdefault(digest, row)
+    if not by_digest:
+        return {}
+    model.objects.bulk_create(
+        [
+            model(digest=digest, user_agent=row.user_agent, browser=row.browser, device=row.device, os=row.os)
+            for digest, row in by_digest.items()
+        ],
+        ignore_conflicts=True,
+    )
+    ids = dict(model.objects.filter(digest__in=by_digest).values_list('digest', 'id'))
+    return {row.user_agent: ids[digest] for digest, row in by_digest.items()}
+
+
+def backfill(apps, schema_editor):
+    """Point existing page views at the dimension tables, one id range at a time"""
+    PageView = apps.get_model('analytics', 'PageView')
+    UserAgent = apps.get_model('analytics', 'UserAgent')
+    Path = apps.get_model('analytics', 'Path')
+    ReferrerDomain = apps.get_model('analytics', 'ReferrerDomain')
+    AggregationWatermark = apps.get_model('analytics', 'AggregationWatermark')
+
+    # Everything up to here is interned below; dimensions.intern_pending() starts after it
+    max_id = PageView.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    last_id = 0
+    while True:
+        rows = list(
+            PageView.objects.filter(id__gt=last_id, page__isnull=True)
+            .only('id', 'path', 'user_agent', 'browser', 'device', 'os', 'referrer_domain')
+            .order_by('id')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        path_ids = _intern(Path, 'path', (row.path[:500] for row in rows if row.path))
+        domain_ids = _intern(ReferrerDomain, 'domain', (row.referrer_domain[:200] for row in rows if row.referrer_domain))
+        agent_ids = _intern_user_agents(UserAgent, rows)
+
+        for row in rows:
+            row.page_id = path_ids.get(row.path[:500])
+            row.referrer_host_id = domain_ids.get(row.referrer_domain[:200])
+            row.agent_id = agent_ids.get(row.user_agent)
+            if row.agent_id:
+                row.user_agent = ''
+        PageView.objects.bulk_update(rows, ['page', 'referrer_host', 'agent', 'user_agent'])
+
+    AggregationWatermark.objects.update_or_create(name='dimensions:pageview', defaults={'last_id': max_id})
+
+
+def restore_user_agents(apps, schema_editor):
+    PageView = apps.get_model('analytics', 'PageView')
+    UserAgent = apps.get_model('analytics', 'UserAgent')
+    apps.get_model('analytics', 'AggregationWatermark').objects.filter(name='dimensions:pageview').delete()
+    for agent in UserAgent.objects.iterator(chunk_size=BATCH_SIZE):
+        PageView.objects.filter(agent_id=agent.id, user_agent='').update(user_agent=agent.user_agent)
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own so large tables don't need one huge transaction
+    atomic = False
+
+    dependencies = [
+        ('analytics', '0007_pageview_dimensions'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, restore_user_agents),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0009_heavyhittersketch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botvisit',
+            name='hits',
+            field=models.PositiveIntegerField(default=1, help_text='Requests this row stands for (aggregated during crawl spikes)'),
+        ),
+    ]
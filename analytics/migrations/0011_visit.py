@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0010_botvisit_hits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Visit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_key', models.CharField(max_length=40)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('duration', models.PositiveIntegerField(default=0, help_text='Seconds between first and last page view')),
+                ('page_count', models.PositiveIntegerField(default=1)),
+                ('entry_path', models.CharField(max_length=500)),
+                ('exit_path', models.CharField(max_length=500)),
+                ('referrer_domain', models.CharField(blank=True, max_length=200)),
+                ('country', models.CharField(blank=True, max_length=100)),
+            ],
+            options={
+                'ordering': ['-start'],
+                'indexes': [models.Index(fields=['session_key', 'end'], name='analytics_v_session_c06034_idx'), models.Index(fields=['start', 'page_count'], name='analytics_v_start_329119_idx'), models.Index(fields=['start', 'entry_path'], name='analytics_v_start_a9f829_idx'), models.Index(fields=['start', 'exit_path'], name='analytics_v_start_520ae0_idx')],
+            },
+        ),
+    ]
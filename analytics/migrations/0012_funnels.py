@@ -0,0 +1,45 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0011_visit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Funnel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.SlugField(max_length=100, unique=True)),
+                ('steps', models.JSONField(default=list)),
+                ('is_active', models.BooleanField(default=True)),
+                ('evaluated_through', models.DateField(blank=True, help_text='Empty = backfill results on the next run', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='FunnelResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('dimension', models.CharField(max_length=20)),
+                ('value', models.CharField(blank=True, max_length=100)),
+                ('step', models.PositiveSmallIntegerField()),
+                ('visitors', models.PositiveIntegerField(default=0)),
+                ('funnel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='analytics.funnel')),
+            ],
+            options={
+                'ordering': ['-day', 'step'],
+                'constraints': [models.UniqueConstraint(fields=('funnel', 'day', 'dimension', 'value', 'step'), name='analytics_funnel_result_unique_key')],
+            },
+        ),
+    ]
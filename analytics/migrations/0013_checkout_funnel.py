@@ -0,0 +1,28 @@
+from django.db import migrations
+
+CHECKOUT_STEPS = [
+    {'kind': 'path', 'value': '/', 'label': 'Home'},
+    {'kind': 'path', 'value': '/pricing/', 'label': 'Pricing'},
+    {'kind': 'payment_prepared', 'label': 'Checkout started'},
+    {'kind': 'payment_success', 'label': 'Payment successful'},
+]
+
+
+def create_checkout_funnel(apps, schema_editor):
+    Funnel = apps.get_model('analytics', 'Funnel')
+    Funnel.objects.get_or_create(slug='checkout', defaults={'name': 'Checkout', 'steps': CHECKOUT_STEPS})
+
+
+def delete_checkout_funnel(apps, schema_editor):
+    apps.get_model('analytics', 'Funnel').objects.filter(slug='checkout').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0012_funnels'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_checkout_funnel, delete_checkout_funnel),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 19:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0013_checkout_funnel'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='pageview',
+            name='analytics_p_timesta_ce023d_idx',
+        ),
+        migrations.AddIndex(
+            model_name='pageview',
+            index=models.Index(fields=['timestamp', 'path'], name='analytics_p_timesta_cd14c8_idx'),
+        ),
+    ]
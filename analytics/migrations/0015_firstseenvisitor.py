@@ -0,0 +1,49 @@
+# Generated by Django 5.2.5 on 2026-10-18 19:06
+
+from django.db import migrations, models
+from django.db.models import Min
+
+BATCH_SIZE = 2000
+
+
+def backfill(apps, schema_editor):
+    """Record every visitor the page view rollups have already counted"""
+    AggregationWatermark = apps.get_model('analytics', 'AggregationWatermark')
+    FirstSeenVisitor = apps.get_model('analytics', 'FirstSeenVisitor')
+    PageView = apps.get_model('analytics', 'PageView')
+
+    watermark = AggregationWatermark.objects.filter(name='rollup:pageview').first()
+    if watermark is None:
+        return
+    rows = (
+        PageView.objects.filter(id__lte=watermark.last_id)
+        .order_by()
+        .values('session_key')
+        .annotate(first_seen=Min('timestamp'))
+    )
+    batch = []
+    for row in rows.iterator(chunk_size=BATCH_SIZE):
+        batch.append(FirstSeenVisitor(session_key=row['session_key'], first_seen=row['first_seen']))
+        if len(batch) >= BATCH_SIZE:
+            FirstSeenVisitor.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    FirstSeenVisitor.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0014_pageview_timestamp_path_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirstSeenVisitor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_key', models.CharField(max_length=40, unique=True)),
+                ('first_seen', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
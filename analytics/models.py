@@ -1,3 +1,4 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.utils import timezone
@@ -12,6 +13,7 @@ class BotVisit(models.Model):
     user_agent = models.TextField(blank=True)
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     bot_type = models.CharField(max_length=100, blank=True)  # e.g., "googlebot", "curl"
+    hits = models.PositiveIntegerField(default=1, help_text="Requests this row stands for (aggregated during crawl spikes)")
     
     class Meta:
         ordering = ['-timestamp']
@@ -24,12 +26,47 @@ class BotVisit(models.Model):
         return f"{self.bot_type} - {self.path} ({self.timestamp.strftime('%Y-%m-%d %H:%M')})"
 
 
+class UserAgent(models.Model):
+    """Distinct user-agent string and its classification (PageView dimension)"""
+    digest = models.CharField(max_length=32, unique=True)  # blake2b-128 hex of user_agent
+    user_agent = models.TextField()
+    browser = models.CharField(max_length=50, blank=True)
+    device = models.CharField(max_length=50, blank=True)
+    os = models.CharField(max_length=50, blank=True)
+    
+    def __str__(self):
+        return f"{self.browser} / {self.os} / {self.device}"
+
+
+class Path(models.Model):
+    """Distinct request path (PageView dimension)"""
+    path = models.CharField(max_length=500, unique=True)
+    
+    def __str__(self):
+        return self.path
+
+
+class ReferrerDomain(models.Model):
+    """Distinct referrer host (PageView dimension)"""
+    domain = models.CharField(max_length=200, unique=True)
+    
+    def __str__(self):
+        return self.domain
+
+
 class PageView(models.Model):
     """Track every page view on the site"""
     url = models.CharField(max_length=500)
     path = models.CharField(max_length=500)
     page_title = models.CharField(max_length=200, blank=True)
     
+    # Interned dimensions (see analytics.dimensions); integer keys for grouping
+    page = models.ForeignKey(Path, on_delete=models.PROTECT, null=True, blank=True, related_name='views')
+    agent = models.ForeignKey(UserAgent, on_delete=models.PROTECT, null=True, blank=True, related_name='views')
+    referrer_host = models.ForeignKey(
+        ReferrerDomain, on_delete=models.PROTECT, null=True, blank=True, related_name='views'
+    )
+    
     # Visitor info
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     session_key = models.CharField(max_length=40, db_index=True)
@@ -41,8 +78,9 @@ class PageView(models.Model):
     city = models.CharField(max_length=100, blank=True)
     region = models.CharField(max_length=100, blank=True)
     
-    # Browser/Device info
-    user_agent = models.TextField()
+    # Browser/Device info (the full string moves to ``agent`` once
+    # analytics.dimensions has interned the row)
+    user_agent = models.TextField(blank=True)
     browser = models.CharField(max_length=50, blank=True)
     device = models.CharField(max_length=50, blank=True)
     os = models.CharField(max_length=50, blank=True)
@@ -52,7 +90,7 @@ class PageView(models.Model):
     referrer_domain = models.CharField(max_length=200, blank=True)
     
     # Timing
-    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
     time_on_page = models.IntegerField(null=True, blank=True, help_text="Seconds spent on page")
     
     class Meta:
@@ -66,6 +104,10 @@ class PageView(models.Model):
     
     def __str__(self):
         return f"{self.path} - {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
+    
+    @property
+    def full_user_agent(self):
+        return self.agent.user_agent if self.agent_id else self.user_agent
 
 
 class Event(models.Model):
@@ -104,3 +146,180 @@ class Event(models.Model):
     
     def __str__(self):
         return f"{self.event_type}: {self.event_name} - {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
+
+
+class TrafficRollup(models.Model):
+    """Pre-aggregated counts per hour/day bucket, maintained by analytics.rollups"""
+    HOUR = 'hour'
+    DAY = 'day'
+    GRANULARITIES = [
+        (HOUR, 'Hour'),
+        (DAY, 'Day'),
+    ]
+    
+    granularity = models.CharField(max_length=4, choices=GRANULARITIES)
+    bucket = models.DateTimeField(help_text="Start of the hour/day bucket")
+    
+    # "site" holds page view totals; other dimensions break views down by value
+    dimension = models.CharField(max_length=20)
+    value = models.CharField(max_length=500, blank=True)
+    label = models.CharField(max_length=200, blank=True)  # e.g. page title, country code
+    
+    count = models.PositiveIntegerField(default=0)
+    sessions = models.PositiveIntegerField(default=0, help_text="Distinct sessions in the bucket (site only)")
+    new_sessions = models.PositiveIntegerField(default=0, help_text="Sessions first seen in the bucket (site only)")
+    
+    class Meta:
+        ordering = ['-bucket']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'dimension', 'bucket', 'value'],
+                name='analytics_rollup_unique_key',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.granularity} {self.bucket:%Y-%m-%d %H:%M} {self.dimension}={self.value}: {self.count}"
+
+
+class AggregationWatermark(models.Model):
+    """Highest raw row id already folded in by an incremental job"""
+    name = models.CharField(max_length=100, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name} @ {self.last_id}"
+
+
+class FirstSeenVisitor(models.Model):
+    """When each visitor was first folded into the rollups; kept after their raw page views are pruned"""
+    session_key = models.CharField(max_length=40, unique=True)
+    first_seen = models.DateTimeField()
+    
+    def __str__(self):
+        return f"{self.session_key} @ {self.first_seen.strftime('%Y-%m-%d %H:%M')}"
+
+
+class Visit(models.Model):
+    """One visitor's page views with no gap longer than the visit timeout, built by analytics.visits"""
+    session_key = models.CharField(max_length=40)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    duration = models.PositiveIntegerField(default=0, help_text="Seconds between first and last page view")
+    page_count = models.PositiveIntegerField(default=1)
+    entry_path = models.CharField(max_length=500)
+    exit_path = models.CharField(max_length=500)
+    referrer_domain = models.CharField(max_length=200, blank=True)  # of the entry page view
+    country = models.CharField(max_length=100, blank=True)
+    
+    class Meta:
+        ordering = ['-start']
+        indexes = [
+            models.Index(fields=['session_key', 'end']),
+            models.Index(fields=['start', 'page_count']),
+            models.Index(fields=['start', 'entry_path']),
+            models.Index(fields=['start', 'exit_path']),
+        ]
+    
+    @property
+    def is_bounce(self):
+        return self.page_count == 1
+    
+    def __str__(self):
+        return f"{self.session_key} {self.start:%Y-%m-%d %H:%M} ({self.page_count} pages)"
+
+
+class VisitorSketch(models.Model):
+    """HyperLogLog sketch of distinct visitors for one day, site-wide or for one path"""
+    day = models.DateField()
+    path = models.CharField(max_length=500, blank=True)  # '' = whole site
+    registers = models.BinaryField()
+    
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'path'], name='analytics_visitor_sketch_day_path'),
+        ]
+    
+    def __str__(self):
+        return f"{self.day} {self.path or '(site)'}"
+
+
+class HeavyHitterSketch(models.Model):
+    """Space-Saving summary of the most frequent values of one dimension for one day"""
+    day = models.DateField()
+    dimension = models.CharField(max_length=20)  # e.g. "path", "bot_ip"
+    counters = models.JSONField(default=dict)
+    
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'dimension'], name='analytics_heavy_hitter_day_dimension'),
+        ]
+    
+    def __str__(self):
+        return f"{self.day} {self.dimension}"
+
+
+class Funnel(models.Model):
+    """
+    Ordered conversion steps, evaluated per day by analytics.funnels.
+    
+    ``steps`` is a list of {"kind", "value", "label"} where kind is one of
+    STEP_KINDS, e.g. {"kind": "path", "value": "/pricing/"} or
+    {"kind": "event", "value": "payment:Payment Initiated"}.
+    """
+    PATH = 'path'
+    PATH_PREFIX = 'path_prefix'
+    EVENT = 'event'  # value: "event_type" or "event_type:event_name"
+    PAYMENT_PREPARED = 'payment_prepared'  # PaymentTransaction created (payments-prepare)
+    PAYMENT_SUCCESS = 'payment_success'  # PaymentTransaction marked successful
+    STEP_KINDS = [PATH, PATH_PREFIX, EVENT, PAYMENT_PREPARED, PAYMENT_SUCCESS]
+    
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(max_length=100, unique=True)
+    steps = models.JSONField(default=list)
+    is_active = models.BooleanField(default=True)
+    evaluated_through = models.DateField(null=True, blank=True, help_text="Empty = backfill results on the next run")
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['name']
+    
+    def clean(self):
+        if not isinstance(self.steps, list) or len(self.steps) < 2:
+            raise ValidationError({'steps': 'A funnel needs at least two steps.'})
+        for i, step in enumerate(self.steps, 1):
+            if not isinstance(step, dict) or step.get('kind') not in self.STEP_KINDS:
+                raise ValidationError({'steps': f'Step {i}: kind must be one of {", ".join(self.STEP_KINDS)}.'})
+            if step['kind'] in (self.PATH, self.PATH_PREFIX, self.EVENT) and not step.get('value'):
+                raise ValidationError({'steps': f'Step {i}: a {step["kind"]} step needs a value.'})
+    
+    def step_labels(self):
+        return [step.get('label') or step.get('value') or step['kind'] for step in self.steps]
+    
+    def __str__(self):
+        return self.name
+
+
+class FunnelResult(models.Model):
+    """Visitors reaching each funnel step on one day, site-wide or per country/device"""
+    funnel = models.ForeignKey(Funnel, on_delete=models.CASCADE, related_name='results')
+    day = models.DateField()
+    dimension = models.CharField(max_length=20)  # "site", "country" or "device"
+    value = models.CharField(max_length=100, blank=True)
+    step = models.PositiveSmallIntegerField()  # 0-based index into Funnel.steps
+    visitors = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        ordering = ['-day', 'step']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['funnel', 'day', 'dimension', 'value', 'step'],
+                name='analytics_funnel_result_unique_key',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.funnel} {self.day} {self.dimension}={self.value} step {self.step}: {self.visitors}"
@@ -0,0 +1,291 @@
+"""
+JSON analytics queries answered from the pre-aggregated tables.
+
+A query names a metric, an optional breakdown dimension, filters, an
+inclusive local date range, a bucket size (hour, day or week) and optionally
+a second range to compare against. Everything is read from TrafficRollup and
+the per-day visitor sketches, so the cost depends on the number of buckets
+in the range and never on the size of the raw tables:
+
+- ``pageviews``: page views, by or filtered on path, country, city, browser,
+  device, os or referrer
+- ``new_visitors``: sessions first seen in each bucket
+- ``visitors``: estimated distinct visitors (HyperLogLog), site-wide or for
+  one path; day and week buckets only
+- ``bot_hits`` / ``events``: by or filtered on bot_type / event_type
+
+Rollups are one-dimensional, so filters must be on the breakdown dimension
+(or on the metric's only dimension). Results are cached under a hash of the
+normalized query plus the rollup version, which changes whenever new counts
+are committed.
+"""
+import datetime
+import hashlib
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from . import rollups, sketches
+from .hll import HyperLogLog
+from .models import TrafficRollup, VisitorSketch
+
+HOUR = 'hour'
+DAY = 'day'
+WEEK = 'week'
+BUCKETS = (HOUR, DAY, WEEK)
+
+# metric -> (rollup dimension without a breakdown, rollup field, dimensions it can be broken down by)
+ROLLUP_METRICS = {
+    'pageviews': (rollups.SITE, 'count', tuple(rollups.PAGEVIEW_DIMENSIONS)),
+    'new_visitors': (rollups.SITE, 'new_sessions', ()),
+    'bot_hits': ('bot_type', 'count', ('bot_type',)),
+    'events': ('event_type', 'count', ('event_type',)),
+}
+VISITORS = 'visitors'
+METRICS = tuple(ROLLUP_METRICS) + (VISITORS,)
+
+DEFAULT_DAYS = 30
+MAX_HOURLY_DAYS = 31
+MAX_DAYS = 3660
+MAX_LIMIT = 50
+CACHE_PREFIX = 'analytics:query'
+
+
+class QueryError(ValueError):
+    """A query that can't be answered from the rollups"""
+
+
+def get_cache_timeout():
+    return int(getattr(settings, 'ANALYTICS_QUERY_CACHE_TIMEOUT', 300) or 0)
+
+
+# Parsing --------------------------------------------------------------------
+
+def _parse_day(value, name):
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise QueryError(f'{name} must be a YYYY-MM-DD date')
+    return day
+
+
+def _parse_range(start, end, name='start'):
+    today = timezone.localdate()
+    end = _parse_day(end, 'end') if end else today
+    start = _parse_day(start, name) if start else end - datetime.timedelta(days=DEFAULT_DAYS - 1)
+    if start > end:
+        raise QueryError(f'{name} must not be after the end of its range')
+    if (end - start).days >= MAX_DAYS:
+        raise QueryError(f'Ranges are limited to {MAX_DAYS} days')
+    return start, end
+
+
+def parse_query(params):
+    """
+    Normalize request parameters (a QueryDict or dict of lists/strings) into
+    a query dict; raises QueryError when the rollups can't answer it.
+    """
+    def get(name, default=None):
+        value = params.get(name, default)
+        return value.strip() if isinstance(value, str) else value
+
+    def get_list(name):
+        if hasattr(params, 'getlist'):
+            return params.getlist(name)
+        value = params.get(name) or []
+        return [value] if isinstance(value, str) else list(value)
+
+    metric = get('metric', 'pageviews')
+    if metric not in METRICS:
+        raise QueryError(f'Unknown metric {metric!r}; choose from {", ".join(METRICS)}')
+    bucket = get('bucket', DAY)
+    if bucket not in BUCKETS:
+        raise QueryError(f'Unknown bucket {bucket!r}; choose from {", ".join(BUCKETS)}')
+    start, end = _parse_range(get('start'), get('end'))
+
+    filters = defaultdict(set)
+    for item in get_list('filter'):
+        dimension, sep, value = item.partition(':')
+        if not sep:
+            raise QueryError('Filters look like dimension:value')
+        filters[dimension.strip()].add(value)
+    dimension = get('dimension') or None
+
+    if metric == VISITORS:
+        if dimension or set(filters) - {'path'} or len(filters.get('path', ())) > 1:
+            raise QueryError('visitors can only be filtered by a single path')
+        if bucket == HOUR:
+            raise QueryError('visitors are counted per day; use the day or week bucket')
+    else:
+        allowed = ROLLUP_METRICS[metric][2]
+        for name in ([dimension] if dimension else []) + list(filters):
+            if name not in allowed:
+                raise QueryError(f'{metric} can be broken down or filtered by: {", ".join(allowed) or "nothing"}')
+        if len(set(filters) | ({dimension} if dimension else set())) > 1:
+            raise QueryError('Rollups are per dimension; filter on the breakdown dimension only')
+    if bucket == HOUR and (end - start).days >= MAX_HOURLY_DAYS:
+        raise QueryError(f'Hourly buckets are limited to {MAX_HOURLY_DAYS} days')
+
+    compare = get('compare')
+    comparison = None
+    if compare == 'previous':
+        length = end - start + datetime.timedelta(days=1)
+        comparison = (start - length, end - length)
+    elif get('compare_start') or get('compare_end'):
+        if not (get('compare_start') and get('compare_end')):
+            raise QueryError('compare_start and compare_end go together')
+        comparison = _parse_range(get('compare_start'), get('compare_end'), 'compare_start')
+    elif compare:
+        raise QueryError('compare must be "previous" (or use compare_start/compare_end)')
+
+    try:
+        limit = max(1, min(MAX_LIMIT, int(get('limit', 10))))
+    except (TypeError, ValueError):
+        raise QueryError('limit must be a number')
+
+    return {
+        'metric': metric,
+        'dimension': dimension,
+        'filters': {name: sorted(values) for name, values in sorted(filters.items())},
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'bucket': bucket,
+        'compare': [day.isoformat() for day in comparison] if comparison else None,
+        'limit': limit,
+    }
+
+
+# Evaluation -----------------------------------------------------------------
+
+def _midnight(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def bucket_keys(start, end, bucket):
+    """Every bucket label in ``start``..``end`` (inclusive dates), in order"""
+    if bucket == HOUR:
+        since, until = _midnight(start), _midnight(end + datetime.timedelta(days=1))
+        keys, ts = [], since
+        while ts < until:
+            keys.append(timezone.localtime(ts).isoformat())
+            ts += datetime.timedelta(hours=1)
+        return keys
+    day = start - datetime.timedelta(days=start.weekday()) if bucket == WEEK else start
+    step = datetime.timedelta(days=7 if bucket == WEEK else 1)
+    keys = []
+    while day <= end:
+        keys.append(day.isoformat())
+        day += step
+    return keys
+
+
+def bucket_key(value, bucket):
+    """Label of the bucket containing an hour/day rollup bucket or a date"""
+    if bucket == HOUR:
+        return timezone.localtime(value).isoformat()
+    day = timezone.localtime(value).date() if isinstance(value, datetime.datetime) else value
+    if bucket == WEEK:
+        day -= datetime.timedelta(days=day.weekday())
+    return day.isoformat()
+
+
+def _series(counts, keys):
+    return [{'bucket': key, 'value': counts.get(key, 0)} for key in keys]
+
+
+def _rollup_result(query, start, end):
+    default_dimension, field, _ = ROLLUP_METRICS[query['metric']]
+    breakdown = query['dimension']
+    filtered = next(iter(query['filters']), None)
+    dimension = breakdown or filtered or default_dimension
+    granularity = TrafficRollup.HOUR if query['bucket'] == HOUR else TrafficRollup.DAY
+
+    qs = TrafficRollup.objects.filter(
+        granularity=granularity, dimension=dimension,
+        bucket__gte=_midnight(start), bucket__lt=_midnight(end + datetime.timedelta(days=1)),
+    )
+    if filtered:
+        qs = qs.filter(value__in=query['filters'][filtered])
+    keys = bucket_keys(start, end, query['bucket'])
+
+    if not breakdown:
+        counts = defaultdict(int)
+        for bucket, total in qs.values('bucket').annotate(total=Sum(field)).values_list('bucket', 'total'):
+            counts[bucket_key(bucket, query['bucket'])] += total or 0
+        return {'total': sum(counts.values()), 'series': _series(counts, keys)}
+
+    top = list(
+        qs.values('value').annotate(total=Sum(field)).order_by('-total', 'value').values_list('value', flat=True)[
+            :query['limit']
+        ]
+    )
+    groups = {value: defaultdict(int) for value in top}
+    labels = {}
+    for bucket, value, label, count in qs.filter(value__in=top).values_list('bucket', 'value', 'label', field):
+        groups[value][bucket_key(bucket, query['bucket'])] += count
+        if label:
+            labels[value] = label
+    return {
+        'total': qs.aggregate(total=Sum(field))['total'] or 0,
+        'groups': [
+            {
+                'value': value,
+                'label': labels.get(value, ''),
+                'total': sum(groups[value].values()),
+                'series': _series(groups[value], keys),
+            }
+            for value in top
+        ],
+    }
+
+
+def _visitors_result(query, start, end):
+    path = query['filters'].get('path', [sketches.SITE_PATH])[0]
+    by_bucket = defaultdict(list)
+    for day, registers in VisitorSketch.objects.filter(day__gte=start, day__lte=end, path=path).values_list(
+        'day', 'registers'
+    ):
+        by_bucket[bucket_key(day, query['bucket'])].append(HyperLogLog.from_bytes(registers))
+    counts = {key: HyperLogLog.union(day_sketches).count() for key, day_sketches in by_bucket.items()}
+    total = HyperLogLog.union(sketch for day_sketches in by_bucket.values() for sketch in day_sketches)
+    return {'total': total.count(), 'series': _series(counts, bucket_keys(start, end, query['bucket']))}
+
+
+def _evaluate(query, start, end):
+    if query['metric'] == VISITORS:
+        return _visitors_result(query, start, end)
+    return _rollup_result(query, start, end)
+
+
+def run(query):
+    """Answer a parsed query, from the cache when the rollups haven't changed since"""
+    digest = hashlib.sha1(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()
+    cache_key = f'{CACHE_PREFIX}:{rollups.get_version()}:{digest}'
+    result = cache.get(cache_key)
+    if result is not None:
+        return result
+
+    start, end = parse_date(query['start']), parse_date(query['end'])
+    result = {'query': query, **_evaluate(query, start, end)}
+    if query['compare']:
+        compare_start, compare_end = (parse_date(day) for day in query['compare'])
+        comparison = _evaluate(query, compare_start, compare_end)
+        previous = comparison['total']
+        result['comparison'] = {
+            'start': query['compare'][0],
+            'end': query['compare'][1],
+            **comparison,
+            'change': round((result['total'] - previous) / previous * 100, 1) if previous else None,
+        }
+
+    timeout = get_cache_timeout()
+    if timeout:
+        cache.set(cache_key, result, timeout)
+    return result
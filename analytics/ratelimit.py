@@ -0,0 +1,208 @@
+"""
+Per-client crawl rate tracking for bot traffic.
+
+Every bot request is counted against its client key (IP address + user-agent
+digest) in a sliding one-minute window. The estimate weights the previous
+fixed minute by how much of it still overlaps the window, so each key costs
+two counters instead of a list of timestamps.
+
+- Below ANALYTICS_BOT_LOG_THRESHOLD hits/minute every bot hit is its own
+  BotVisit row, as before.
+- Above it, hits are aggregated: one BotVisit per client per minute whose
+  ``hits`` field holds how many requests it stands for. A scraper sending
+  thousands of requests a minute costs one INSERT per minute.
+- Above ANALYTICS_BOT_BLOCK_RATE (0 = off) crawlers that aren't on
+  ANALYTICS_BOT_ALLOWLIST get a 429 before the view runs.
+
+Counters live in process memory by default. Set ANALYTICS_RATE_BACKEND to
+'cache' to keep them in the Django cache (Redis when REDIS_URL is set) so all
+workers share them.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import ingest, matching
+from .useragent import UserAgentCache
+
+logger = logging.getLogger(__name__)
+
+WINDOW = 60
+MEMORY = 'memory'
+CACHE = 'cache'
+CACHE_PREFIX = 'analytics:rate'
+
+
+def get_log_threshold():
+    return max(0, int(getattr(settings, 'ANALYTICS_BOT_LOG_THRESHOLD', 60) or 0))
+
+
+def get_block_rate():
+    return max(0, int(getattr(settings, 'ANALYTICS_BOT_BLOCK_RATE', 0) or 0))
+
+
+def get_backend_name():
+    backend = (getattr(settings, 'ANALYTICS_RATE_BACKEND', MEMORY) or MEMORY).lower()
+    return backend if backend in (MEMORY, CACHE) else MEMORY
+
+
+def client_key(ip_address, user_agent):
+    return f'{ip_address}|{UserAgentCache.key(user_agent or "").hex()}'
+
+
+def _estimate(current, previous, now):
+    elapsed = (now % WINDOW) / WINDOW
+    return int(current + previous * (1 - elapsed))
+
+
+class MemoryRateCounter:
+    """Sliding-window counters in process memory, least recently seen keys dropped first"""
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._counters = OrderedDict()  # key -> [window index, current, previous]
+        self._lock = threading.Lock()
+
+    def hit(self, key, now=None):
+        """Count one request for ``key``; returns its estimated hits in the last minute"""
+        now = now or time.time()
+        window = int(now // WINDOW)
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = [window, 0, 0]
+            else:
+                self._counters.move_to_end(key)
+            if counter[0] != window:
+                counter[2] = counter[1] if counter[0] == window - 1 else 0
+                counter[0], counter[1] = window, 0
+            counter[1] += 1
+            current, previous = counter[1], counter[2]
+            while len(self._counters) > self.max_keys:
+                self._counters.popitem(last=False)
+        return _estimate(current, previous, now)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+
+
+class CacheRateCounter:
+    """Sliding-window counters in the Django cache, shared between workers"""
+
+    def hit(self, key, now=None):
+        now = now or time.time()
+        window = int(now // WINDOW)
+        current_key = f'{CACHE_PREFIX}:{key}:{window}'
+        if cache.add(current_key, 1, WINDOW * 2):
+            current = 1
+        else:
+            try:
+                current = cache.incr(current_key)
+            except ValueError:  # expired between add and incr
+                cache.set(current_key, 1, WINDOW * 2)
+                current = 1
+        previous = cache.get(f'{CACHE_PREFIX}:{key}:{window - 1}', 0)
+        return _estimate(current, previous, now)
+
+    def clear(self):
+        pass
+
+
+class BotLogAggregator:
+    """Per-client BotVisit rows that stand for several hits, emitted once per minute"""
+
+    def __init__(self):
+        self._pending = {}  # key -> (window index, BotVisit)
+        self._lock = threading.Lock()
+        self._swept = 0
+
+    def add(self, key, visit, now=None):
+        """Fold ``visit`` into the client's row for this minute; returns rows that are complete"""
+        now = now or time.time()
+        window = int(now // WINDOW)
+        ready = []
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None and pending[0] == window:
+                pending[1].hits += visit.hits
+            else:
+                if pending is not None:
+                    ready.append(pending[1])
+                self._pending[key] = (window, visit)
+            if self._swept != window:
+                # Close out clients that went quiet in an earlier minute
+                self._swept = window
+                for stale_key, (stale_window, stale_visit) in list(self._pending.items()):
+                    if stale_window != window:
+                        ready.append(stale_visit)
+                        del self._pending[stale_key]
+        return ready
+
+    def drain(self):
+        """Every pending row, complete or not (e.g. at shutdown)"""
+        with self._lock:
+            rows = [visit for _, visit in self._pending.values()]
+            self._pending.clear()
+        return rows
+
+
+memory_counter = MemoryRateCounter()
+cache_counter = CacheRateCounter()
+aggregator = BotLogAggregator()
+
+
+def get_counter():
+    return cache_counter if get_backend_name() == CACHE else memory_counter
+
+
+def observe(request, ip_address, user_agent):
+    """Count this bot request once (memoized on the request); returns hits/minute for its client"""
+    rate = getattr(request, 'analytics_bot_rate', None)
+    if rate is None:
+        rate = get_counter().hit(client_key(ip_address, user_agent))
+        request.analytics_bot_rate = rate
+    return rate
+
+
+def should_block(user_agent, rate):
+    """True when a non-allowlisted crawler is over ANALYTICS_BOT_BLOCK_RATE"""
+    limit = get_block_rate()
+    if not limit or rate <= limit:
+        return False
+    return not matching.get_allowlist_matcher().search(user_agent or '')
+
+
+def visits_to_record(key, rate, visit):
+    """BotVisit rows to write for one bot hit at ``rate`` hits/minute"""
+    threshold = get_log_threshold()
+    if not threshold or rate <= threshold:
+        return [visit]
+    return aggregator.add(key, visit)
+
+
+def flush_pending():
+    """Record aggregated rows that are still open (called at exit)"""
+    for visit in aggregator.drain():
+        try:
+            ingest.record(visit)
+        except Exception:
+            logger.exception('Failed to record aggregated bot visit')
+
+
+# Registered after ingest's own shutdown hook, so it runs first
+atexit.register(flush_pending)
+
+
+@receiver(setting_changed)
+def _reset_counters(setting, **kwargs):
+    if setting in ('ANALYTICS_RATE_BACKEND', 'ANALYTICS_BOT_LOG_THRESHOLD', 'ANALYTICS_BOT_BLOCK_RATE'):
+        memory_counter.clear()
+        aggregator.drain()
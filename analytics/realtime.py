@@ -0,0 +1,99 @@
+"""
+Live "active visitors" counter kept entirely in the cache.
+
+Nothing is read-modify-written, so concurrent page views can't overwrite each
+other:
+
+- ``analytics:active:path:<visitor>`` holds the page the visitor was on most
+  recently, one small key per visitor
+- each minute has a roster: the first view of a visitor in that minute
+  (``cache.add`` on ``...:<minute>:seen:<visitor>``) takes the next slot
+  number from an atomic ``cache.incr`` counter and writes its ID to
+  ``...:<minute>:slot:<n>``
+
+All keys expire on their own once they leave the window. "Active now" is
+everyone on the rosters of the last ANALYTICS_ACTIVE_WINDOW minutes, read
+with three ``get_many`` calls (counters, slots, paths); each visitor counts
+once overall and once for their latest page. Nothing here reads the database.
+
+With the default per-process LocMemCache each worker sees only its own
+visitors; set REDIS_URL to share the counter between workers.
+"""
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+KEY_PREFIX = 'analytics:active'
+
+
+def get_window_minutes():
+    return max(1, int(getattr(settings, 'ANALYTICS_ACTIVE_WINDOW', 5) or 1))
+
+
+def get_timeout():
+    return (get_window_minutes() + 1) * 60
+
+
+def current_minute(now=None):
+    return int((now or time.time()) // 60)
+
+
+def path_key(visitor_id):
+    return f'{KEY_PREFIX}:path:{visitor_id}'
+
+
+def seen_key(minute, visitor_id):
+    return f'{KEY_PREFIX}:{minute}:seen:{visitor_id}'
+
+
+def counter_key(minute):
+    return f'{KEY_PREFIX}:{minute}:n'
+
+
+def slot_key(minute, slot):
+    return f'{KEY_PREFIX}:{minute}:slot:{slot}'
+
+
+def mark_active(visitor_id, path, now=None):
+    """Record that ``visitor_id`` is on ``path`` this minute"""
+    timeout = get_timeout()
+    minute = current_minute(now)
+    cache.set(path_key(visitor_id), path, timeout)
+    if not cache.add(seen_key(minute, visitor_id), 1, timeout):
+        return  # already on this minute's roster
+    counter = counter_key(minute)
+    cache.add(counter, 0, timeout)
+    try:
+        slot = cache.incr(counter)
+    except ValueError:
+        # The counter was evicted between add() and incr()
+        cache.add(counter, 1, timeout)
+        slot = 1
+    cache.set(slot_key(minute, slot), visitor_id, timeout)
+
+
+def active_visitors(now=None, limit=10):
+    """
+    Visitors seen within the window:
+    {'visitors': n, 'window_minutes': w, 'paths': [{'path': p, 'visitors': n}, ...]}
+    """
+    window = get_window_minutes()
+    minute = current_minute(now)
+    minutes = range(minute - window + 1, minute + 1)
+    counters = cache.get_many([counter_key(m) for m in minutes])
+    slots = [
+        slot_key(m, slot)
+        for m in minutes
+        for slot in range(1, (counters.get(counter_key(m)) or 0) + 1)
+    ]
+    visitor_ids = set(cache.get_many(slots).values())
+    latest_path = cache.get_many([path_key(visitor_id) for visitor_id in visitor_ids])
+
+    paths = Counter(latest_path.values())
+    return {
+        'visitors': len(visitor_ids),
+        'window_minutes': window,
+        'paths': [{'path': path, 'visitors': count} for path, count in paths.most_common(limit)],
+    }
@@ -0,0 +1,180 @@
+"""
+Retention for the raw analytics tables.
+
+Rows older than ANALYTICS_RETENTION_DAYS are appended to monthly archive files
+(``<source>-YYYY-MM.ndjson.gz`` under ANALYTICS_ARCHIVE_DIR) and then deleted
+in bounded batches. Each batch is written as its own gzip member, so files are
+append-only and a partially written month stays readable.
+
+Only rows every incremental job has already folded in are archived (see
+``REQUIRED_WATERMARKS``; page views also wait for geo enrichment when it is
+deferred). Rollups, visitor sketches, visits and anything else derived
+from the raw rows therefore stay intact after the rows are gone; whether a
+visitor is new is decided from FirstSeenVisitor, never from older raw rows.
+
+If the process dies between writing a batch and deleting it, that batch is
+archived again on the next run; pass ``dedupe=True`` to :func:`read_archive`
+to drop the repeats.
+"""
+import datetime
+import gzip
+import json
+import os
+import re
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import dimensions, enrich
+from .models import AggregationWatermark, BotVisit, PageView, UserAgent
+
+SOURCES = {
+    'pageview': PageView,
+    'botvisit': BotVisit,
+}
+
+# Raw rows are archived only once these jobs have processed them
+REQUIRED_WATERMARKS = {
+    'pageview': ['rollup:pageview', 'visits:pageview', dimensions.WATERMARK],
+    'botvisit': ['rollup:botvisit'],
+}
+
+ARCHIVE_NAME_RE = re.compile(r'^(?P<source>[a-z]+)-(?P<month>\d{4}-\d{2})\.ndjson\.gz$')
+
+
+def get_retention_days():
+    return int(getattr(settings, 'ANALYTICS_RETENTION_DAYS', 90))
+
+
+def get_archive_dir():
+    return str(getattr(settings, 'ANALYTICS_ARCHIVE_DIR', ''))
+
+
+def archive_path(source, month):
+    return os.path.join(get_archive_dir(), f'{source}-{month}.ndjson.gz')
+
+
+def json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).hex()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def required_watermarks(source):
+    names = list(REQUIRED_WATERMARKS.get(source, []))
+    if source == 'pageview' and enrich.get_geo_mode() == enrich.DEFERRED:
+        names.append(enrich.WATERMARK)
+    return names
+
+
+def archivable_max_id(source):
+    """Highest id every required incremental job has already processed"""
+    names = required_watermarks(source)
+    if not names:
+        return None
+    marks = dict(AggregationWatermark.objects.filter(name__in=names).values_list('name', 'last_id'))
+    return min(marks.get(name, 0) for name in names)
+
+
+def fill_user_agents(rows):
+    """Archived rows keep the full UA string, not just a key into UserAgent"""
+    agent_ids = {row['agent_id'] for row in rows if row.get('agent_id')}
+    if not agent_ids:
+        return
+    texts = dict(UserAgent.objects.filter(id__in=agent_ids).values_list('id', 'user_agent'))
+    for row in rows:
+        if row.get('agent_id') and not row.get('user_agent'):
+            row['user_agent'] = texts.get(row['agent_id'], '')
+
+
+def archive_batch(source, cutoff, batch_size):
+    """
+    Archive and delete up to ``batch_size`` rows of ``source`` older than ``cutoff``.
+    Returns the number of rows moved.
+    """
+    model = SOURCES[source]
+    qs = model.objects.filter(timestamp__lt=cutoff)
+    max_id = archivable_max_id(source)
+    if max_id is not None:
+        qs = qs.filter(id__lte=max_id)
+    rows = list(qs.order_by('id').values()[:batch_size])
+    if not rows:
+        return 0
+    fill_user_agents(rows)
+
+    by_month = {}
+    for row in rows:
+        month = timezone.localtime(row['timestamp']).strftime('%Y-%m')
+        by_month.setdefault(month, []).append(row)
+
+    os.makedirs(get_archive_dir(), exist_ok=True)
+    for month, month_rows in sorted(by_month.items()):
+        payload = ''.join(
+            json.dumps(row, default=json_default, separators=(',', ':')) + '\n' for row in month_rows
+        ).encode('utf-8')
+        with open(archive_path(source, month), 'ab') as fh:
+            fh.write(gzip.compress(payload))
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    model.objects.filter(id__in=[row['id'] for row in rows]).delete()
+    return len(rows)
+
+
+def archive_old_rows(retention_days=None, batch_size=5000, max_batches=None, dry_run=False):
+    """
+    Move rows older than the retention window into the archive.
+    Returns {source: rows archived} (rows that would be archived with ``dry_run``).
+    """
+    days = get_retention_days() if retention_days is None else retention_days
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    moved = {}
+    for source, model in SOURCES.items():
+        if dry_run:
+            qs = model.objects.filter(timestamp__lt=cutoff)
+            max_id = archivable_max_id(source)
+            moved[source] = (qs.filter(id__lte=max_id) if max_id is not None else qs).count()
+            continue
+        moved[source] = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            count = archive_batch(source, cutoff, batch_size)
+            moved[source] += count
+            batches += 1
+            if count < batch_size:
+                break
+    return moved
+
+
+def list_archives(source=None):
+    """[(source, 'YYYY-MM', path)] for archive files on disk, oldest first"""
+    directory = get_archive_dir()
+    if not directory or not os.path.isdir(directory):
+        return []
+    found = []
+    for name in sorted(os.listdir(directory)):
+        match = ARCHIVE_NAME_RE.match(name)
+        if match and (source is None or match['source'] == source):
+            found.append((match['source'], match['month'], os.path.join(directory, name)))
+    return found
+
+
+def read_archive(source, month, dedupe=False):
+    """Stream the archived rows of one month as dicts (timestamps stay ISO strings)"""
+    path = archive_path(source, month)
+    seen = set() if dedupe else None
+    with gzip.open(path, 'rt', encoding='utf-8') as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if seen is not None:
+                if row['id'] in seen:
+                    continue
+                seen.add(row['id'])
+            yield row
@@ -0,0 +1,305 @@
+"""
+Incremental pre-aggregation of raw analytics rows into TrafficRollup.
+
+Every source table (PageView, BotVisit, Event) has an AggregationWatermark
+holding the highest primary key already folded in. update_rollups() reads
+only rows past that id, in id order and bounded batches, adds their counts to
+the matching hour and day buckets and advances the watermark in the same
+transaction, so each raw row is counted exactly once.
+
+Dimensions:
+
+- ``site``: page views and first-seen sessions per bucket (visitors already
+  counted are remembered in FirstSeenVisitor); day buckets also carry the
+  distinct sessions estimated by the day's visitor sketch. Hour buckets have
+  no distinct count, since that would mean rescanning raw rows
+- ``path``, ``country``, ``city``, ``browser``, ``device``, ``os``, ``referrer``:
+  page views per value
+- ``bot_type``: bot hits per bot signature (BotVisit.hits, so aggregated rows count fully)
+- ``event_type``: Event rows per type
+
+With deferred geo enrichment (see analytics.enrich) page views are only
+folded once the enrichment job has passed them, so country and city counts
+are complete.
+
+The same pass feeds the per-day HyperLogLog visitor sketches and Space-Saving
+heavy-hitter summaries (see analytics.sketches) used for unique visitors and
+top-N lists over arbitrary date ranges.
+
+The dashboard reads only these rows, so its cost depends on the number of
+buckets in the requested range rather than on the size of the raw tables.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from . import enrich
+from .models import (
+    AggregationWatermark, BotVisit, Event, FirstSeenVisitor, HeavyHitterSketch, PageView, TrafficRollup,
+)
+from .sketches import SITE_PATH, HeavyHitterUpdates, VisitorSketchUpdates
+
+HOUR = TrafficRollup.HOUR
+DAY = TrafficRollup.DAY
+GRANULARITIES = (HOUR, DAY)
+
+SITE = 'site'
+
+# dimension -> (PageView field holding the value, field used as display label)
+PAGEVIEW_DIMENSIONS = {
+    'path': ('path', 'page_title'),
+    'country': ('country', 'country_code'),
+    'city': ('city', 'country'),
+    'browser': ('browser', None),
+    'device': ('device', None),
+    'os': ('os', None),
+    'referrer': ('referrer_domain', None),
+}
+
+# Chunk size for session_key__in lookups (stays under SQLite's variable limit)
+IN_CHUNK = 500
+
+# Bumped whenever new counts are committed; part of cached query keys (analytics.query)
+VERSION_KEY = 'analytics:rollup:version'
+
+
+def get_batch_size():
+    return max(1, int(getattr(settings, 'ANALYTICS_ROLLUP_BATCH_SIZE', 5000) or 1))
+
+
+def bucket_start(ts, granularity):
+    """Start of the hour/day bucket containing ``ts`` (in the current time zone)"""
+    local = timezone.localtime(ts)
+    if granularity == HOUR:
+        return local.replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def bucket_end(bucket, granularity):
+    return bucket + (timedelta(hours=1) if granularity == HOUR else timedelta(days=1))
+
+
+class RollupDeltas:
+    """Counts accumulated from one batch of raw rows, keyed by rollup row"""
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.new_sessions = defaultdict(int)
+        self.labels = {}
+        self.visitors = VisitorSketchUpdates()
+        self.heavy_hitters = HeavyHitterUpdates()
+
+    def add(self, ts, dimension, value, label='', amount=1):
+        for granularity in GRANULARITIES:
+            key = (granularity, bucket_start(ts, granularity), dimension, (value or '')[:500])
+            self.counts[key] += amount
+            if label:
+                self.labels[key] = label[:200]
+
+    def add_new_session(self, ts):
+        for granularity in GRANULARITIES:
+            self.new_sessions[(granularity, bucket_start(ts, granularity), SITE, '')] += 1
+
+    def add_visitor(self, ts, path, visitor_key):
+        self.visitors.add(bucket_start(ts, DAY).date(), path, visitor_key)
+
+    def add_heavy_hitter(self, ts, dimension, value, label='', amount=1):
+        self.heavy_hitters.add(bucket_start(ts, DAY).date(), dimension, value, label, amount)
+    
+    def apply(self):
+        """Merge into TrafficRollup and the per-day sketches (call inside a transaction)"""
+        visitors = self.visitors.apply()
+        self.heavy_hitters.apply()
+        keys = set(self.counts) | set(self.new_sessions)
+        if not keys:
+            return
+        transaction.on_commit(bump_version)
+
+        existing = {}
+        for granularity in GRANULARITIES:
+            buckets = {k[1] for k in keys if k[0] == granularity}
+            dimensions = {k[2] for k in keys if k[0] == granularity}
+            for row in TrafficRollup.objects.filter(
+                granularity=granularity, bucket__in=buckets, dimension__in=dimensions
+            ):
+                existing[(row.granularity, row.bucket, row.dimension, row.value)] = row
+
+        to_create, to_update = [], []
+        for key in keys:
+            row = existing.get(key)
+            if row is None:
+                granularity, bucket, dimension, value = key
+                row = TrafficRollup(granularity=granularity, bucket=bucket, dimension=dimension, value=value)
+                to_create.append(row)
+            else:
+                to_update.append(row)
+            row.count += self.counts.get(key, 0)
+            row.new_sessions += self.new_sessions.get(key, 0)
+            if key in self.labels:
+                row.label = self.labels[key]
+            if key[2] == SITE and key[0] == DAY and (key[1].date(), SITE_PATH) in visitors:
+                # Distinct sessions can't be summed; take the day's visitor sketch estimate
+                row.sessions = visitors[(key[1].date(), SITE_PATH)]
+
+        TrafficRollup.objects.bulk_create(to_create)
+        TrafficRollup.objects.bulk_update(to_update, ['count', 'new_sessions', 'sessions', 'label'])
+
+
+def fold_pageviews(rows, deltas):
+    first_seen = {}
+    for row in rows:
+        ts = row['timestamp']
+        deltas.add(ts, SITE, '')
+        for dimension, (field, label_field) in PAGEVIEW_DIMENSIONS.items():
+            deltas.add(ts, dimension, row[field], row[label_field] if label_field else '')
+        deltas.add_visitor(ts, row['path'], row['session_key'])
+        deltas.add_heavy_hitter(ts, 'path', row['path'], row['page_title'])
+        deltas.add_heavy_hitter(ts, 'referrer', row['referrer_domain'])
+        deltas.add_heavy_hitter(ts, 'city', row['city'], row['country'])
+        first_seen.setdefault(row['session_key'], ts)
+
+    # Looked up in FirstSeenVisitor rather than older raw rows, which retention may have pruned
+    keys = list(first_seen)
+    seen_before = set()
+    for i in range(0, len(keys), IN_CHUNK):
+        seen_before.update(
+            FirstSeenVisitor.objects.filter(session_key__in=keys[i:i + IN_CHUNK]).values_list('session_key', flat=True)
+        )
+    new_visitors = []
+    for session_key, ts in first_seen.items():
+        if session_key not in seen_before:
+            deltas.add_new_session(ts)
+            new_visitors.append(FirstSeenVisitor(session_key=session_key, first_seen=ts))
+    FirstSeenVisitor.objects.bulk_create(new_visitors, batch_size=IN_CHUNK)
+
+
+def fold_botvisits(rows, deltas):
+    for row in rows:
+        bot_type = row['bot_type'] or 'unknown'
+        hits = row['hits']  # > 1 for rows aggregated during a crawl spike
+        deltas.add(row['timestamp'], 'bot_type', bot_type, amount=hits)
+        deltas.add_heavy_hitter(row['timestamp'], 'bot_ip', row['ip_address'], bot_type, amount=hits)
+        deltas.add_heavy_hitter(row['timestamp'], 'bot_path', row['path'], bot_type, amount=hits)
+
+
+def fold_events(rows, deltas):
+    for row in rows:
+        deltas.add(row['timestamp'], 'event_type', row['event_type'])
+
+
+# watermark name -> (model, fields read per row, fold function)
+SOURCES = {
+    'rollup:pageview': (
+        PageView,
+        ['id', 'timestamp', 'session_key']
+        + sorted({f for pair in PAGEVIEW_DIMENSIONS.values() for f in pair if f}),
+        fold_pageviews,
+    ),
+    'rollup:botvisit': (BotVisit, ['id', 'timestamp', 'bot_type', 'hits', 'ip_address', 'path'], fold_botvisits),
+    'rollup:event': (Event, ['id', 'timestamp', 'event_type'], fold_events),
+}
+
+
+def get_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def bump_version():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+
+def upstream_max_id(name):
+    """Highest id of ``name``'s source that is ready to fold (None = no limit)"""
+    if name == 'rollup:pageview' and enrich.get_geo_mode() == enrich.DEFERRED:
+        return enrich.enriched_max_id()
+    return None
+
+
+def update_rollups(batch_size=None, max_batches=None):
+    """
+    Fold raw rows newer than each source's watermark into TrafficRollup.
+
+    ``max_batches`` bounds the work per source (None = catch up fully).
+    Returns {watermark name: rows processed}.
+    """
+    batch_size = batch_size or get_batch_size()
+    processed = {}
+    for name, (model, fields, fold) in SOURCES.items():
+        processed[name] = 0
+        batches = 0
+        max_id = upstream_max_id(name)
+        while max_batches is None or batches < max_batches:
+            with transaction.atomic():
+                watermark, _ = AggregationWatermark.objects.select_for_update().get_or_create(name=name)
+                qs = model.objects.filter(id__gt=watermark.last_id)
+                if max_id is not None:
+                    qs = qs.filter(id__lte=max_id)
+                rows = list(qs.order_by('id').values(*fields)[:batch_size])
+                if not rows:
+                    break
+                deltas = RollupDeltas()
+                fold(rows, deltas)
+                deltas.apply()
+                watermark.last_id = rows[-1]['id']
+                watermark.save(update_fields=['last_id', 'updated_at'])
+            processed[name] += len(rows)
+            batches += 1
+            if len(rows) < batch_size:
+                break
+    return processed
+
+
+def reset_rollups():
+    """Drop all rollups and watermarks so the next update rebuilds from raw rows"""
+    with transaction.atomic():
+        TrafficRollup.objects.all().delete()
+        HeavyHitterSketch.objects.all().delete()
+        FirstSeenVisitor.objects.all().delete()
+        AggregationWatermark.objects.filter(name__in=SOURCES).delete()
+        transaction.on_commit(bump_version)
+
+
+# Read helpers ---------------------------------------------------------------
+
+def rollup_rows(dimension, granularity=DAY, since=None, until=None):
+    qs = TrafficRollup.objects.filter(granularity=granularity, dimension=dimension)
+    if since is not None:
+        qs = qs.filter(bucket__gte=bucket_start(since, granularity))
+    if until is not None:
+        qs = qs.filter(bucket__lt=until)
+    return qs
+
+
+def total(dimension, field='count', granularity=DAY, since=None, until=None):
+    """Sum of ``field`` over the buckets in range (all time when ``since`` is None)"""
+    return rollup_rows(dimension, granularity, since, until).aggregate(total=Sum(field))['total'] or 0
+
+
+def series(dimension=SITE, granularity=DAY, since=None, until=None, value=''):
+    """Per-bucket rows for one dimension value, oldest first"""
+    return list(
+        rollup_rows(dimension, granularity, since, until)
+        .filter(value=value)
+        .order_by('bucket')
+        .values('bucket', 'count', 'sessions', 'new_sessions')
+    )
+
+
+def top_values(dimension, since=None, until=None, limit=10, exclude=(), exclude_contains=()):
+    """Highest-count values of a dimension over a day range: [{value, label, count}]"""
+    qs = rollup_rows(dimension, DAY, since, until)
+    for value in exclude:
+        qs = qs.exclude(value=value)
+    for fragment in exclude_contains:
+        qs = qs.exclude(value__contains=fragment)
+    return list(
+        qs.values('value').annotate(label=Max('label'), count=Sum('count')).order_by('-count', 'value')[:limit]
+    )
@@ -0,0 +1,203 @@
+"""
+Stored per-day sketches and the queries answered from them.
+
+VisitorSketch holds one HyperLogLog per day for the whole site (path '') and
+one per (day, path). The rollup job adds each new page view's visitor key to
+both, and unique visitors for any date range are estimated by merging the
+day sketches, without touching PageView (error bound: see analytics.hll).
+
+HeavyHitterSketch holds one Space-Saving summary per (day, dimension) for
+high-cardinality dimensions (pages, referrers, cities, bot IPs and paths).
+Top-N lists over a date range merge at most ANALYTICS_TOPK_CAPACITY entries
+per day, whatever the number of distinct values. The merged list is cached
+until the rollup job commits new counts (error bound: see analytics.topk).
+"""
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .hll import HyperLogLog
+from .models import HeavyHitterSketch, VisitorSketch
+from .topk import SpaceSaving
+
+SITE_PATH = ''
+
+
+class VisitorSketchUpdates:
+    """Visitor keys collected from one batch of page views, per (day, path)"""
+
+    def __init__(self):
+        self.keys = defaultdict(set)
+
+    def add(self, day, path, visitor_key):
+        self.keys[(day, SITE_PATH)].add(visitor_key)
+        self.keys[(day, (path or '')[:500])].add(visitor_key)
+
+    def apply(self):
+        """
+        Merge into VisitorSketch rows (call inside a transaction); returns
+        {(day, path): estimated distinct visitors} for the sketches touched
+        """
+        if not self.keys:
+            return {}
+        days = {day for day, _ in self.keys}
+        paths = {path for _, path in self.keys}
+        existing = {
+            (row.day, row.path): row
+            for row in VisitorSketch.objects.filter(day__in=days, path__in=paths)
+        }
+
+        to_create, to_update = [], []
+        estimates = {}
+        for key, visitor_keys in self.keys.items():
+            row = existing.get(key)
+            if row is None:
+                sketch = HyperLogLog()
+                row = VisitorSketch(day=key[0], path=key[1])
+                to_create.append(row)
+            else:
+                sketch = HyperLogLog.from_bytes(row.registers)
+                to_update.append(row)
+            sketch.update(visitor_keys)
+            row.registers = sketch.to_bytes()
+            estimates[key] = sketch.count()
+
+        VisitorSketch.objects.bulk_create(to_create)
+        VisitorSketch.objects.bulk_update(to_update, ['registers'])
+        return estimates
+
+
+def merged_sketch(start, end, path=SITE_PATH):
+    """Union of the day sketches for ``start``..``end`` (inclusive dates)"""
+    rows = VisitorSketch.objects.filter(day__gte=start, day__lte=end, path=path).values_list(
+        'registers', flat=True
+    )
+    return HyperLogLog.union(HyperLogLog.from_bytes(registers) for registers in rows)
+
+
+def unique_visitors(start, end, path=SITE_PATH):
+    """Estimated distinct visitors between two dates (inclusive)"""
+    return merged_sketch(start, end, path).count()
+
+
+def daily_visitors(start, end, path=SITE_PATH):
+    """{date: estimated distinct visitors} for each day with traffic in the range"""
+    rows = VisitorSketch.objects.filter(day__gte=start, day__lte=end, path=path).values_list(
+        'day', 'registers'
+    )
+    return {day: HyperLogLog.from_bytes(registers).count() for day, registers in rows}
+
+
+# Heavy hitters --------------------------------------------------------------
+
+# dimension -> what it counts
+HEAVY_HITTER_DIMENSIONS = {
+    'path': 'page views per path (label: page title)',
+    'referrer': 'page views per referrer domain',
+    'city': 'page views per city (label: country)',
+    'bot_ip': 'bot hits per IP address (label: bot type)',
+    'bot_path': 'bot hits per path (label: bot type)',
+}
+
+TOP_CACHE_PREFIX = 'analytics:topk'
+TOP_VERSION_KEY = f'{TOP_CACHE_PREFIX}:version'
+
+
+def get_topk_capacity():
+    return max(10, int(getattr(settings, 'ANALYTICS_TOPK_CAPACITY', 200) or 10))
+
+
+def get_topk_cache_timeout():
+    return int(getattr(settings, 'ANALYTICS_TOPK_CACHE_TIMEOUT', 300) or 0)
+
+
+class HeavyHitterUpdates:
+    """Exact value counts from one batch of rows, per (day, dimension)"""
+
+    def __init__(self):
+        self.counts = defaultdict(Counter)
+        self.labels = defaultdict(dict)
+
+    def add(self, day, dimension, value, label='', amount=1):
+        if not value:
+            return
+        value = str(value)[:500]
+        self.counts[(day, dimension)][value] += amount
+        if label:
+            self.labels[(day, dimension)][value] = label[:200]
+
+    def apply(self):
+        """Merge into HeavyHitterSketch rows (call inside a transaction)"""
+        if not self.counts:
+            return
+        capacity = get_topk_capacity()
+        days = {day for day, _ in self.counts}
+        dimensions = {dimension for _, dimension in self.counts}
+        existing = {
+            (row.day, row.dimension): row
+            for row in HeavyHitterSketch.objects.filter(day__in=days, dimension__in=dimensions)
+        }
+
+        to_create, to_update = [], []
+        for key, counts in self.counts.items():
+            row = existing.get(key)
+            if row is None:
+                sketch = SpaceSaving(capacity)
+                row = HeavyHitterSketch(day=key[0], dimension=key[1])
+                to_create.append(row)
+            else:
+                sketch = SpaceSaving.from_dict(row.counters, capacity=capacity)
+                to_update.append(row)
+            sketch.update(counts, self.labels.get(key))
+            row.counters = sketch.to_dict()
+
+        HeavyHitterSketch.objects.bulk_create(to_create)
+        HeavyHitterSketch.objects.bulk_update(to_update, ['counters'])
+        transaction.on_commit(_bump_top_version)
+
+
+def _bump_top_version():
+    """Invalidate cached top-N lists once new counts are committed"""
+    try:
+        cache.incr(TOP_VERSION_KEY)
+    except ValueError:
+        cache.set(TOP_VERSION_KEY, 1, None)
+
+
+def merged_heavy_hitters(dimension, start, end):
+    """Union of the day summaries for ``start``..``end`` (inclusive dates)"""
+    rows = HeavyHitterSketch.objects.filter(dimension=dimension, day__gte=start, day__lte=end).values_list(
+        'counters', flat=True
+    )
+    capacity = get_topk_capacity()
+    return SpaceSaving.union((SpaceSaving.from_dict(counters, capacity) for counters in rows), capacity)
+
+
+def top_items(dimension, start, end, limit=10, exclude=(), exclude_contains=()):
+    """
+    Most frequent values between two dates (inclusive):
+    [{'value', 'label', 'count', 'error'}], counts are upper bounds
+    """
+    version = cache.get(TOP_VERSION_KEY, 0)
+    cache_key = f'{TOP_CACHE_PREFIX}:{version}:{dimension}:{start.isoformat()}:{end.isoformat()}'
+    ranked = cache.get(cache_key)
+    if ranked is None:
+        sketch = merged_heavy_hitters(dimension, start, end)
+        ranked = [
+            {'value': value, 'label': sketch.labels.get(value, ''), 'count': count, 'error': error}
+            for value, count, error in sketch.top()
+        ]
+        timeout = get_topk_cache_timeout()
+        if timeout:
+            cache.set(cache_key, ranked, timeout)
+
+    result = []
+    for item in ranked:
+        if item['value'] in exclude or any(fragment in item['value'] for fragment in exclude_contains):
+            continue
+        result.append(item)
+        if limit is not None and len(result) >= limit:
+            break
+    return result
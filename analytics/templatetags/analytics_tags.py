@@ -0,0 +1,29 @@
+import html
+
+from django import template
+
+register = template.Library()
+
+
+class PageTitleNode(template.Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        output = self.nodelist.render(context)
+        request = context.get('request')
+        if request is not None:
+            # Read by AnalyticsMiddleware, so the page view needn't scan the body for <title>
+            request.analytics_title = html.unescape(' '.join(output.split()))
+        return output
+
+
+@register.tag
+def page_title(parser, token):
+    """
+    {% page_title %}...{% endpage_title %} renders its contents and hands
+    them to analytics as the page title.
+    """
+    nodelist = parser.parse(('endpage_title',))
+    parser.delete_first_token()
+    return PageTitleNode(nodelist)
@@ -0,0 +1,996 @@
+import csv
+import gzip
+import importlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+import requests
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import Sum
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from . import dimensions, enrich, export, funnels, geo, ingest, matching, query, ratelimit, realtime, retention, rollups, sketches, useragent, visitor, visits
+from .hll import HyperLogLog
+from .topk import SpaceSaving
+from .middleware import AnalyticsMiddleware
+from .models import AggregationWatermark, PageView, BotVisit, Event, FirstSeenVisitor, TrafficRollup, UserAgent, Path, Visit, Funnel, FunnelResult
+
+BROWSER_UA = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/126.0 Safari/537.36"
+)
+
+
+class IngestTests(TestCase):
+    def tearDown(self):
+        ingest.buffer.flush()
+
+    def test_sync_mode_writes_inline(self):
+        r = self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(PageView.objects.filter(path="/privacy-policy/").count(), 1)
+
+    @override_settings(ANALYTICS_INGEST_MODE="buffered", ANALYTICS_BUFFER_SIZE=10, ANALYTICS_BUFFER_FLUSH_INTERVAL=0)
+    def test_buffered_mode_defers_until_flush(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT="curl/8.0")
+        self.assertEqual(PageView.objects.count(), 0)
+        self.assertEqual(BotVisit.objects.count(), 0)
+
+        self.assertEqual(ingest.flush(), 2)
+        self.assertEqual(PageView.objects.count(), 1)
+        self.assertEqual(BotVisit.objects.filter(bot_type="curl").count(), 1)
+        # Interned by the flush itself, not in the request
+        view = PageView.objects.get()
+        self.assertEqual((view.page.path, view.full_user_agent, view.user_agent), ("/privacy-policy/", BROWSER_UA, ""))
+
+    @override_settings(ANALYTICS_INGEST_MODE="buffered", ANALYTICS_BUFFER_SIZE=2, ANALYTICS_BUFFER_FLUSH_INTERVAL=0)
+    def test_buffered_mode_flushes_when_batch_is_full(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertEqual(PageView.objects.count(), 0)
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertEqual(PageView.objects.count(), 2)
+        self.assertEqual(len(ingest.buffer), 0)
+
+
+class GeoDatabaseTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "geoip.bin")
+        csv_path = os.path.join(self.tmpdir.name, "ranges.csv")
+        with open(csv_path, "w") as fh:
+            fh.write("41.58.0.0,41.58.255.255,NG,Nigeria,Lagos,Lagos\n")
+            fh.write("8.8.8.0,8.8.8.255,US,United States,California,Mountain View\n")
+            fh.write("2c0f:f5c0::,2c0f:f5c0:ffff:ffff:ffff:ffff:ffff:ffff,NG,Nigeria,FCT,Abuja\n")
+            fh.write("not-an-ip,1.1.1.1,XX,Nowhere,-,-\n")
+        call_command("build_geoip", csv_path, output=self.db_path, stdout=io.StringIO())
+        geo.reset_database()
+
+    def tearDown(self):
+        geo.reset_database()
+        self.tmpdir.cleanup()
+
+    def test_lookup_ipv4_and_ipv6_ranges(self):
+        db = geo.GeoDatabase(self.db_path)
+        self.assertEqual(len(db), 3)
+        self.assertEqual(db.lookup("41.58.10.1")["city"], "Lagos")
+        self.assertEqual(db.lookup("8.8.8.8")["country_code"], "US")
+        self.assertEqual(db.lookup("2c0f:f5c0::1")["city"], "Abuja")
+        self.assertEqual(db.lookup("::ffff:41.58.0.1")["country"], "Nigeria")
+        self.assertIsNone(db.lookup("8.8.9.1"))
+        self.assertIsNone(db.lookup("1.0.0.1"))
+        db.close()
+
+    def test_middleware_uses_local_database(self):
+        with override_settings(ANALYTICS_GEOIP_PATH=self.db_path):
+            self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA, REMOTE_ADDR="41.58.3.4")
+            self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA, REMOTE_ADDR="10.0.0.7")
+        self.assertEqual(PageView.objects.get(ip_address="41.58.3.4").country, "Nigeria")
+        self.assertEqual(PageView.objects.get(ip_address="10.0.0.7").country, "Local")
+
+    def test_database_built_later_is_picked_up(self):
+        later_path = os.path.join(self.tmpdir.name, "later.bin")
+        with override_settings(ANALYTICS_GEOIP_PATH=later_path), patch.object(geo, "RECHECK_INTERVAL", 0):
+            self.assertIsNone(geo.lookup("8.8.8.8"))
+            os.replace(self.db_path, later_path)
+            self.assertEqual(geo.lookup("8.8.8.8")["country_code"], "US")
+
+
+def login_staff(client):
+    staff = get_user_model().objects.create_user(
+        username="staff", email="staff@example.com", password="pass12345", is_staff=True
+    )
+    client.force_login(staff)
+    return staff
+
+
+def make_pageview(session_key="s1", path="/", **kwargs):
+    fields = dict(
+        url=f"http://testserver{path}", path=path, session_key=session_key, ip_address="8.8.8.8",
+        user_agent=BROWSER_UA, browser="Chrome", device="Desktop", os="Windows",
+    )
+    fields.update(kwargs)
+    return PageView.objects.create(**fields)
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_incremental_rollup_counts_each_row_once(self):
+        now = timezone.now()
+        make_pageview("s1", "/", country="Nigeria", timestamp=now - timedelta(days=1))
+        make_pageview("s1", "/pricing/", timestamp=now)
+        make_pageview("s2", "/pricing/", referrer_domain="google.com", timestamp=now)
+        BotVisit.objects.create(path="/", bot_type="googlebot", timestamp=now)
+
+        processed = rollups.update_rollups(batch_size=2)
+        self.assertEqual(processed["rollup:pageview"], 3)
+        self.assertEqual(rollups.update_rollups()["rollup:pageview"], 0)
+
+        self.assertEqual(rollups.total(rollups.SITE), 3)
+        self.assertEqual(rollups.total(rollups.SITE, "new_sessions"), 2)
+        self.assertEqual(rollups.total(rollups.SITE, "sessions", since=now), 2)
+        self.assertEqual(rollups.total("bot_type"), 1)
+        top = rollups.top_values("path")
+        self.assertEqual((top[0]["value"], top[0]["count"]), ("/pricing/", 2))
+
+        # A returning session is not a new visitor
+        make_pageview("s2", "/blog/", timestamp=now)
+        rollups.update_rollups()
+        self.assertEqual(rollups.total(rollups.SITE), 4)
+        self.assertEqual(rollups.total(rollups.SITE, "new_sessions"), 2)
+        self.assertEqual(
+            TrafficRollup.objects.get(granularity="day", dimension="referrer", value="google.com").count, 1
+        )
+
+    def test_returning_visitor_is_not_new_after_their_rows_are_pruned(self):
+        make_pageview("s1", "/", timestamp=timezone.now() - timedelta(days=200))
+        rollups.update_rollups()
+        PageView.objects.all().delete()  # as retention would
+
+        make_pageview("s1", "/pricing/")
+        make_pageview("s2", "/pricing/")
+        rollups.update_rollups()
+        self.assertEqual(rollups.total(rollups.SITE, "new_sessions"), 2)
+        self.assertEqual(FirstSeenVisitor.objects.count(), 2)
+
+    def test_dashboard_reads_rollups(self):
+        make_pageview("s1", "/pricing/", page_title="Pricing", country="Ghana", country_code="GH")
+        Event.objects.create(event_type="click", event_name="cta", session_key="s1", ip_address="8.8.8.8")
+        login_staff(self.client)
+        # Catch-up is left to rollup_analytics by default
+        self.assertEqual(self.client.get("/analytics/").context["today_views"], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            rollups.update_rollups()
+        r = self.client.get("/analytics/")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.context["today_views"], 1)
+        self.assertEqual(r.context["total_events"], 1)
+        self.assertEqual(r.context["top_pages"][0]["page_title"], "Pricing")
+        self.assertEqual(r.context["top_countries"][0]["country_code"], "GH")
+
+
+class MatchingTests(TestCase):
+    def test_automaton_reports_earliest_listed_signature(self):
+        signatures = ["bot", "crawler", "googlebot"] + [f"sig{i}crawl" for i in range(200)]
+        matcher = matching.SignatureMatcher(signatures)
+        self.assertEqual(matcher.search("Mozilla/5.0 (compatible; Googlebot/2.1)"), "bot")
+        self.assertEqual(matcher.search("xx SIG150CRAWL yy"), "sig150crawl")
+        self.assertEqual(matcher.search("acme-crawler sig7crawl"), "crawler")
+        self.assertIsNone(matcher.search(BROWSER_UA))
+
+    def test_path_trie_prefix_and_exact_entries(self):
+        trie = matching.PathPrefixTrie(matching.DEFAULT_EXCLUDE_PATHS)
+        self.assertTrue(trie.matches("/admin/analytics/"))
+        self.assertTrue(trie.matches("/favicon.ico"))
+        self.assertFalse(trie.matches("/favicon.ico.bak"))
+        self.assertFalse(trie.matches("/admin"))
+        self.assertFalse(trie.matches("/pricing/"))
+
+    @override_settings(ANALYTICS_EXCLUDE_PATHS=["/privacy-policy/"], ANALYTICS_BOT_SIGNATURES=["chrome"])
+    def test_middleware_uses_configured_lists(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.client.get("/pricing/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertEqual(PageView.objects.count(), 0)
+        self.assertEqual(BotVisit.objects.get().bot_type, "chrome")
+
+
+class UserAgentCacheTests(TestCase):
+    def test_lru_eviction_and_counters(self):
+        calls = []
+
+        def classify(ua):
+            calls.append(ua)
+            return (False, None, "Chrome", "Desktop", ua)
+
+        cache = useragent.UserAgentCache(maxsize=2)
+        cache.get_or_classify("a", classify)
+        cache.get_or_classify("b", classify)
+        cache.get_or_classify("a", classify)
+        cache.get_or_classify("c", classify)  # evicts "b", the least recently used
+        cache.get_or_classify("b", classify)
+        self.assertEqual(calls, ["a", "b", "c", "b"])
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 4)
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def test_middleware_memoizes_classification_and_status_exposes_it(self):
+        useragent.cache.clear()
+        for _ in range(3):
+            self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        stats = useragent.cache.stats()
+        self.assertEqual((stats["misses"], stats["hits"]), (1, 2))
+        self.assertEqual(PageView.objects.filter(browser="Chrome", os="Windows").count(), 3)
+
+        login_staff(self.client)
+        r = self.client.get("/analytics/status/")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["user_agent_cache"]["hits"], 2)
+
+
+class PageTitleTests(TestCase):
+    def setUp(self):
+        self.middleware = AnalyticsMiddleware(lambda request: HttpResponse())
+
+    def test_title_read_from_document_head(self):
+        response = HttpResponse("<html><head><title>\n  Q&amp;A  | Pi gent\n</title></head>" + "x" * 100000)
+        self.assertEqual(self.middleware.extract_page_title(response), "Q&A | Pi gent")
+
+    def test_title_outside_scan_window_is_ignored(self):
+        response = HttpResponse("x" * (AnalyticsMiddleware.TITLE_SCAN_BYTES + 10) + "<title>Late</title>")
+        self.assertEqual(self.middleware.extract_page_title(response), "")
+
+    def test_view_supplied_title_and_streaming_responses(self):
+        response = HttpResponse("<title>From HTML</title>")
+        response.analytics_title = "From view"
+        self.assertEqual(self.middleware.extract_page_title(response), "From view")
+        streaming = StreamingHttpResponse(iter([b"<title>Never read</title>"]), content_type="text/html")
+        self.assertEqual(self.middleware.extract_page_title(streaming), "")
+
+    def test_tracked_page_title(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertEqual(PageView.objects.get().page_title, "Privacy Policy | Xpenze")
+
+    def test_main_pages_supply_their_title(self):
+        from blog.models import Post
+
+        author = get_user_model().objects.create_user(username="author", password="pw")
+        Post.objects.create(
+            title="Exam Tips & Tricks", slug="exam-tips", content="<p>Hi</p>", author=author,
+            status=Post.Status.PUBLISHED, published_at=timezone.now(),
+        )
+        # With no body scanning at all, titles can only come from the rendered title block
+        with patch.object(AnalyticsMiddleware, "TITLE_SCAN_BYTES", 0):
+            for url in ("/", "/blog/", "/blog/exam-tips/", "/privacy-policy/", "/delete-account-data/", "/pricing/"):
+                self.client.get(url, HTTP_USER_AGENT=BROWSER_UA)
+        titles = dict(PageView.objects.values_list("path", "page_title"))
+        self.assertEqual(titles["/blog/exam-tips/"], "Exam Tips & Tricks - Pi gent Blog")
+        self.assertEqual(titles["/privacy-policy/"], "Privacy Policy | Xpenze")
+        self.assertEqual(titles["/delete-account-data/"], "Account & Data Deletion | Xpenze")
+        for path in ("/", "/blog/", "/pricing/"):
+            self.assertEqual(titles[path], "Pi gent - AI Study Agents | Custom AI Tutors for Nigerian Students")
+
+
+class VisitorCookieTests(TestCase):
+    def cookie_name(self):
+        return visitor.get_cookie_name()
+
+    def test_anonymous_visitor_gets_cookie_instead_of_db_session(self):
+        r = self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertIn(self.cookie_name(), r.cookies)
+        self.assertEqual(Session.objects.count(), 0)
+
+        r2 = self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertNotIn(self.cookie_name(), r2.cookies)  # not re-sent until refresh is due
+        keys = set(PageView.objects.values_list("session_key", flat=True))
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(len(keys.pop()), 32)
+
+    def test_tampered_cookie_gets_new_id(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.client.cookies[self.cookie_name()] = "0" * 32 + ":1:1:forged"
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertEqual(PageView.objects.values("session_key").distinct().count(), 2)
+
+    def test_rotation_and_refresh_policy(self):
+        now = time.time()
+        fresh = visitor.parse_cookie_value(f"{'a' * 32}:{int(now)}:{int(now)}")
+        self.assertFalse(fresh.needs_cookie)
+        stale = visitor.parse_cookie_value(f"{'a' * 32}:{int(now)}:{int(now - 2 * 86400)}")
+        self.assertTrue(stale.needs_cookie)
+        with override_settings(ANALYTICS_VISITOR_ID_ROTATE=3600):
+            self.assertIsNone(visitor.parse_cookie_value(f"{'a' * 32}:{int(now - 7200)}:{int(now)}"))
+
+
+class HyperLogLogTests(TestCase):
+    def test_estimate_within_error_bound_and_merge(self):
+        a, b = HyperLogLog(), HyperLogLog()
+        a.update(f"visitor-{i}" for i in range(20000))
+        b.update(f"visitor-{i}" for i in range(10000, 30000))
+        self.assertAlmostEqual(a.count(), 20000, delta=20000 * 4 * a.relative_error)
+
+        restored = HyperLogLog.from_bytes(a.to_bytes())
+        merged = restored.merge(b)
+        self.assertAlmostEqual(merged.count(), 30000, delta=30000 * 4 * a.relative_error)
+
+    def test_small_counts_are_near_exact(self):
+        sketch = HyperLogLog()
+        sketch.update(["a", "b", "c", "a"])
+        self.assertEqual(sketch.count(), 3)
+
+    def test_rollup_job_feeds_sketches_and_api(self):
+        now = timezone.now()
+        today = timezone.localdate()
+        make_pageview("s1", "/", timestamp=now - timedelta(days=1))
+        make_pageview("s1", "/pricing/", timestamp=now)
+        make_pageview("s2", "/pricing/", timestamp=now)
+        rollups.update_rollups()
+
+        self.assertEqual(sketches.unique_visitors(today, today), 2)
+        self.assertEqual(sketches.unique_visitors(today - timedelta(days=1), today), 2)
+        self.assertEqual(sketches.unique_visitors(today - timedelta(days=1), today, path="/"), 1)
+
+        login_staff(self.client)
+        r = self.client.get(f"/analytics/api/visitors/?start={today - timedelta(days=1)}&end={today}&path=/pricing/")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["visitors"], 2)
+        self.assertEqual(self.client.get("/analytics/api/visitors/?start=nope").status_code, 400)
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(ANALYTICS_ARCHIVE_DIR=self.tmpdir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    def test_archives_only_rolled_up_rows_and_keeps_rollups(self):
+        old = timezone.now() - timedelta(days=120)
+        make_pageview("s1", "/", timestamp=old)
+        make_pageview("s2", "/pricing/", timestamp=old)
+        recent = make_pageview("s3", "/", timestamp=timezone.now())
+        BotVisit.objects.create(path="/", bot_type="curl", timestamp=old)
+
+        # Nothing is rolled up yet, so nothing may be archived
+        self.assertEqual(retention.archive_old_rows(retention_days=90)["pageview"], 0)
+
+        rollups.update_rollups()
+        # Page views also wait for the visit and interning jobs
+        self.assertEqual(retention.archive_old_rows(retention_days=90, dry_run=True)["pageview"], 0)
+        visits.update_visits()
+        self.assertEqual(retention.archive_old_rows(retention_days=90, dry_run=True)["pageview"], 0)
+        dimensions.intern_pending()
+        moved = retention.archive_old_rows(retention_days=90, batch_size=1)
+        self.assertEqual(moved, {"pageview": 2, "botvisit": 1})
+        self.assertEqual(list(PageView.objects.values_list("id", flat=True)), [recent.id])
+        self.assertEqual(rollups.total(rollups.SITE), 3)
+
+        month = timezone.localtime(old).strftime("%Y-%m")
+        rows = list(retention.read_archive("pageview", month))
+        self.assertEqual([r["path"] for r in rows], ["/", "/pricing/"])
+        self.assertEqual([m for _, m, _ in retention.list_archives("botvisit")], [month])
+
+    def test_read_archive_dedupes_replayed_batches(self):
+        old = timezone.now() - timedelta(days=120)
+        make_pageview("s1", "/", timestamp=old)
+        dimensions.intern_pending()
+        rollups.update_rollups()
+        visits.update_visits()
+        retention.archive_batch("pageview", timezone.now(), 10)
+        # Simulate a crash after writing but before deleting: the batch is written twice
+        month = timezone.localtime(old).strftime("%Y-%m")
+        with open(retention.archive_path("pageview", month), "rb") as fh:
+            data = fh.read()
+        with open(retention.archive_path("pageview", month), "ab") as fh:
+            fh.write(data)
+        self.assertEqual(len(list(retention.read_archive("pageview", month))), 2)
+        self.assertEqual(len(list(retention.read_archive("pageview", month, dedupe=True))), 1)
+
+    def test_dry_run_writes_nothing(self):
+        make_pageview("s1", "/", timestamp=timezone.now() - timedelta(days=120))
+        out = io.StringIO()
+        call_command("archive_analytics", dry_run=True, stdout=out)
+        self.assertIn("Would archive pageview: 0", out.getvalue())
+        self.assertFalse(TrafficRollup.objects.exists())
+        self.assertFalse(AggregationWatermark.objects.filter(last_id__gt=0).exists())
+
+        call_command("archive_analytics", stdout=io.StringIO())
+        self.assertEqual(PageView.objects.count(), 0)
+
+    @override_settings(ANALYTICS_GEO_MODE="deferred")
+    def test_deferred_geo_waits_for_enrichment(self):
+        make_pageview("s1", "/", timestamp=timezone.now() - timedelta(days=120))
+        dimensions.intern_pending()
+        rollups.update_rollups()
+        visits.update_visits()
+        # Rollups wait for geo too, so force their watermarks past the row
+        AggregationWatermark.objects.filter(name__in=["rollup:pageview", "visits:pageview"]).update(last_id=10**9)
+        self.assertEqual(retention.archive_old_rows(retention_days=90, dry_run=True)["pageview"], 0)
+        enrich.enrich_pageviews(resolver=enrich.StubResolver())
+        self.assertEqual(retention.archive_old_rows(retention_days=90)["pageview"], 1)
+
+
+class CollectBeaconTests(TestCase):
+    def post(self, items, **extra):
+        body = items if isinstance(items, str) else json.dumps(items)
+        return self.client.post(
+            "/analytics/collect/", body, content_type="text/plain", HTTP_USER_AGENT=BROWSER_UA, **extra
+        )
+
+    def test_batch_is_validated_and_bulk_inserted(self):
+        r = self.post([
+            {"type": "click", "name": "CTA clicked", "data": {"button": "pricing"}, "url": "http://testserver/"},
+            {"type": "download", "name": "Syllabus"},
+            {"type": "not-a-type", "name": "x"},
+            {"type": "click"},
+            {"type": "click", "name": "big", "data": {"x": "y" * 5000}},
+            "garbage",
+        ], HTTP_REFERER="http://testserver/pricing/")
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(r.json(), {"accepted": 2, "rejected": 4})
+        click = Event.objects.get(event_type="click")
+        self.assertEqual(click.event_data, {"button": "pricing"})
+        self.assertEqual(len(click.session_key), 32)
+        self.assertEqual(Event.objects.get(event_type="download").page_url, "http://testserver/pricing/")
+
+    def test_timing_updates_latest_pageview_of_visitor(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.post([{"type": "timing", "path": "/privacy-policy/", "seconds": 37.6}])
+        older, latest = PageView.objects.order_by("id")
+        self.assertIsNone(older.time_on_page)
+        latest.refresh_from_db()
+        self.assertEqual(latest.time_on_page, 37)
+
+    def test_malformed_oversized_and_ignored_requests(self):
+        self.assertEqual(self.post("{not json").status_code, 400)
+        self.assertEqual(self.post({"type": "click"}).status_code, 400)
+        with override_settings(ANALYTICS_COLLECT_MAX_EVENTS=2):
+            self.assertEqual(self.post([{"type": "click", "name": "a"}] * 3).status_code, 400)
+        with override_settings(ANALYTICS_COLLECT_MAX_BYTES=64):
+            self.assertEqual(self.post([{"type": "click", "name": "a" * 100}]).status_code, 413)
+        self.assertEqual(self.post([{"type": "click", "name": "a"}], CONTENT_LENGTH="12abc").status_code, 400)
+        self.assertEqual(self.client.get("/analytics/collect/").status_code, 405)
+        bot = self.client.post(
+            "/analytics/collect/", json.dumps([{"type": "click", "name": "a"}]),
+            content_type="text/plain", HTTP_USER_AGENT="curl/8.0",
+        )
+        self.assertEqual(bot.status_code, 204)
+        self.assertEqual(Event.objects.count(), 0)
+
+
+@override_settings(ANALYTICS_TRACKING_MODE="beacon")
+class PageviewBeaconTests(TestCase):
+    def beacon(self, data, user_agent=BROWSER_UA):
+        return self.client.post(
+            "/analytics/pageview/", json.dumps(data), content_type="text/plain", HTTP_USER_AGENT=user_agent
+        )
+
+    def test_middleware_defers_to_beacon(self):
+        r = self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.assertContains(r, "data-track-pageviews")
+        self.assertEqual(PageView.objects.count(), 0)
+
+        r = self.beacon({
+            "path": "/privacy-policy/", "url": "http://testserver/privacy-policy/?utm_source=x",
+            "title": "  Privacy\n Policy ", "referrer": "https://www.google.com/search",
+        })
+        self.assertEqual(r.status_code, 204)
+        self.assertIn(visitor.get_cookie_name(), r.cookies)
+        view = PageView.objects.get()
+        self.assertEqual((view.path, view.page_title, view.browser), ("/privacy-policy/", "Privacy Policy", "Chrome"))
+        self.assertEqual(view.referrer_domain, "www.google.com")
+        self.assertEqual(len(view.session_key), 32)
+
+    def test_bots_exclusions_and_pixel(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT="curl/8.0")
+        self.beacon({"path": "/privacy-policy/"}, user_agent="Mozilla/5.0 (compatible; Googlebot/2.1)")
+        # Only the middleware logs crawlers; the bot's beacon adds nothing
+        self.assertEqual(list(BotVisit.objects.values_list("bot_type", flat=True)), ["curl"])
+        self.beacon({"path": "/admin/"})
+        self.assertEqual(self.beacon({"title": "no path"}).status_code, 400)
+        self.assertEqual(PageView.objects.count(), 0)
+
+        r = self.client.get("/analytics/pageview/", {"p": "/pricing/", "t": "Pricing"}, HTTP_USER_AGENT=BROWSER_UA)
+        self.assertEqual(r["Content-Type"], "image/gif")
+        self.assertEqual(PageView.objects.get().path, "/pricing/")
+        self.assertEqual(self.client.get("/analytics/pageview/").status_code, 200)
+
+    def test_beacon_ignored_in_server_mode(self):
+        with override_settings(ANALYTICS_TRACKING_MODE="server"):
+            self.assertNotContains(self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA), "data-track-pageviews")
+            self.beacon({"path": "/privacy-policy/"})
+        self.assertEqual(PageView.objects.count(), 1)
+
+
+class ActiveVisitorsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sliding_window_counts_latest_path_per_visitor(self):
+        now = time.time()
+        realtime.mark_active("a" * 32, "/blog/", now=now - 4 * 60)
+        realtime.mark_active("a" * 32, "/pricing/", now=now)
+        realtime.mark_active("b" * 32, "/pricing/", now=now - 60)
+        realtime.mark_active("c" * 32, "/old/", now=now - 10 * 60)  # outside the window
+        with self.assertNumQueries(0):
+            active = realtime.active_visitors(now=now)
+        self.assertEqual(active["visitors"], 2)
+        self.assertEqual(active["paths"], [{"path": "/pricing/", "visitors": 2}])
+
+    def test_concurrent_visitors_are_all_counted(self):
+        now = time.time()
+        threads = [
+            threading.Thread(target=realtime.mark_active, args=(f"{i:032x}", "/", now)) for i in range(50)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        realtime.mark_active(f"{0:032x}", "/blog/", now)  # repeat view: new path, same roster slot
+        self.assertEqual(cache.get(realtime.counter_key(realtime.current_minute(now))), 50)
+        active = realtime.active_visitors(now=now)
+        self.assertEqual(active["visitors"], 50)
+        self.assertEqual(active["paths"][1], {"path": "/blog/", "visitors": 1})
+
+    def test_tracked_views_feed_staff_endpoint(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT="curl/8.0")
+        login_staff(self.client)
+        data = self.client.get("/analytics/api/active/").json()
+        self.assertEqual(data["visitors"], 1)
+        self.assertEqual(data["paths"], [{"path": "/privacy-policy/", "visitors": 1}])
+
+
+class DimensionTests(TestCase):
+    def setUp(self):
+        dimensions.clear_caches()
+
+    def tearDown(self):
+        dimensions.clear_caches()
+
+    def test_tracked_views_reference_interned_dimensions(self):
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA, HTTP_REFERER="https://www.google.com/")
+        self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA)
+        # Tracking itself never touches the dimension tables
+        self.assertEqual(UserAgent.objects.count(), 0)
+        self.assertEqual(PageView.objects.filter(user_agent=BROWSER_UA).count(), 2)
+
+        self.assertEqual(dimensions.intern_pending(), 2)
+        first, second = PageView.objects.order_by("id")
+        self.assertEqual(first.page_id, second.page_id)
+        self.assertEqual(first.agent_id, second.agent_id)
+        self.assertEqual(first.page.path, "/privacy-policy/")
+        self.assertEqual(first.referrer_host.domain, "www.google.com")
+        self.assertIsNone(second.referrer_host_id)
+        self.assertEqual(first.user_agent, "")
+        self.assertEqual(first.full_user_agent, BROWSER_UA)
+        self.assertEqual((first.agent.browser, first.agent.os), ("Chrome", "Windows"))
+        self.assertEqual(UserAgent.objects.count(), 1)
+
+    def test_intern_pending_runs_incrementally(self):
+        make_pageview(path="/blog/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(dimensions.intern_pending(), 1)
+        self.assertEqual(dimensions.intern_pending(), 0)
+        make_pageview(path="/blog/")
+        make_pageview(path="/about/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(dimensions.intern_pending(batch_size=1), 2)
+        self.assertEqual(Path.objects.count(), 2)
+        self.assertEqual(UserAgent.objects.count(), 1)
+        self.assertEqual(len(set(PageView.objects.values_list("page_id", flat=True))), 2)
+        self.assertFalse(PageView.objects.exclude(user_agent="").exists())
+
+    def test_ids_cached_only_after_commit(self):
+        make_pageview(path="/blog/")
+        with self.captureOnCommitCallbacks(execute=False):
+            dimensions.intern_pending()
+        self.assertEqual(len(dimensions.paths), 0)
+        self.assertEqual(len(dimensions.user_agents), 0)
+
+    def test_backfill_migration_interns_existing_rows(self):
+        migration = importlib.import_module("analytics.migrations.0008_backfill_pageview_dimensions")
+        for path in ("/", "/blog/", "/blog/"):
+            make_pageview(path=path, referrer_domain="t.co")
+        make_pageview(path="/", user_agent="Other/1.0")
+        migration.backfill(apps, None)
+
+        self.assertEqual(
+            AggregationWatermark.objects.get(name=dimensions.WATERMARK).last_id, PageView.objects.latest("id").id
+        )
+        self.assertEqual(dimensions.intern_pending(), 0)
+        self.assertEqual(Path.objects.count(), 2)
+        self.assertEqual(UserAgent.objects.count(), 2)
+        self.assertFalse(PageView.objects.filter(page__isnull=True).exists())
+        self.assertFalse(PageView.objects.exclude(user_agent="").exists())
+        self.assertEqual(PageView.objects.filter(referrer_host__domain="t.co").count(), 3)
+        self.assertEqual(
+            set(PageView.objects.values_list("agent__user_agent", flat=True)), {BROWSER_UA, "Other/1.0"}
+        )
+
+
+class CountingResolver(enrich.StubResolver):
+    calls = []
+
+    def resolve(self, ips):
+        self.calls.append(set(ips))
+        return super().resolve(ips)
+
+
+class FlakyResolver(enrich.StubResolver):
+    """Fails the lookup for ``down`` IPs until they are cleared."""
+
+    down = set()
+
+    def resolve(self, ips):
+        found = super().resolve(ips)
+        failed = ips & self.down
+        if failed:
+            raise enrich.GeoLookupError({ip: geo for ip, geo in found.items() if ip not in failed}, failed)
+        return found
+
+
+@override_settings(
+    ANALYTICS_GEO_MODE="deferred",
+    ANALYTICS_GEO_STUB={"41.58.3.4": {"country": "Nigeria", "country_code": "NG", "city": "Lagos", "region": "Lagos"}},
+)
+class GeoEnrichmentTests(TestCase):
+    def test_views_stored_without_geo_then_enriched_in_batches(self):
+        for ip in ("41.58.3.4", "41.58.3.4", "10.0.0.7", "8.8.8.8"):
+            self.client.get("/privacy-policy/", HTTP_USER_AGENT=BROWSER_UA, REMOTE_ADDR=ip)
+        self.assertEqual(set(PageView.objects.values_list("country", flat=True)), {""})
+
+        # Rollups wait for enrichment so country counts are complete
+        self.assertEqual(rollups.update_rollups()["rollup:pageview"], 0)
+
+        resolver = CountingResolver()
+        resolver.calls.clear()
+        totals = enrich.enrich_pageviews(batch_size=3, resolver=resolver)
+        self.assertEqual(totals, {"processed": 4, "updated": 3})
+        self.assertEqual(resolver.calls, [{"41.58.3.4", "10.0.0.7"}, {"8.8.8.8"}])
+        self.assertEqual(PageView.objects.filter(city="Lagos").count(), 2)
+        self.assertEqual(PageView.objects.get(ip_address="10.0.0.7").country, "Local")
+        self.assertEqual(PageView.objects.get(ip_address="8.8.8.8").country, "")
+
+        self.assertEqual(rollups.update_rollups()["rollup:pageview"], 4)
+        self.assertEqual(rollups.top_values("country")[0], {"value": "Nigeria", "label": "NG", "count": 2})
+        self.assertEqual(enrich.enrich_pageviews(resolver=resolver), {"processed": 0, "updated": 0})
+
+    @override_settings(ANALYTICS_GEO_RESOLVER="analytics.enrich.BatchHTTPResolver", ANALYTICS_ROLLUP_ON_DASHBOARD=True)
+    def test_dashboard_leaves_network_lookups_to_the_worker(self):
+        make_pageview(ip_address="41.58.3.4")
+        login_staff(self.client)
+        with patch("analytics.enrich.requests.post") as post:
+            self.assertEqual(self.client.get("/analytics/").status_code, 200)
+        post.assert_not_called()
+        self.assertEqual(enrich.enriched_max_id(), 0)
+
+        with override_settings(ANALYTICS_GEO_RESOLVER="analytics.enrich.StubResolver"):
+            self.client.get("/analytics/")
+        self.assertEqual(PageView.objects.get().country_code, "NG")
+
+    def test_failed_lookup_holds_the_watermark_until_a_retry_succeeds(self):
+        first = make_pageview(ip_address="10.0.0.7")
+        make_pageview(ip_address="41.58.3.4")
+        make_pageview(ip_address="8.8.8.8")
+        resolver = FlakyResolver()
+        resolver.down = {"41.58.3.4"}
+
+        self.assertEqual(enrich.enrich_pageviews(resolver=resolver), {"processed": 1, "updated": 1})
+        self.assertEqual(enrich.enriched_max_id(), first.id)
+        self.assertEqual(PageView.objects.get(ip_address="41.58.3.4").country, "")
+
+        resolver.down = set()
+        self.assertEqual(enrich.enrich_pageviews(resolver=resolver), {"processed": 2, "updated": 1})
+        self.assertEqual(PageView.objects.get(ip_address="41.58.3.4").city, "Lagos")
+
+    @override_settings(ANALYTICS_GEO_RESOLVER="analytics.enrich.BatchHTTPResolver")
+    def test_http_errors_are_reported_as_failed_lookups(self):
+        make_pageview(ip_address="8.8.4.4")
+        with patch("analytics.enrich.requests.post", side_effect=requests.ConnectionError):
+            self.assertEqual(enrich.enrich_pageviews(), {"processed": 0, "updated": 0})
+        self.assertEqual(enrich.enriched_max_id(), 0)
+
+    def test_command_uses_configured_resolver(self):
+        make_pageview(ip_address="41.58.3.4")
+        out = io.StringIO()
+        call_command("enrich_geo", resolver="analytics.enrich.StubResolver", stdout=out)
+        self.assertIn("Enriched 1 of 1", out.getvalue())
+        self.assertEqual(PageView.objects.get().country_code, "NG")
+
+
+class HeavyHitterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_space_saving_keeps_heavy_items_with_bounded_error(self):
+        stream = ["hot"] * 300 + ["warm"] * 120 + [f"rare-{i}" for i in range(2000)]
+        first, second = SpaceSaving(50), SpaceSaving(50)
+        for i, item in enumerate(stream):
+            (first if i % 2 else second).add(item)
+        merged = SpaceSaving.union([first, second], capacity=50)
+        self.assertLessEqual(len(merged), 50)
+        top = {item: (count, error) for item, count, error in merged.top(2)}
+        self.assertEqual(set(top), {"hot", "warm"})
+        for item, true_count in (("hot", 300), ("warm", 120)):
+            count, error = top[item]
+            self.assertGreaterEqual(count, true_count)
+            self.assertLessEqual(count - error, true_count)
+
+        restored = SpaceSaving.from_dict(merged.to_dict())
+        self.assertEqual(restored.top(5), merged.top(5))
+
+    def test_rollup_feeds_bot_and_page_sketches(self):
+        for i in range(30):
+            BotVisit.objects.create(path=f"/blog/{i}/", ip_address="203.0.113.9", bot_type="python-requests")
+        for i in range(5):
+            BotVisit.objects.create(path="/blog/0/", ip_address=f"198.51.100.{i}", bot_type="curl")
+        make_pageview("s1", "/pricing/", page_title="Pricing", referrer_domain="t.co", city="Accra", country="Ghana")
+        make_pageview("s2", "/pricing/", page_title="Pricing")
+        rollups.update_rollups()
+
+        today = timezone.localdate()
+        bot_ips = sketches.top_items("bot_ip", today, today, limit=2)
+        self.assertEqual(bot_ips[0]["value"], "203.0.113.9")
+        self.assertEqual((bot_ips[0]["count"], bot_ips[0]["label"]), (30, "python-requests"))
+        self.assertEqual(sketches.top_items("bot_path", today, today, limit=1)[0]["value"], "/blog/0/")
+        self.assertEqual(sketches.top_items("city", today, today), [
+            {"value": "Accra", "label": "Ghana", "count": 1, "error": 0},
+        ])
+
+        login_staff(self.client)
+        r = self.client.get("/analytics/")
+        self.assertEqual(r.context["top_pages"][0], {"path": "/pricing/", "page_title": "Pricing", "views": 2})
+        self.assertEqual(r.context["top_referrers"], [{"referrer_domain": "t.co", "count": 1}])
+        self.assertEqual(r.context["top_bot_ips"][0]["value"], "203.0.113.9")
+        self.assertContains(r, "Most Crawled Paths")
+
+
+@override_settings(ANALYTICS_BOT_LOG_THRESHOLD=5, ANALYTICS_BOT_BLOCK_RATE=20)
+class CrawlRateTests(TestCase):
+    def setUp(self):
+        ratelimit.memory_counter.clear()
+        ratelimit.aggregator.drain()
+
+    def test_sliding_window_weights_previous_minute(self):
+        counter = ratelimit.MemoryRateCounter()
+        for _ in range(30):
+            counter.hit("k", now=600.0)
+        # A quarter into the next minute, 3/4 of the previous one still counts
+        self.assertEqual(counter.hit("k", now=675.0), 1 + 22)
+        self.assertEqual(counter.hit("k", now=800.0), 1)
+
+    def test_busy_crawler_is_aggregated_and_rollups_count_hits(self):
+        for i in range(12):
+            self.client.get("/", HTTP_USER_AGENT="python-requests/2.31", REMOTE_ADDR="203.0.113.7")
+        for visit in ratelimit.aggregator.drain():
+            visit.save()
+        self.assertEqual(sum(BotVisit.objects.values_list("hits", flat=True)), 12)
+        self.assertLess(BotVisit.objects.count(), 12)
+
+        rollups.update_rollups()
+        total = TrafficRollup.objects.filter(dimension="bot_type", granularity=TrafficRollup.DAY).aggregate(Sum("count"))
+        self.assertEqual(total["count__sum"], 12)
+
+    def test_block_rate_spares_allowlisted_crawlers(self):
+        statuses = [
+            self.client.get("/", HTTP_USER_AGENT="python-requests/2.31", REMOTE_ADDR="203.0.113.8").status_code
+            for _ in range(25)
+        ]
+        self.assertNotIn(429, statuses[:20])
+        self.assertEqual(statuses[-1], 429)
+
+        googlebot = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+        for _ in range(25):
+            r = self.client.get("/", HTTP_USER_AGENT=googlebot, REMOTE_ADDR="66.249.66.1")
+        self.assertNotEqual(r.status_code, 429)
+
+
+class VisitTests(TestCase):
+    def test_page_views_split_into_visits_on_inactivity_gap(self):
+        start = timezone.now() - timedelta(hours=3)
+        make_pageview("s1", "/", timestamp=start, referrer_domain="t.co", country="Ghana")
+        make_pageview("s1", "/pricing/", timestamp=start + timedelta(minutes=10))
+        make_pageview("s2", "/blog/", timestamp=start + timedelta(minutes=5))
+        self.assertEqual(visits.update_visits(batch_size=2), 3)
+
+        # Next batch: one view continues s1's visit, one starts a new visit after the gap
+        make_pageview("s1", "/signup/", timestamp=start + timedelta(minutes=25))
+        make_pageview("s1", "/", timestamp=start + timedelta(minutes=90))
+        self.assertEqual(visits.update_visits(), 2)
+        self.assertEqual(visits.update_visits(), 0)
+
+        first = Visit.objects.get(session_key="s1", start=start)
+        self.assertEqual((first.page_count, first.entry_path, first.exit_path), (3, "/", "/signup/"))
+        self.assertEqual((first.duration, first.referrer_domain, first.country), (25 * 60, "t.co", "Ghana"))
+        self.assertEqual(Visit.objects.count(), 3)
+
+        stats = visits.visit_stats()
+        self.assertEqual(stats["visits"], 3)
+        self.assertEqual(stats["bounce_rate"], 66.7)
+        self.assertEqual(stats["pages_per_visit"], 1.67)
+        self.assertEqual(visits.top_paths("entry_path", limit=1), [{"path": "/", "visits": 2}])
+
+    def test_dashboard_shows_visit_metrics(self):
+        make_pageview("s1", "/")
+        make_pageview("s1", "/pricing/")
+        visits.update_visits()
+        login_staff(self.client)
+        r = self.client.get("/analytics/")
+        self.assertEqual(r.context["visit_stats"]["pages_per_visit"], 2)
+        self.assertEqual(r.context["top_exit_pages"], [{"path": "/pricing/", "visits": 1}])
+        self.assertContains(r, "Bounce Rate")
+
+
+class FunnelTests(TestCase):
+    def test_checkout_funnel_is_evaluated_incrementally_per_day(self):
+        from payments.models import PaymentTransaction
+
+        buyer = get_user_model().objects.create_user(username="buyer", email="b@example.com", password="pw")
+        make_pageview("s1", "/", user=buyer, country="Ghana")
+        make_pageview("s1", "/pricing/", user=buyer, country="Ghana")
+        make_pageview("s2", "/")
+        make_pageview("s2", "/pricing/")
+        make_pageview("s3", "/pricing/")  # never saw the home page
+        make_pageview("s4", "/pricing/")
+        make_pageview("s4", "/")  # steps out of order
+        tx = PaymentTransaction.objects.create(student=buyer, reference="ref-1", amount=100)
+        tx.status = PaymentTransaction.Status.SUCCESS
+        tx.save()
+
+        funnel = Funnel.objects.get(slug="checkout")
+        self.assertEqual(funnels.update_funnels(), funnels.get_backfill_days())  # new funnel: backfilled
+        self.assertEqual(funnels.update_funnels(), 0)
+        funnel.refresh_from_db()
+
+        report = funnels.funnel_report(funnel, timezone.localdate())
+        self.assertEqual([step["visitors"] for step in report["steps"]], [3, 2, 1, 1])
+        self.assertEqual(report["conversion_rate"], 33.3)
+        self.assertEqual(report["by_country"][0], {"value": "Unknown", "entered": 2, "converted": 0, "rate": 0})
+        self.assertIn({"value": "Ghana", "entered": 1, "converted": 1, "rate": 100.0}, report["by_country"])
+
+        # Only today is re-evaluated when new rows arrive
+        make_pageview("s5", "/")
+        self.assertEqual(funnels.update_funnels(), 1)
+        self.assertEqual(
+            FunnelResult.objects.get(funnel=funnel, day=timezone.localdate(), dimension="site", step=0).visitors, 4
+        )
+
+    def test_edited_funnel_is_pending_until_the_scheduled_run(self):
+        make_pageview("s1", "/")
+        make_pageview("s1", "/pricing/")
+        funnel = Funnel.objects.get(slug="checkout")
+        funnels.update_funnels()
+        old_day = timezone.localdate() - timedelta(days=funnels.get_backfill_days() + 5)
+        FunnelResult.objects.create(funnel=funnel, day=old_day, dimension="site", step=0, visitors=9)
+
+        funnel.steps = [{"kind": "path", "value": "/pricing/"}, {"kind": "path", "value": "/"}]
+        funnel.evaluated_through = None  # what the admin does when the steps change
+        funnel.save()
+        self.assertTrue(funnels.funnel_report(funnel, timezone.localdate())["pending"])
+        login_staff(self.client)
+        self.assertContains(self.client.get("/analytics/"), "Pending: results are computed")
+
+        funnels.update_funnels()
+        funnel.refresh_from_db()
+        self.assertFalse(FunnelResult.objects.filter(funnel=funnel, day=old_day).exists())
+        report = funnels.funnel_report(funnel, timezone.localdate())
+        self.assertFalse(report["pending"])
+        self.assertEqual([step["visitors"] for step in report["steps"]], [1, 0])
+
+    def test_step_validation(self):
+        from django.core.exceptions import ValidationError
+
+        with self.assertRaises(ValidationError):
+            Funnel(name="Bad", slug="bad", steps=[{"kind": "path", "value": "/"}, {"kind": "nope"}]).clean()
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        login_staff(self.client)
+
+    def test_streams_csv_with_column_and_date_filters(self):
+        make_pageview("s1", "/", country="Ghana")
+        make_pageview("s2", "/old/", timestamp=timezone.now() - timedelta(days=10))
+        today = timezone.localdate().isoformat()
+        r = self.client.get("/analytics/export/", {"start": today, "columns": "path,country,user_agent"})
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        self.assertIn(f"pageview-{today}.csv", r["Content-Disposition"])
+        rows = list(csv.reader(io.StringIO(b"".join(r.streaming_content).decode())))
+        # user_agent comes back from the UserAgent dimension table
+        self.assertEqual(rows, [["path", "country", "user_agent"], ["/", "Ghana", BROWSER_UA]])
+
+    def test_gzipped_ndjson_and_bad_parameters(self):
+        for i in range(5):
+            BotVisit.objects.create(path=f"/p{i}/", bot_type="curl")
+        chunks = export.stream("botvisit", export.NDJSON, ["path"], compress=True, chunk_size=2)
+        rows = [json.loads(line) for line in gzip.decompress(b"".join(chunks)).decode().splitlines()]
+        self.assertEqual(rows, [{"path": f"/p{i}/"} for i in range(5)])
+
+        self.assertEqual(self.client.get("/analytics/export/", {"columns": "nope"}).status_code, 400)
+        self.assertEqual(self.client.get("/analytics/export/", {"source": "users"}).status_code, 400)
+        self.assertEqual(self.client.get("/analytics/export/", {"start": "2025-13-01"}).status_code, 400)
+
+    def test_command_writes_file(self):
+        make_pageview("s1", "/pricing/")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "views.ndjson")
+            call_command("export_analytics", "pageview", "--format", "ndjson", "--columns", "id,path",
+                         "--output", path, stdout=io.StringIO())
+            with open(path) as fh:
+                self.assertEqual(json.loads(fh.readline())["path"], "/pricing/")
+
+
+class QueryApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        login_staff(self.client)
+
+    def test_series_breakdown_and_comparison_from_rollups(self):
+        today = timezone.localdate()
+        now = timezone.now()
+        make_pageview("s1", "/", timestamp=now, country="Ghana")
+        make_pageview("s2", "/pricing/", timestamp=now, country="Ghana")
+        make_pageview("s3", "/", timestamp=now - timedelta(days=7), country="Kenya")
+        rollups.update_rollups()
+
+        r = self.client.get("/analytics/api/query/", {
+            "metric": "pageviews", "bucket": "day", "start": today.isoformat(), "end": today.isoformat(),
+            "compare": "previous",
+        })
+        self.assertEqual(r.status_code, 200)
+        data = r.json()
+        self.assertEqual(data["series"], [{"bucket": today.isoformat(), "value": 2}])
+        self.assertEqual(data["comparison"]["total"], 0)
+
+        start = (today - timedelta(days=13)).isoformat()
+        data = self.client.get("/analytics/api/query/", {
+            "metric": "pageviews", "bucket": "week", "start": start, "dimension": "country",
+        }).json()
+        self.assertEqual([(g["value"], g["total"]) for g in data["groups"]], [("Ghana", 2), ("Kenya", 1)])
+        self.assertEqual(sum(point["value"] for point in data["groups"][1]["series"]), 1)
+
+        data = self.client.get("/analytics/api/query/", {"metric": "visitors", "start": start}).json()
+        self.assertEqual(data["total"], 3)
+        self.assertEqual(len(data["series"]), 14)
+
+    def test_cached_until_rollups_change(self):
+        make_pageview("s1", "/")
+        rollups.update_rollups()
+        params = query.parse_query({"metric": "pageviews"})
+        self.assertEqual(query.run(params)["total"], 1)
+        with self.assertNumQueries(0):
+            query.run(params)
+        make_pageview("s2", "/")
+        with self.captureOnCommitCallbacks(execute=True):
+            rollups.update_rollups()
+        self.assertEqual(query.run(params)["total"], 2)
+
+    def test_rejects_queries_rollups_cannot_answer(self):
+        for params in (
+            {"metric": "sessions"},
+            {"metric": "pageviews", "dimension": "country", "filter": "path:/"},
+            {"metric": "visitors", "bucket": "hour"},
+            {"metric": "pageviews", "bucket": "hour", "start": "2025-01-01", "end": "2025-03-01"},
+            {"metric": "pageviews", "start": "2025-02-01", "end": "2025-01-01"},
+        ):
+            self.assertEqual(self.client.get("/analytics/api/query/", params).status_code, 400, params)
@@ -0,0 +1,113 @@
+"""
+Space-Saving heavy-hitter summary.
+
+Tracks at most ``capacity`` items with an upper-bound count each, whatever the
+number of distinct items in the stream. ``floor`` bounds the count of any item
+that isn't tracked (it is 0 until something has been evicted), and each
+tracked item's count overestimates its true count by at most its ``error``.
+Any item whose true count exceeds ``total / capacity`` is guaranteed to be
+tracked.
+
+Summaries merge (used to combine per-day sketches into a date range): an item
+missing from one side is assumed to have that side's ``floor``, and the merged
+result keeps the ``capacity`` largest counts.
+"""
+import heapq
+
+DEFAULT_CAPACITY = 200
+
+
+class SpaceSaving:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise ValueError('capacity must be positive')
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.labels = {}
+        self.floor = 0
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, item, amount=1, label=''):
+        self.total += amount
+        if label:
+            self.labels[item] = label
+        if item in self.counts:
+            self.counts[item] += amount
+            return
+        self.counts[item] = self.floor + amount
+        self.errors[item] = self.floor
+        if len(self.counts) > self.capacity:
+            self._evict(len(self.counts) - self.capacity)
+
+    def update(self, counts, labels=None):
+        """Fold exact per-item counts (e.g. one batch of rows) into the summary"""
+        exact = SpaceSaving(max(1, len(counts)))
+        exact.counts = dict(counts)
+        exact.errors = dict.fromkeys(counts, 0)
+        exact.labels = dict(labels or {})
+        exact.total = sum(counts.values())
+        return self.merge(exact)
+
+    def merge(self, other):
+        """Fold ``other`` into this summary; capacity stays this summary's"""
+        merged = {}
+        errors = {}
+        for item in self.counts.keys() | other.counts.keys():
+            merged[item] = self.counts.get(item, self.floor) + other.counts.get(item, other.floor)
+            errors[item] = self.errors.get(item, self.floor) + other.errors.get(item, other.floor)
+        self.counts, self.errors = merged, errors
+        self.labels.update(other.labels)
+        self.floor += other.floor
+        self.total += other.total
+        if len(self.counts) > self.capacity:
+            self._evict(len(self.counts) - self.capacity)
+        return self
+
+    def _evict(self, n):
+        for item in heapq.nsmallest(n, self.counts, key=self.counts.__getitem__):
+            self.floor = max(self.floor, self.counts.pop(item))
+            self.errors.pop(item, None)
+            self.labels.pop(item, None)
+
+    def top(self, n=None):
+        """[(item, count, error)] by count, highest first"""
+        ranked = sorted(self.counts.items(), key=lambda pair: (-pair[1], pair[0]))
+        if n is not None:
+            ranked = ranked[:n]
+        return [(item, count, self.errors.get(item, 0)) for item, count in ranked]
+
+    def to_dict(self):
+        return {
+            'capacity': self.capacity,
+            'floor': self.floor,
+            'total': self.total,
+            'items': {
+                item: [count, self.errors.get(item, 0), self.labels.get(item, '')]
+                for item, count in self.counts.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data, capacity=None):
+        sketch = cls(capacity or data.get('capacity') or DEFAULT_CAPACITY)
+        sketch.floor = data.get('floor', 0)
+        sketch.total = data.get('total', 0)
+        for item, (count, error, label) in data.get('items', {}).items():
+            sketch.counts[item] = count
+            sketch.errors[item] = error
+            if label:
+                sketch.labels[item] = label
+        if len(sketch.counts) > sketch.capacity:
+            sketch._evict(len(sketch.counts) - sketch.capacity)
+        return sketch
+
+    @classmethod
+    def union(cls, sketches, capacity=DEFAULT_CAPACITY):
+        result = cls(capacity)
+        for sketch in sketches:
+            result.merge(sketch)
+        return result
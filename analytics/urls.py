@@ -4,4 +4,11 @@ from . import views
 urlpatterns = [
     path('', views.analytics_dashboard, name='analytics_dashboard'),
     path('exclude/', views.exclude_from_analytics, name='exclude_analytics'),
+    path('status/', views.analytics_status, name='analytics_status'),
+    path('collect/', views.collect_events, name='analytics_collect'),
+    path('pageview/', views.track_pageview, name='analytics_pageview'),
+    path('api/active/', views.active_visitors_api, name='analytics_active_visitors'),
+    path('api/visitors/', views.unique_visitors_api, name='analytics_unique_visitors'),
+    path('api/query/', views.query_api, name='analytics_query'),
+    path('export/', views.export_api, name='analytics_export'),
 ]
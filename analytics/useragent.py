@@ -0,0 +1,89 @@
+"""
+Memoized user-agent classification.
+
+A few hundred distinct user agents make up most traffic, so the
+(is_bot, bot_type, browser, device, os) tuple computed by AnalyticsMiddleware
+is kept in a bounded, thread-safe LRU cache keyed by a digest of the UA
+string. Hit/miss counters are per process and exposed through
+``/analytics/status/``.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .matching import SETTING_NAMES as MATCHER_SETTINGS
+
+
+def get_cache_size():
+    return max(0, int(getattr(settings, 'ANALYTICS_UA_CACHE_SIZE', 2048) or 0))
+
+
+class UserAgentCache:
+    """LRU cache of classification tuples with hit/miss counters"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(user_agent):
+        # Fixed-size key: long UA strings aren't kept alive by the cache
+        return hashlib.blake2b(user_agent.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def get_or_classify(self, user_agent, classify):
+        """Return the cached tuple for ``user_agent``, computing it with ``classify`` on a miss"""
+        if self.maxsize <= 0:
+            return classify(user_agent)
+
+        key = self.key(user_agent)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        # Classify outside the lock; a concurrent miss for the same UA is harmless
+        result = classify(user_agent)
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+cache = UserAgentCache(get_cache_size())
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    if setting == 'ANALYTICS_UA_CACHE_SIZE':
+        cache.maxsize = get_cache_size()
+    if setting == 'ANALYTICS_UA_CACHE_SIZE' or setting in MATCHER_SETTINGS:
+        cache.clear()
@@ -1,10 +1,17 @@
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.db.models import Count, Q
-from django.db.models.functions import TruncDate, TruncHour
 from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods, require_POST
 from datetime import timedelta
-from .models import PageView, Event, BotVisit
+from .models import Event, BotVisit, Funnel
+from . import beacon, enrich, export, funnels, ingest, query, realtime, rollups, sketches, useragent, visitor, visits
+
+# Max rollup batches (per source) folded in synchronously when the dashboard loads
+DASHBOARD_ROLLUP_BATCHES = 5
 
 
 def is_staff(user):
@@ -14,134 +21,108 @@ def is_staff(user):
 @login_required
 @user_passes_test(is_staff)
 def analytics_dashboard(request):
-    """Main analytics dashboard - staff only"""
+    """Main analytics dashboard - staff only, served from pre-aggregated rollups"""
+    
+    # Catch-up is left to the scheduled commands unless explicitly enabled (bounded work)
+    if getattr(settings, 'ANALYTICS_ROLLUP_ON_DASHBOARD', False):
+        if enrich.get_geo_mode() == enrich.DEFERRED:
+            # Only offline lookups here; network resolvers are left to enrich_geo
+            resolver = enrich.get_resolver()
+            if not getattr(resolver, 'uses_network', True):
+                enrich.enrich_pageviews(max_batches=DASHBOARD_ROLLUP_BATCHES, resolver=resolver)
+        rollups.update_rollups(max_batches=DASHBOARD_ROLLUP_BATCHES)
+        visits.update_visits(max_batches=DASHBOARD_ROLLUP_BATCHES)
+        # New and edited funnels are left to build_funnels, which backfills them
+        funnels.update_funnels(backfill=False)
     
     # Time ranges
     now = timezone.now()
-    today = now.date()
+    today = rollups.bucket_start(now, rollups.DAY)
     yesterday = today - timedelta(days=1)
     week_ago = now - timedelta(days=7)
     month_ago = now - timedelta(days=30)
+    site = rollups.SITE
     
     # Total stats
-    total_views = PageView.objects.count()
-    total_visitors = PageView.objects.values('session_key').distinct().count()
-    total_events = Event.objects.count()
+    total_views = rollups.total(site)
+    total_visitors = rollups.total(site, 'new_sessions')
+    total_events = rollups.total('event_type')
+    
+    # Unique visitors come from merged per-day HyperLogLog sketches
+    today_date = today.date()
+    yesterday_date = yesterday.date()
+    week_start_date = timezone.localtime(week_ago).date()
+    month_start_date = timezone.localtime(month_ago).date()
     
     # Today's stats
-    today_views = PageView.objects.filter(timestamp__date=today).count()
-    today_visitors = PageView.objects.filter(timestamp__date=today).values('session_key').distinct().count()
+    today_views = rollups.total(site, since=today)
+    today_visitors = sketches.unique_visitors(today_date, today_date)
     
     # Yesterday's stats
-    yesterday_views = PageView.objects.filter(timestamp__date=yesterday).count()
-    yesterday_visitors = PageView.objects.filter(timestamp__date=yesterday).values('session_key').distinct().count()
+    yesterday_views = rollups.total(site, since=yesterday, until=today)
+    yesterday_visitors = sketches.unique_visitors(yesterday_date, yesterday_date)
     
-    # Week stats
-    week_views = PageView.objects.filter(timestamp__gte=week_ago).count()
-    week_visitors = PageView.objects.filter(timestamp__gte=week_ago).values('session_key').distinct().count()
+    # Week stats (views from hourly buckets)
+    week_views = rollups.total(site, granularity=rollups.HOUR, since=week_ago)
+    week_visitors = sketches.unique_visitors(week_start_date, today_date)
     
     # Month stats
-    month_views = PageView.objects.filter(timestamp__gte=month_ago).count()
-    month_visitors = PageView.objects.filter(timestamp__gte=month_ago).values('session_key').distinct().count()
-    
-    # Top pages (last 30 days)
-    top_pages = PageView.objects.filter(
-        timestamp__gte=month_ago
-    ).values('path', 'page_title').annotate(
-        views=Count('id')
-    ).order_by('-views')[:10]
-    
-    # Traffic by day (last 30 days)
-    daily_traffic = PageView.objects.filter(
-        timestamp__gte=month_ago
-    ).annotate(
-        date=TruncDate('timestamp')
-    ).values('date').annotate(
-        views=Count('id'),
-        visitors=Count('session_key', distinct=True)
-    ).order_by('date')
-    
-    # Traffic by hour (last 24 hours)
-    hourly_traffic = PageView.objects.filter(
-        timestamp__gte=now - timedelta(hours=24)
-    ).annotate(
-        hour=TruncHour('timestamp')
-    ).values('hour').annotate(
-        views=Count('id')
-    ).order_by('hour')
+    month_views = rollups.total(site, granularity=rollups.HOUR, since=month_ago)
+    month_visitors = sketches.unique_visitors(month_start_date, today_date)
+    
+    # Top pages (last 30 days, from the per-day heavy-hitter sketches)
+    top_pages = [
+        {'path': row['value'], 'page_title': row['label'], 'views': row['count']}
+        for row in sketches.top_items('path', month_start_date, today_date)
+    ]
+    
+    # Visit metrics (last 30 days, from the sessionized Visit table)
+    visit_stats = visits.visit_stats(since=month_ago)
+    visit_stats['avg_duration_display'] = format_duration(visit_stats['avg_duration'])
+    top_entry_pages = visits.top_paths('entry_path', since=month_ago)
+    top_exit_pages = visits.top_paths('exit_path', since=month_ago)
+    
+    # Funnel conversion (last 30 days, from per-day FunnelResult rows)
+    funnel_reports = [
+        funnels.funnel_report(funnel, month_start_date) for funnel in Funnel.objects.filter(is_active=True)
+    ]
     
     # Browser stats
-    browser_stats = PageView.objects.filter(
-        timestamp__gte=month_ago
-    ).values('browser').annotate(
-        count=Count('id')
-    ).order_by('-count')[:5]
+    browser_stats = _top('browser', 'browser', month_ago, limit=5)
     
     # Device stats
-    device_stats = PageView.objects.filter(
-        timestamp__gte=month_ago
-    ).values('device').annotate(
-        count=Count('id')
-    ).order_by('-count')
+    device_stats = _top('device', 'device', month_ago, limit=None)
     
     # OS stats
-    os_stats = PageView.objects.filter(
-        timestamp__gte=month_ago
-    ).values('os').annotate(
-        count=Count('id')
-    ).order_by('-count')[:5]
+    os_stats = _top('os', 'os', month_ago, limit=5)
     
     # Top referrers
-    top_referrers = PageView.objects.filter(
-        timestamp__gte=month_ago,
-        referrer_domain__isnull=False
-    ).exclude(
-        referrer_domain=''
-    ).exclude(
-        referrer_domain__contains='krixx.pythonanywhere.com'
-    ).values('referrer_domain').annotate(
-        count=Count('id')
-    ).order_by('-count')[:10]
+    top_referrers = _top_sketch(
+        'referrer', 'referrer_domain', month_start_date, today_date,
+        exclude=[''], exclude_contains=['krixx.pythonanywhere.com'],
+    )
     
     # Geographic stats - Top countries
-    top_countries = PageView.objects.filter(
-        timestamp__gte=month_ago,
-        country__isnull=False
-    ).exclude(
-        country=''
-    ).exclude(
-        country='Local'
-    ).values('country', 'country_code').annotate(
-        count=Count('id')
-    ).order_by('-count')[:10]
+    top_countries = _top('country', 'country', month_ago, label_key='country_code', exclude=['', 'Local'])
     
     # Top cities
-    top_cities = PageView.objects.filter(
-        timestamp__gte=month_ago,
-        city__isnull=False
-    ).exclude(
-        city=''
-    ).exclude(
-        city='Local'
-    ).values('city', 'country').annotate(
-        count=Count('id')
-    ).order_by('-count')[:10]
+    top_cities = _top_sketch('city', 'city', month_start_date, today_date, label_key='country', exclude=['', 'Local'])
     
     # Recent events
     recent_events = Event.objects.select_related('user').order_by('-timestamp')[:20]
     
     # Bot statistics
-    total_bots = BotVisit.objects.count()
-    today_bots = BotVisit.objects.filter(timestamp__date=today).count()
-    week_bots = BotVisit.objects.filter(timestamp__gte=week_ago).count()
-    month_bots = BotVisit.objects.filter(timestamp__gte=month_ago).count()
+    total_bots = rollups.total('bot_type')
+    today_bots = rollups.total('bot_type', since=today)
+    week_bots = rollups.total('bot_type', granularity=rollups.HOUR, since=week_ago)
+    month_bots = rollups.total('bot_type', granularity=rollups.HOUR, since=month_ago)
     
     # Top bot types (last 30 days)
-    top_bots = BotVisit.objects.filter(
-        timestamp__gte=month_ago
-    ).values('bot_type').annotate(
-        count=Count('id')
-    ).order_by('-count')[:10]
+    top_bots = _top('bot_type', 'bot_type', month_ago)
+    
+    # Heaviest bot IPs and paths (unbounded cardinality, so from sketches)
+    top_bot_ips = sketches.top_items('bot_ip', month_start_date, today_date)
+    top_bot_paths = sketches.top_items('bot_path', month_start_date, today_date)
     
     # Recent bot visits
     recent_bots = BotVisit.objects.order_by('-timestamp')[:20]
@@ -170,16 +151,23 @@ def analytics_dashboard(request):
         'month_views': month_views,
         'month_visitors': month_visitors,
         
-        # Charts data
+        # Visits
+        'visit_stats': visit_stats,
+        'top_entry_pages': top_entry_pages,
+        'top_exit_pages': top_exit_pages,
+        'funnel_reports': funnel_reports,
+        
+        # Charts data (traffic series are fetched from the query API)
+        'query_start': month_start_date,
+        'query_hourly_start': yesterday_date,
+        'query_end': today_date,
         'top_pages': top_pages,
-        'daily_traffic': list(daily_traffic),
-        'hourly_traffic': list(hourly_traffic),
-        'browser_stats': list(browser_stats),
-        'device_stats': list(device_stats),
-        'os_stats': list(os_stats),
-        'top_referrers': list(top_referrers),
-        'top_countries': list(top_countries),
-        'top_cities': list(top_cities),
+        'browser_stats': browser_stats,
+        'device_stats': device_stats,
+        'os_stats': os_stats,
+        'top_referrers': top_referrers,
+        'top_countries': top_countries,
+        'top_cities': top_cities,
         'recent_events': recent_events,
         
         # Bot stats
@@ -187,13 +175,188 @@ def analytics_dashboard(request):
         'today_bots': today_bots,
         'week_bots': week_bots,
         'month_bots': month_bots,
-        'top_bots': list(top_bots),
+        'top_bots': top_bots,
+        'top_bot_ips': top_bot_ips,
+        'top_bot_paths': top_bot_paths,
         'recent_bots': recent_bots,
     }
     
     return render(request, 'analytics/dashboard.html', context)
 
 
+@login_required
+@user_passes_test(is_staff)
+def analytics_status(request):
+    """Per-process tracking internals for monitoring - staff only"""
+    return JsonResponse({
+        'ingest': {
+            'mode': ingest.get_ingest_mode(),
+            'buffered': len(ingest.buffer),
+        },
+        'user_agent_cache': useragent.cache.stats(),
+    })
+
+
+@login_required
+@user_passes_test(is_staff)
+def active_visitors_api(request):
+    """Visitors active in the last few minutes, overall and per page - staff only (no DB reads)"""
+    return JsonResponse(realtime.active_visitors())
+
+
+@login_required
+@user_passes_test(is_staff)
+def unique_visitors_api(request):
+    """
+    Estimated unique visitors between two dates - staff only.
+    GET ?start=YYYY-MM-DD&end=YYYY-MM-DD[&path=/blog/] (defaults to the last 30 days)
+    """
+    today = timezone.localdate()
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    try:
+        start = parse_date(start) if start else today - timedelta(days=29)
+        end = parse_date(end) if end else today
+    except ValueError:
+        start = end = None
+    if start is None or end is None:
+        return JsonResponse({'detail': 'start and end must be YYYY-MM-DD dates'}, status=400)
+    if start > end:
+        return JsonResponse({'detail': 'start must not be after end'}, status=400)
+    
+    path = request.GET.get('path', sketches.SITE_PATH)
+    sketch = sketches.merged_sketch(start, end, path)
+    return JsonResponse({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'path': path,
+        'visitors': sketch.count(),
+        'relative_error': round(sketch.relative_error, 4),
+    })
+
+
+@login_required
+@user_passes_test(is_staff)
+def query_api(request):
+    """
+    Time-bucketed metrics from the rollups - staff only (see analytics.query).
+    GET ?metric=pageviews&bucket=day&start=YYYY-MM-DD&end=YYYY-MM-DD
+        [&dimension=country][&filter=country:Ghana][&compare=previous][&limit=10]
+    """
+    try:
+        return JsonResponse(query.run(query.parse_query(request.GET)))
+    except query.QueryError as e:
+        return JsonResponse({'detail': str(e)}, status=400)
+
+
+@login_required
+@user_passes_test(is_staff)
+def export_api(request):
+    """
+    Stream raw analytics rows - staff only.
+    GET ?source=pageview|event|botvisit[&start=YYYY-MM-DD&end=YYYY-MM-DD]
+        [&columns=id,timestamp,path][&format=csv|ndjson][&gzip=1]
+    """
+    source = request.GET.get('source', 'pageview')
+    fmt = request.GET.get('format', export.CSV)
+    compress = request.GET.get('gzip', '').lower() in ('1', 'true', 'yes')
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    try:
+        start = parse_date(start) if start else None
+        end = parse_date(end) if end else None
+        chunks = export.stream(source, fmt, request.GET.get('columns'), start, end, compress)
+    except ValueError as e:  # bad dates or ExportError
+        return JsonResponse({'detail': str(e)}, status=400)
+    
+    response = StreamingHttpResponse(
+        chunks, content_type='application/gzip' if compress else export.FORMATS[fmt]
+    )
+    response['Content-Disposition'] = f'attachment; filename="{export.filename(source, fmt, start, end, compress)}"'
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+@csrf_exempt
+@require_POST
+def collect_events(request):
+    """Batched client-side events from static/js/analytics.js (see analytics.beacon)"""
+    if beacon.is_ignored(request):
+        return HttpResponse(status=204)
+    
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'detail': 'invalid Content-Length'}, status=400)
+    if content_length > beacon.get_max_bytes():
+        return JsonResponse({'detail': 'payload too large'}, status=413)
+    try:
+        items = beacon.parse_batch(request.body)
+    except beacon.BeaconError as e:
+        return JsonResponse({'detail': str(e)}, status=400)
+    
+    analytics_visitor = visitor.get_visitor(request)
+    accepted, rejected = beacon.store_batch(request, items, analytics_visitor.id)
+    response = JsonResponse({'accepted': accepted, 'rejected': rejected}, status=202)
+    visitor.set_visitor_cookie(response, analytics_visitor)
+    return response
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def track_pageview(request):
+    """Page view beacon from static/js/analytics.js: POST JSON, or GET for the pixel"""
+    pixel = request.method == 'GET'
+    try:
+        fields = beacon.parse_pageview(request)
+    except beacon.BeaconError as e:
+        if not pixel:
+            return JsonResponse({'detail': str(e)}, status=400)
+        fields = None
+    
+    analytics_visitor = None
+    if fields is not None:
+        try:
+            analytics_visitor = beacon.record_pageview(request, *fields)
+        except Exception:
+            pass  # Same as the middleware: never fail the page over analytics
+    
+    if pixel:
+        response = HttpResponse(beacon.PIXEL_GIF, content_type='image/gif')
+        response['Cache-Control'] = 'no-store'
+    else:
+        response = HttpResponse(status=204)
+    if analytics_visitor is not None:
+        visitor.set_visitor_cookie(response, analytics_visitor)
+    return response
+
+
+def _top(dimension, key, since, limit=10, label_key=None, exclude=(), exclude_contains=()):
+    """Top rollup values shaped like the old ``.values(key).annotate(count=...)`` rows"""
+    rows = rollups.top_values(
+        dimension, since=since, limit=limit, exclude=exclude, exclude_contains=exclude_contains
+    )
+    result = []
+    for row in rows:
+        item = {key: row['value'], 'count': row['count']}
+        if label_key:
+            item[label_key] = row['label']
+        result.append(item)
+    return result
+
+
+def _top_sketch(dimension, key, start, end, limit=10, label_key=None, exclude=(), exclude_contains=()):
+    """Like ``_top`` but from the heavy-hitter sketches (approximate, bounded cost)"""
+    rows = sketches.top_items(dimension, start, end, limit=limit, exclude=exclude, exclude_contains=exclude_contains)
+    result = []
+    for row in rows:
+        item = {key: row['value'], 'count': row['count']}
+        if label_key:
+            item[label_key] = row['label']
+        result.append(item)
+    return result
+
+
 def calculate_growth(current, previous):
     """Calculate percentage growth"""
     if previous == 0:
@@ -201,6 +364,12 @@ def calculate_growth(current, previous):
     return round(((current - previous) / previous) * 100, 1)
 
 
+def format_duration(seconds):
+    """Seconds as e.g. '2m 05s'"""
+    minutes, seconds = divmod(int(seconds), 60)
+    return f'{minutes}m {seconds:02d}s' if minutes else f'{seconds}s'
+
+
 def exclude_from_analytics(request):
     """Page to exclude/include user from analytics tracking"""
     # Check if user is currently excluded
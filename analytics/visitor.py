@@ -0,0 +1,105 @@
+"""
+Anonymous analytics visitor IDs.
+
+Instead of creating a database session for every new visitor, tracked
+responses carry a signed cookie holding a random visitor ID. That ID is what
+PageView.session_key stores.
+
+Policy (all in seconds, see settings):
+
+- ANALYTICS_VISITOR_COOKIE_AGE: cookie lifetime since the visitor was last
+  seen. The cookie is re-signed at most once per ANALYTICS_VISITOR_REFRESH,
+  so active visitors keep their ID while idle ones expire.
+- ANALYTICS_VISITOR_ID_ROTATE: absolute lifetime of an ID; after that a new
+  ID is issued even for active visitors (0 disables rotation).
+
+A missing, tampered or expired cookie simply yields a fresh ID.
+"""
+import re
+import time
+import uuid
+
+from django.conf import settings
+
+SALT = 'analytics.visitor'
+ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def get_cookie_name():
+    return getattr(settings, 'ANALYTICS_VISITOR_COOKIE', 'pg_vid')
+
+
+def get_cookie_age():
+    return int(getattr(settings, 'ANALYTICS_VISITOR_COOKIE_AGE', 180 * 86400))
+
+
+def get_refresh_interval():
+    return int(getattr(settings, 'ANALYTICS_VISITOR_REFRESH', 86400))
+
+
+def get_rotate_after():
+    return int(getattr(settings, 'ANALYTICS_VISITOR_ID_ROTATE', 365 * 86400) or 0)
+
+
+class Visitor:
+    """Visitor ID resolved for one request and whether its cookie must be (re)sent"""
+
+    def __init__(self, visitor_id, issued, touched, is_new=False):
+        self.id = visitor_id
+        self.issued = issued
+        self.touched = touched
+        self.is_new = is_new
+
+    @property
+    def needs_cookie(self):
+        return self.is_new or time.time() - self.touched >= get_refresh_interval()
+
+    def cookie_value(self, now=None):
+        return f'{self.id}:{self.issued}:{int(now or time.time())}'
+
+
+def new_visitor(now=None):
+    now = int(now or time.time())
+    return Visitor(uuid.uuid4().hex, now, now, is_new=True)
+
+
+def parse_cookie_value(value, now=None):
+    """Visitor for a verified cookie value, or None if malformed or rotated out"""
+    try:
+        visitor_id, issued, touched = value.split(':')
+        issued, touched = int(issued), int(touched)
+    except (AttributeError, ValueError):
+        return None
+    if not ID_RE.match(visitor_id):
+        return None
+    rotate_after = get_rotate_after()
+    if rotate_after and (now or time.time()) - issued >= rotate_after:
+        return None
+    return Visitor(visitor_id, issued, touched)
+
+
+def get_visitor(request):
+    """Resolve (and memoize on the request) the analytics visitor"""
+    visitor = getattr(request, 'analytics_visitor', None)
+    if visitor is None:
+        value = request.get_signed_cookie(
+            get_cookie_name(), default=None, salt=SALT, max_age=get_cookie_age()
+        )
+        visitor = (value and parse_cookie_value(value)) or new_visitor()
+        request.analytics_visitor = visitor
+    return visitor
+
+
+def set_visitor_cookie(response, visitor):
+    """Attach the signed visitor cookie if it is new or due for a refresh"""
+    if not visitor.needs_cookie:
+        return
+    response.set_signed_cookie(
+        get_cookie_name(),
+        visitor.cookie_value(),
+        salt=SALT,
+        max_age=get_cookie_age(),
+        secure=getattr(settings, 'SESSION_COOKIE_SECURE', False),
+        httponly=True,
+        samesite='Lax',
+    )
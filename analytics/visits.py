@@ -0,0 +1,182 @@
+"""
+Incremental sessionization of page views into Visit rows.
+
+A visit is one visitor's (``session_key``) run of page views with no gap
+longer than ANALYTICS_VISIT_TIMEOUT minutes (default 30). update_visits()
+reads page views past the ``visits:pageview`` AggregationWatermark in id
+order and bounded batches, extends each visitor's most recent visit when the
+new view falls within the timeout of it and starts a new one otherwise, then
+advances the watermark in the same transaction.
+
+Visit stores only what visit-level metrics need (start, end, duration, page
+count, entry/exit path, entry referrer, country), so bounce rate,
+pages per visit and entry/exit pages are indexed queries on a table that is
+much smaller than PageView. Like the rollups, visits only see page views the
+geo enrichment job has already passed when ANALYTICS_GEO_MODE is deferred.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, Q, Sum
+
+from . import enrich
+from .models import AggregationWatermark, PageView, Visit
+
+WATERMARK = 'visits:pageview'
+FIELDS = ['id', 'timestamp', 'session_key', 'path', 'referrer_domain', 'country']
+
+# Chunk size for session_key__in lookups (stays under SQLite's variable limit)
+IN_CHUNK = 500
+
+
+def get_visit_timeout():
+    """Inactivity gap that ends a visit"""
+    return timedelta(minutes=max(1, int(getattr(settings, 'ANALYTICS_VISIT_TIMEOUT', 30) or 1)))
+
+
+def get_batch_size():
+    return max(1, int(getattr(settings, 'ANALYTICS_ROLLUP_BATCH_SIZE', 5000) or 1))
+
+
+def _open_visits(session_keys, since):
+    """{session_key: latest visit ending at or after ``since``}"""
+    keys = list(session_keys)
+    latest = {}
+    for i in range(0, len(keys), IN_CHUNK):
+        for visit in Visit.objects.filter(session_key__in=keys[i:i + IN_CHUNK], end__gte=since).order_by('end'):
+            latest[visit.session_key] = visit
+    return latest
+
+
+def _start_visit(view):
+    return Visit(
+        session_key=view['session_key'],
+        start=view['timestamp'],
+        end=view['timestamp'],
+        page_count=1,
+        entry_path=view['path'][:500],
+        exit_path=view['path'][:500],
+        referrer_domain=view['referrer_domain'][:200],
+        country=view['country'],
+    )
+
+
+def _extend_visit(visit, view):
+    ts = view['timestamp']
+    if ts < visit.start:
+        # A late-arriving earlier view becomes the entry page
+        visit.start = ts
+        visit.entry_path = view['path'][:500]
+        visit.referrer_domain = view['referrer_domain'][:200]
+    if ts >= visit.end:
+        visit.end = ts
+        visit.exit_path = view['path'][:500]
+    visit.page_count += 1
+    visit.country = visit.country or view['country']
+    visit.duration = int((visit.end - visit.start).total_seconds())
+
+
+def fold_pageviews(rows, timeout):
+    """Apply one batch of page view rows to the Visit table (call inside a transaction)"""
+    by_visitor = defaultdict(list)
+    for row in rows:
+        by_visitor[row['session_key']].append(row)
+    earliest = min(row['timestamp'] for row in rows)
+    visits = _open_visits(by_visitor, earliest - timeout)
+
+    to_create, to_update = [], {}
+    for session_key, views in by_visitor.items():
+        visit = visits.get(session_key)
+        for view in sorted(views, key=lambda v: (v['timestamp'], v['id'])):
+            ts = view['timestamp']
+            if visit is not None and visit.start - timeout <= ts <= visit.end + timeout:
+                _extend_visit(visit, view)
+                if visit.pk:
+                    to_update[visit.pk] = visit
+            else:
+                visit = _start_visit(view)
+                to_create.append(visit)
+
+    Visit.objects.bulk_create(to_create)
+    Visit.objects.bulk_update(
+        list(to_update.values()),
+        ['start', 'end', 'duration', 'page_count', 'entry_path', 'exit_path', 'referrer_domain', 'country'],
+    )
+
+
+def update_visits(batch_size=None, max_batches=None):
+    """
+    Sessionize page views newer than the watermark.
+
+    ``max_batches`` bounds the work (None = catch up fully).
+    Returns the number of page views processed.
+    """
+    batch_size = batch_size or get_batch_size()
+    timeout = get_visit_timeout()
+    max_id = enrich.enriched_max_id() if enrich.get_geo_mode() == enrich.DEFERRED else None
+    processed = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            watermark, _ = AggregationWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+            qs = PageView.objects.filter(id__gt=watermark.last_id)
+            if max_id is not None:
+                qs = qs.filter(id__lte=max_id)
+            rows = list(qs.order_by('id').values(*FIELDS)[:batch_size])
+            if not rows:
+                break
+            fold_pageviews(rows, timeout)
+            watermark.last_id = rows[-1]['id']
+            watermark.save(update_fields=['last_id', 'updated_at'])
+        processed += len(rows)
+        batches += 1
+        if len(rows) < batch_size:
+            break
+    return processed
+
+
+def reset_visits():
+    """Drop all visits and the watermark so the next update rebuilds from raw rows"""
+    with transaction.atomic():
+        Visit.objects.all().delete()
+        AggregationWatermark.objects.filter(name=WATERMARK).delete()
+
+
+# Read helpers ---------------------------------------------------------------
+
+def visits_between(since=None, until=None):
+    qs = Visit.objects.all()
+    if since is not None:
+        qs = qs.filter(start__gte=since)
+    if until is not None:
+        qs = qs.filter(start__lt=until)
+    return qs
+
+
+def visit_stats(since=None, until=None):
+    """{visits, bounce_rate (%), pages_per_visit, avg_duration (seconds)} for visits starting in range"""
+    totals = visits_between(since, until).aggregate(
+        visits=Count('id'),
+        bounces=Count('id', filter=Q(page_count=1)),
+        pages=Sum('page_count'),
+        duration=Avg('duration'),
+    )
+    count = totals['visits']
+    return {
+        'visits': count,
+        'bounce_rate': round(totals['bounces'] / count * 100, 1) if count else 0,
+        'pages_per_visit': round(totals['pages'] / count, 2) if count else 0,
+        'avg_duration': int(totals['duration'] or 0),
+    }
+
+
+def top_paths(field, since=None, until=None, limit=10):
+    """Most common entry or exit paths: [{path, visits}]"""
+    if field not in ('entry_path', 'exit_path'):
+        raise ValueError(f'Unknown visit path field {field!r}')
+    return [
+        {'path': row[field], 'visits': row['visits']}
+        for row in visits_between(since, until).values(field).annotate(visits=Count('id')).order_by('-visits', field)[:limit]
+    ]
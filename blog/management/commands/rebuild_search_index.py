@@ -0,0 +1,18 @@
+"""
+Management command to rebuild the blog full-text search index from the Post table.
+Run with: python manage.py rebuild_search_index
+"""
+from django.core.management.base import BaseCommand
+
+from blog import search
+
+
+class Command(BaseCommand):
+    help = 'Drops and refills the full-text search index for blog posts'
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        count = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {count} posts ({backend.vendor or "no full-text backend; using icontains"})'
+        ))
@@ -0,0 +1,69 @@
+import html
+
+from django.db import migrations
+from django.utils.html import strip_tags
+
+# The index as this migration created it; kept here so later changes to
+# blog/search.py don't alter it
+FTS_TABLE = "blog_post_fts"
+PG_TABLE = "blog_post_search"
+
+
+def plain_text(value):
+    return html.unescape(strip_tags(value or "")).replace("\x02", "").replace("\x03", "")
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in ("sqlite", "postgresql"):
+        return
+    Post = apps.get_model("blog", "Post")
+    with schema_editor.connection.cursor() as cursor:
+        if vendor == "sqlite":
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                "title, body, tags, categories, status UNINDEXED, tokenize='porter unicode61')"
+            )
+        else:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {PG_TABLE} ("
+                "post_id bigint PRIMARY KEY REFERENCES blog_post (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+                "status varchar(12) NOT NULL, body text NOT NULL, document tsvector NOT NULL)"
+            )
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {PG_TABLE}_document ON {PG_TABLE} USING GIN (document)")
+
+        for post in Post.objects.prefetch_related("tags", "categories").iterator(chunk_size=500):
+            title, body = post.title, plain_text(post.content)
+            tags = " ".join(t.name for t in post.tags.all())
+            categories = " ".join(c.name for c in post.categories.all())
+            if vendor == "sqlite":
+                cursor.execute(
+                    f"INSERT INTO {FTS_TABLE} (rowid, title, body, tags, categories, status) VALUES (%s, %s, %s, %s, %s, %s)",
+                    [post.pk, title, body, tags, categories, post.status],
+                )
+            else:
+                cursor.execute(
+                    f"INSERT INTO {PG_TABLE} (post_id, status, body, document) VALUES (%s, %s, %s, "
+                    "setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'B') "
+                    "|| setweight(to_tsvector('english', %s), 'B') || setweight(to_tsvector('english', %s), 'D'))",
+                    [post.pk, post.status, body, title, tags, categories, body],
+                )
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    table = {"sqlite": FTS_TABLE, "postgresql": PG_TABLE}.get(vendor)
+    if table:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("blog", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,308 @@
+"""
+Full-text search index for blog posts.
+
+The backend is picked from the database vendor:
+
+- SQLite: an FTS5 virtual table ``blog_post_fts`` (porter stemming), ranked
+  with bm25() and excerpted with snippet()
+- PostgreSQL: a ``blog_post_search`` table holding a weighted ``tsvector``
+  with a GIN index, ranked with ts_rank_cd() and excerpted with ts_headline()
+- anything else: the old ``icontains`` scan, without ranking or snippets
+
+Each indexed row holds a post's title, plain-text body, tag names and
+category names. Rows are written in the same transaction as the change that
+caused them (Post save/delete, tag or category M2M changes, tag or category
+renames and deletes), so the index can't drift from the tables. Rebuild it
+with ``python manage.py rebuild_search_index``; the rebuild runs in one
+transaction, so searches meanwhile keep seeing the old index.
+"""
+import html
+import re
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils.html import escape, strip_tags
+
+from .models import Category, Post, Tag
+
+FTS_TABLE = "blog_post_fts"
+PG_TABLE = "blog_post_search"
+
+# Relative weight of matches in each column: title, body, tags, categories
+BM25_WEIGHTS = (10.0, 1.0, 4.0, 4.0)
+
+# Highlight markers swapped for <mark> after the snippet is HTML-escaped
+MARK_START = "\x02"
+MARK_END = "\x03"
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def plain_text(value):
+    """Post HTML as searchable text"""
+    return html.unescape(strip_tags(value or "")).replace(MARK_START, "").replace(MARK_END, "")
+
+
+def highlight(snippet):
+    """Escape an index snippet and turn its markers into <mark> tags"""
+    return escape(snippet or "").replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+
+def document(post, tag_names=None, category_names=None):
+    """(title, body, tags, categories) as stored in the index"""
+    if tag_names is None:
+        tag_names = post.tags.values_list("name", flat=True)
+    if category_names is None:
+        category_names = post.categories.values_list("name", flat=True)
+    return (post.title, plain_text(post.content), " ".join(tag_names), " ".join(category_names))
+
+
+class FallbackBackend:
+    """Unranked icontains scan for databases without a supported full-text index"""
+
+    vendor = None
+
+    def create(self, conn):
+        pass
+
+    def drop(self, conn):
+        pass
+
+    def index(self, conn, post_id, status, doc):
+        pass
+
+    def remove(self, conn, post_ids):
+        pass
+
+    @staticmethod
+    def within_sql(within):
+        """``within`` (a Post queryset) as an id subquery and its params"""
+        sql, params = within.order_by().values("pk").query.sql_with_params()
+        return f"({sql})", list(params)
+
+    def search(self, conn, query, limit, published_only, within=None):
+        qs = Post.objects.filter(
+            Q(title__icontains=query)
+            | Q(content__icontains=query)
+            | Q(tags__name__icontains=query)
+            | Q(categories__name__icontains=query)
+        ).distinct()
+        if published_only:
+            qs = qs.filter(status=Post.Status.PUBLISHED)
+        if within is not None:
+            qs = qs.filter(pk__in=within.order_by().values("pk"))
+        ids = qs.order_by("-published_at", "-id").values_list("id", flat=True)
+        return [(post_id, 0.0, "") for post_id in (ids[:limit] if limit else ids)]
+
+
+class SQLiteBackend(FallbackBackend):
+    vendor = "sqlite"
+
+    def create(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                "title, body, tags, categories, status UNINDEXED, tokenize='porter unicode61')"
+            )
+
+    def drop(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+    def index(self, conn, post_id, status, doc):
+        with conn.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [post_id])
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, body, tags, categories, status) VALUES (%s, %s, %s, %s, %s, %s)",
+                [post_id, *doc, status],
+            )
+
+    def remove(self, conn, post_ids):
+        with conn.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [[post_id] for post_id in post_ids])
+
+    @staticmethod
+    def match_expression(query):
+        """User input as an FTS5 query: every word must match, the last one as a prefix"""
+        tokens = TOKEN_RE.findall(query)
+        if not tokens:
+            return None
+        quoted = ['"%s"' % token for token in tokens]
+        quoted[-1] += "*"
+        return " ".join(quoted)
+
+    def search(self, conn, query, limit, published_only, within=None):
+        expression = self.match_expression(query)
+        if expression is None:
+            return []
+        weights = ", ".join(str(weight) for weight in BM25_WEIGHTS)
+        sql = (
+            f"SELECT rowid, bm25({FTS_TABLE}, {weights}) AS rank, "
+            f"snippet({FTS_TABLE}, 1, %s, %s, '...', 16) "
+            f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+        )
+        params = [MARK_START, MARK_END, expression]
+        if published_only:
+            sql += " AND status = %s"
+            params.append(Post.Status.PUBLISHED)
+        if within is not None:
+            subquery, subparams = self.within_sql(within)
+            sql += f" AND rowid IN {subquery}"
+            params.extend(subparams)
+        sql += " ORDER BY rank"
+        if limit:
+            sql += " LIMIT %s"
+            params.append(limit)
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            # bm25() is lower-is-better; report higher-is-better like Postgres
+            return [(post_id, -rank, snippet) for post_id, rank, snippet in cursor.fetchall()]
+
+
+class PostgresBackend(FallbackBackend):
+    vendor = "postgresql"
+
+    def create(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {PG_TABLE} ("
+                "post_id bigint PRIMARY KEY REFERENCES blog_post (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+                "status varchar(12) NOT NULL, body text NOT NULL, document tsvector NOT NULL)"
+            )
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {PG_TABLE}_document ON {PG_TABLE} USING GIN (document)")
+
+    def drop(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {PG_TABLE}")
+
+    def index(self, conn, post_id, status, doc):
+        title, body, tags, categories = doc
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {PG_TABLE} (post_id, status, body, document) VALUES (%s, %s, %s, "
+                "setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'B') "
+                "|| setweight(to_tsvector('english', %s), 'B') || setweight(to_tsvector('english', %s), 'D')) "
+                "ON CONFLICT (post_id) DO UPDATE SET status = EXCLUDED.status, body = EXCLUDED.body, "
+                "document = EXCLUDED.document",
+                [post_id, status, body, title, tags, categories, body],
+            )
+
+    def remove(self, conn, post_ids):
+        with conn.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {PG_TABLE} WHERE post_id = ANY(%s)", [list(post_ids)])
+
+    def search(self, conn, query, limit, published_only, within=None):
+        where = "document @@ query" + (" AND status = %s" if published_only else "")
+        params = [query] + ([Post.Status.PUBLISHED] if published_only else [])
+        if within is not None:
+            subquery, subparams = self.within_sql(within)
+            where += f" AND post_id IN {subquery}"
+            params += subparams
+        # Rank over the GIN matches first, then build headlines for the page only
+        sql = (
+            "SELECT post_id, rank, ts_headline('english', body, query, %s) FROM ("
+            f"SELECT post_id, body, query, ts_rank_cd(document, query) AS rank "
+            f"FROM {PG_TABLE}, websearch_to_tsquery('english', %s) AS query WHERE {where} "
+            "ORDER BY rank DESC" + (" LIMIT %s" if limit else "") + ") AS hits ORDER BY rank DESC"
+        )
+        options = f"StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=30, MinWords=12"
+        params = [options] + params + ([limit] if limit else [])
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+BACKENDS = {backend.vendor: backend for backend in (SQLiteBackend(), PostgresBackend())}
+
+
+def get_backend(conn=None):
+    return BACKENDS.get((conn or connection).vendor, FallbackBackend())
+
+
+def index_post(post):
+    get_backend().index(connection, post.pk, post.status, document(post))
+
+
+def index_posts(post_ids):
+    posts = Post.objects.filter(pk__in=list(post_ids)).prefetch_related("tags", "categories")
+    backend = get_backend()
+    for post in posts:
+        doc = document(post, [t.name for t in post.tags.all()], [c.name for c in post.categories.all()])
+        backend.index(connection, post.pk, post.status, doc)
+
+
+def rebuild_index(batch_size=500):
+    """Drop and refill the index from the Post table; returns posts indexed"""
+    backend = get_backend()
+    with transaction.atomic():
+        backend.drop(connection)
+        backend.create(connection)
+        ids = list(Post.objects.order_by("id").values_list("id", flat=True))
+        for start in range(0, len(ids), batch_size):
+            index_posts(ids[start:start + batch_size])
+    return len(ids)
+
+
+def search_posts(query, limit=10, published_only=True, within=None):
+    """
+    [(post id, rank, highlighted snippet HTML)], best match first; ``within``
+    (a Post queryset) restricts the hits to its posts before the limit.
+    """
+    query = (query or "").strip()
+    if not query:
+        return []
+    return [
+        (post_id, rank, highlight(snippet))
+        for post_id, rank, snippet in get_backend().search(connection, query, limit, published_only, within)
+    ]
+
+
+# Keep the index in sync ----------------------------------------------------------
+
+@receiver(post_save, sender=Post)
+def _post_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def _post_deleted(sender, instance, **kwargs):
+    get_backend().remove(connection, [instance.pk])
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+@receiver(m2m_changed, sender=Post.categories.through)
+def _post_terms_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        # tag.posts.clear(): remember the posts before the links are gone
+        instance._search_post_ids = list(instance.posts.values_list("id", flat=True))
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        index_post(instance)
+    elif action == "post_clear":
+        index_posts(getattr(instance, "_search_post_ids", []))
+    else:
+        index_posts(pk_set or [])
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Category)
+def _term_saved(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        index_posts(instance.posts.values_list("id", flat=True))
+
+
+@receiver(pre_delete, sender=Tag)
+@receiver(pre_delete, sender=Category)
+def _term_deleting(sender, instance, **kwargs):
+    instance._search_post_ids = list(instance.posts.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Category)
+def _term_deleted(sender, instance, **kwargs):
+    index_posts(getattr(instance, "_search_post_ids", []))
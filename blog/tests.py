@@ -1,7 +1,16 @@
-from django.test import TestCase
+import os
+import tempfile
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase, override_settings
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
-from .models import Post, Category
+from django.core.cache import cache
+from django.core.management import call_command
+from . import search, tts
+from .models import Post, Category, Tag
 
 
 class BlogApiTests(TestCase):
@@ -46,4 +55,181 @@ class BlogApiTests(TestCase):
         r2 = self.client.post(f"/api/blog/comments/{cid}/moderate/", {"action": "approve"}, format="json")
         self.assertIn(r2.status_code, (200, 403))
 
-# Create your tests here.
+
+class PostSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        User = get_user_model()
+        self.author = User.objects.create_user(username="writer", email="w@example.com", password="pass12345")
+
+    def make_post(self, title, content="", status=Post.Status.PUBLISHED, tags=()):
+        post = Post.objects.create(title=title, content=content, status=status, author=self.author)
+        for name in tags:
+            post.tags.add(Tag.objects.get_or_create(name=name)[0])
+        return post
+
+    def ids(self, query, **kwargs):
+        return [post_id for post_id, _, _ in search.search_posts(query, **kwargs)]
+
+    def test_title_matches_rank_above_body_matches(self):
+        body = self.make_post("Study habits", "<p>Notes on <b>python</b> for beginners</p>")
+        title = self.make_post("Python for students", "Getting started")
+        self.assertEqual(self.ids("python"), [title.id, body.id])
+
+    def test_stemming_prefix_and_snippet(self):
+        post = self.make_post("Exams", "<p>Tips for preparing &amp; revising <script>x</script></p>")
+        hits = search.search_posts("prepared")
+        self.assertEqual([hit[0] for hit in hits], [post.id])
+        self.assertIn("<mark>preparing</mark>", hits[0][2])
+        self.assertIn("&amp;", hits[0][2])
+        self.assertEqual(self.ids("revis"), [post.id])
+        self.assertEqual(self.ids('"); DROP TABLE blog_post; --'), [])
+
+    def test_drafts_hidden_unless_requested(self):
+        draft = self.make_post("Draft about robots", status=Post.Status.DRAFT)
+        self.assertEqual(self.ids("robots"), [])
+        self.assertEqual(self.ids("robots", published_only=False), [draft.id])
+        draft.status = Post.Status.PUBLISHED
+        draft.save()
+        self.assertEqual(self.ids("robots"), [draft.id])
+
+    def test_index_follows_tags_and_deletes(self):
+        post = self.make_post("Weekly digest", tags=["chatbots"])
+        self.assertEqual(self.ids("chatbots"), [post.id])
+        tag = Tag.objects.get(name="chatbots")
+        tag.name = "assistants"
+        tag.save()
+        self.assertEqual(self.ids("chatbots"), [])
+        self.assertEqual(self.ids("assistants"), [post.id])
+        tag.posts.clear()
+        self.assertEqual(self.ids("assistants"), [])
+        post.tags.add(tag)
+        category = Category.objects.create(name="Tutoring")
+        category.posts.add(post)
+        self.assertEqual(self.ids("tutoring"), [post.id])
+        category.delete()
+        self.assertEqual(self.ids("tutoring"), [])
+        post.delete()
+        self.assertEqual(self.ids("assistants"), [])
+
+    def test_rebuild_command(self):
+        post = self.make_post("Flashcards", "Spaced repetition")
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {search.FTS_TABLE}")
+        self.assertEqual(self.ids("repetition"), [])
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.ids("repetition"), [post.id])
+
+    def test_failed_rebuild_keeps_the_old_index(self):
+        post = self.make_post("Flashcards", "Spaced repetition")
+        with patch("blog.search.index_posts", side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            search.rebuild_index()
+        self.assertEqual(self.ids("repetition"), [post.id])
+
+    def test_api_search_uses_index(self):
+        other = self.make_post("Essay writing", "Citing sources with python")
+        best = self.make_post("Python essay tools", "Python helpers")
+        self.make_post("Python draft", status=Post.Status.DRAFT)
+
+        r = self.client.get("/api/blog/posts/?search=python")
+        self.assertEqual([row["id"] for row in r.data["results"]], [best.id, other.id])
+
+        r = self.client.get("/api/search/?q=python&type=posts")
+        posts = r.data["results"]["posts"]
+        self.assertEqual([row["id"] for row in posts], [best.id, other.id])
+        self.assertIn("<mark>", posts[1]["snippet"])
+
+    @override_settings(BLOG_SEARCH_MAX_RESULTS=2)
+    def test_filters_apply_before_the_result_limit(self):
+        for i in range(3):
+            self.make_post(f"Python notes {i}", "Python python python")
+        tagged = self.make_post("Study plan", "Some python", tags=["planning"])
+        tag = Tag.objects.get(name="planning")
+
+        r = self.client.get("/api/blog/posts/", {"search": "python", "tags": tag.id})
+        self.assertEqual([row["id"] for row in r.data["results"]], [tagged.id])
+        r = self.client.get("/api/blog/posts/", {"search": "python"})
+        self.assertEqual(len(r.data["results"]), 2)
+
+
+def fake_synthesize(text, voice, rate, fileobj):
+    data = f"ID3 {voice} {rate} {text}".encode()
+    fileobj.write(data)
+    return len(data)
+
+
+class TextToSpeechCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        override = override_settings(MEDIA_ROOT=self.media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    @patch("blog.tts.synthesize", side_effect=fake_synthesize)
+    def test_audio_is_synthesized_once_and_served_as_a_file(self, synthesize):
+        r1 = self.client.post("/api/blog/tts/", {"text": "<p>Hello   world</p>"}, format="json")
+        r2 = self.client.post("/api/blog/tts/", {"text": "Hello world"}, format="json")
+        self.assertEqual(r1.status_code, 200)
+        self.assertEqual(synthesize.call_count, 1)
+        self.assertFalse(r1.data["cached"])
+        self.assertTrue(r2.data["cached"])
+        self.assertEqual(r1.data["url"], r2.data["url"])
+        self.assertNotIn("audioContent", r2.data)
+
+        audio = self.client.get(r2.data["url"])
+        self.assertEqual(audio.status_code, 200)
+        self.assertEqual(audio["Content-Type"], "audio/mpeg")
+        self.assertEqual(b"".join(audio.streaming_content), b"ID3 en-US-GuyNeural +0% Hello world")
+
+        r3 = self.client.post("/api/blog/tts/", {"text": "Hello world", "rate": "+20%"}, format="json")
+        self.assertNotEqual(r3.data["url"], r1.data["url"])
+        self.assertEqual(synthesize.call_count, 2)
+        self.assertEqual(self.client.get("/api/blog/tts/" + "0" * 64 + ".mp3").status_code, 404)
+
+    @patch("blog.tts.synthesize", side_effect=fake_synthesize)
+    def test_audio_byte_ranges(self, synthesize):
+        url = self.client.post("/api/blog/tts/", {"text": "Hello world"}, format="json").data["url"]
+        body = b"ID3 en-US-GuyNeural +0% Hello world"
+        self.assertEqual(self.client.get(url)["Accept-Ranges"], "bytes")
+
+        os.utime(tts.audio_path(url[-68:-4]), (1, 1))
+        part = self.client.get(url, HTTP_RANGE="bytes=0-2")
+        self.assertEqual(part.status_code, 206)
+        self.assertEqual(b"".join(part.streaming_content), b"ID3")
+        self.assertEqual(part["Content-Range"], f"bytes 0-2/{len(body)}")
+        self.assertEqual(part["Content-Length"], "3")
+        self.assertEqual(b"".join(self.client.get(url, HTTP_RANGE="bytes=-5").streaming_content), b"world")
+        self.assertEqual(b"".join(self.client.get(url, HTTP_RANGE="bytes=30-").streaming_content), body[30:])
+        # Playback doesn't write to the cache; only the POST marks audio as used
+        self.assertEqual(tts.audio_path(url[-68:-4]).stat().st_mtime, 1)
+        self.assertEqual(list(tts.read_range(BytesIO(body), 0, 9, chunk_size=4)), [b"ID3 ", b"en-U", b"S-"])
+        self.assertEqual(self.client.get(url, HTTP_RANGE=f"bytes={len(body)}-").status_code, 416)
+
+    @patch("blog.tts.synthesize", side_effect=fake_synthesize)
+    def test_audio_evicted_after_lookup_is_404(self, synthesize):
+        url = self.client.post("/api/blog/tts/", {"text": "Hello world"}, format="json").data["url"]
+        with patch("blog.views.open", side_effect=FileNotFoundError, create=True):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    @patch("blog.tts.synthesize", return_value=0)
+    def test_empty_audio_is_not_cached(self, synthesize):
+        r = self.client.post("/api/blog/tts/", {"text": "Silence"}, format="json")
+        self.assertEqual(r.status_code, 500)
+        self.assertEqual(r.data["fallback"], "web-speech-api")
+        self.assertEqual(list(tts.get_cache_dir().glob("*/*")), [])
+
+    @patch("blog.tts.synthesize", side_effect=fake_synthesize)
+    def test_least_recently_used_audio_is_evicted(self, synthesize):
+        old, _ = tts.get_or_create("old post")
+        new, _ = tts.get_or_create("new post")
+        os.utime(tts.audio_path(old), (1, 1))
+        tts.lookup(old)  # played again: now the most recent
+        os.utime(tts.audio_path(new), (2, 2))
+        size = tts.audio_path(old).stat().st_size
+        self.assertEqual(tts.evict(max_bytes=size), 1)
+        self.assertIsNotNone(tts.lookup(old))
+        self.assertIsNone(tts.lookup(new))
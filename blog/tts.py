@@ -0,0 +1,212 @@
+"""
+On-disk cache for blog text-to-speech audio.
+
+Audio is stored as ``<MEDIA_ROOT>/<BLOG_TTS_CACHE_DIR>/<ab>/<key>.mp3`` where
+the key is the SHA-256 of (voice, rate, normalized text), so the same post
+read with the same voice is synthesized once and then served as a file.
+
+- Synthesis streams edge-tts chunks straight into a temporary file that is
+  renamed into place, so readers never see partial audio.
+- One request per key synthesizes at a time (a cache.add() lock); concurrent
+  requests for the same audio wait for its file.
+- Asking for a file (the POST that returns its URL) bumps its mtime; when the
+  store grows past BLOG_TTS_CACHE_MAX_BYTES the least recently used files are
+  deleted. Serving the file itself, range by range, writes nothing.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.html import strip_tags
+
+DEFAULT_VOICE = "en-US-GuyNeural"
+VOICES = (
+    "en-US-GuyNeural",  # Deep, professional
+    "en-US-ChristopherNeural",  # Clear, friendly
+    "en-US-AriaNeural",  # Natural, conversational
+    "en-US-JennyNeural",  # Warm, expressive
+)
+DEFAULT_RATE = "+0%"
+RATE_RE = re.compile(r"^[+-]\d{1,2}%$")
+MAX_TEXT_LENGTH = 5000
+
+KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+LOCK_PREFIX = "blog:tts:lock"
+# Seconds one synthesis may hold the lock / others wait for its file
+LOCK_TIMEOUT = 120
+WAIT_STEP = 0.25
+# Bytes read at a time when streaming a range
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+class TTSError(Exception):
+    """Synthesis produced no audio"""
+
+
+def get_cache_dir():
+    return Path(settings.MEDIA_ROOT) / getattr(settings, "BLOG_TTS_CACHE_DIR", "tts_cache")
+
+
+def get_max_bytes():
+    return int(getattr(settings, "BLOG_TTS_CACHE_MAX_BYTES", 500 * 1024 * 1024) or 0)
+
+
+def normalize_text(text):
+    """Text as it is read out: tags dropped, whitespace collapsed, length capped"""
+    text = re.sub(r"\s+", " ", strip_tags(text or "")).strip()
+    if len(text) > MAX_TEXT_LENGTH:
+        text = text[:MAX_TEXT_LENGTH] + "..."
+    return text
+
+
+def clean_voice(voice):
+    return voice if voice in VOICES else DEFAULT_VOICE
+
+
+def clean_rate(rate):
+    return rate if isinstance(rate, str) and RATE_RE.match(rate) else DEFAULT_RATE
+
+
+def audio_key(text, voice=DEFAULT_VOICE, rate=DEFAULT_RATE):
+    return hashlib.sha256(f"{voice}\0{rate}\0{text}".encode("utf-8")).hexdigest()
+
+
+def audio_path(key):
+    if not KEY_RE.match(key or ""):
+        raise ValueError("Invalid audio key")
+    return get_cache_dir() / key[:2] / f"{key}.mp3"
+
+
+def lookup(key):
+    """Path of cached audio (marking it recently used), or None"""
+    if not KEY_RE.match(key or ""):
+        return None
+    path = audio_path(key)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def read_range(fileobj, start, end, chunk_size=RANGE_CHUNK_SIZE):
+    """Yield bytes ``start``-``end`` (inclusive) of ``fileobj`` in bounded reads, then close it"""
+    with fileobj:
+        fileobj.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = fileobj.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def byte_range(header, size):
+    """
+    (start, end) inclusive for a single-range ``Range`` header, or None to
+    send the whole file (no header, or one we don't handle such as
+    multipart ranges). Raises ValueError when the range can't be satisfied.
+    """
+    match = RANGE_RE.match((header or "").strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-N: the last N bytes
+        length = int(last)
+        if not length:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def synthesize(text, voice, rate, fileobj):
+    """Write edge-tts MP3 audio for ``text`` to ``fileobj``; returns bytes written"""
+    import edge_tts
+
+    async def stream():
+        written = 0
+        async for chunk in edge_tts.Communicate(text, voice, rate=rate).stream():
+            if chunk["type"] == "audio":
+                fileobj.write(chunk["data"])
+                written += len(chunk["data"])
+        return written
+
+    return asyncio.run(stream())
+
+
+def _store(key, text, voice, rate):
+    path = audio_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as fileobj:
+            written = synthesize(text, voice, rate, fileobj)
+        if not written:
+            raise TTSError("No audio generated")
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    evict()
+    return path
+
+
+def get_or_create(text, voice=DEFAULT_VOICE, rate=DEFAULT_RATE):
+    """(key, created) for the audio of already normalized ``text``, synthesizing it on a miss"""
+    key = audio_key(text, voice, rate)
+    if lookup(key):
+        return key, False
+    lock = f"{LOCK_PREFIX}:{key}"
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    locked = cache.add(lock, 1, LOCK_TIMEOUT)
+    while not locked and time.monotonic() < deadline:
+        # Someone else is synthesizing this audio
+        time.sleep(WAIT_STEP)
+        if lookup(key):
+            return key, False
+        locked = cache.add(lock, 1, LOCK_TIMEOUT)
+    try:
+        if lookup(key):
+            return key, False
+        _store(key, text, voice, rate)
+        return key, True
+    finally:
+        if locked:
+            cache.delete(lock)
+
+
+def evict(max_bytes=None):
+    """Delete least recently used audio until the store fits ``max_bytes``; returns files deleted"""
+    max_bytes = get_max_bytes() if max_bytes is None else max_bytes
+    if not max_bytes:
+        return 0
+    files = []
+    total = 0
+    for path in get_cache_dir().glob("*/*.mp3"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    deleted = 0
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        deleted += 1
+    return deleted
@@ -13,4 +13,5 @@ urlpatterns = [
     path('comments/<int:comment_id>/moderate/', views.CommentModerateView.as_view(), name='comment-moderate'),
     path('comments/<int:comment_id>/', views.CommentDetailView.as_view(), name='comment-detail'),
     path('tts/', views.BlogTextToSpeechView.as_view(), name='blog-tts'),
+    path('tts/<str:key>.mp3', views.BlogTextToSpeechAudioView.as_view(), name='blog-tts-audio'),
 ]
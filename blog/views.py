@@ -19,6 +19,11 @@ import os
 from django.utils import timezone
 from django.http import HttpResponseForbidden
 from payments.models import BotInstance, PaymentTransaction
+from django.conf import settings
+from django.db.models import Case, IntegerField, When
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from . import search, tts
 
 class CategoryViewSet(viewsets.ModelViewSet):
     queryset = Category.objects.all()
@@ -44,10 +49,30 @@ class TagViewSet(viewsets.ModelViewSet):
         return super().get_permissions()
 
 
+class PostSearchFilter(filters.SearchFilter):
+    """?search= answered from the full-text index, best match first"""
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, "").strip()
+        if not query or search.get_backend().vendor is None:
+            return super().filter_queryset(request, queryset, view)
+        limit = getattr(settings, "BLOG_SEARCH_MAX_RESULTS", 200)
+        # Filters applied before this backend (tags, author, ...) narrow the hits before the limit
+        within = queryset if queryset.query.where else None
+        hits = search.search_posts(
+            query, limit=limit, published_only=getattr(view, "action", None) == "list", within=within
+        )
+        ids = [post_id for post_id, _, _ in hits]
+        if not ids:
+            return queryset.none()
+        rank = Case(*[When(pk=post_id, then=position) for position, post_id in enumerate(ids)], output_field=IntegerField())
+        return queryset.filter(pk__in=ids).annotate(search_position=rank).order_by("search_position")
+
+
 class PostViewSet(viewsets.ModelViewSet):
     queryset = Post.objects.select_related("author").prefetch_related("categories", "tags").all()
     permission_classes = [AllowAny]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, PostSearchFilter, filters.OrderingFilter]
     filterset_fields = ["author", "status", "categories", "tags"]
     search_fields = ["title", "content", "tags__name", "categories__name"]
     ordering_fields = ["published_at", "created_at"]
@@ -344,80 +369,76 @@ class BlogTextToSpeechView(views.APIView):
     Generate natural-sounding audio from blog post text using Microsoft Edge TTS.
     Completely FREE, unlimited usage, no API key required!
     Uses edge-tts library for professional-quality voices.
+
+    Audio is cached on disk by (text, voice, rate) (see blog/tts.py); the
+    response holds the URL of the MP3 rather than the audio itself.
     """
     permission_classes = [AllowAny]
     
     def post(self, request):
-        import re
-        import base64
-        import asyncio
-        
-        text = request.data.get('text', '').strip()
+        text = tts.normalize_text(request.data.get('text', ''))
         if not text:
             return Response({'error': 'No text provided'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Clean HTML tags
-        text = re.sub(r'<[^>]+>', '', text)
-        text = re.sub(r'\s+', ' ', text).strip()
-        
-        # Limit text length for performance (Edge TTS has no hard limit)
-        if len(text) > 5000:
-            text = text[:5000] + '...'
+        voice = tts.clean_voice(request.data.get('voice'))
+        rate = tts.clean_rate(request.data.get('rate'))
         
         try:
-            # Import edge-tts (install with: pip install edge-tts)
-            import edge_tts
-            
-            # Choose voice
-            # Male voices:
-            # 'en-US-GuyNeural' - Deep, professional
-            # 'en-US-ChristopherNeural' - Clear, friendly
-            # Female voices:
-            # 'en-US-AriaNeural' - Natural, conversational
-            # 'en-US-JennyNeural' - Warm, expressive
-            
-            voice = 'en-US-GuyNeural'  # Professional male voice
-            
-            # Generate audio using edge-tts
-            async def generate_audio():
-                communicate = edge_tts.Communicate(text, voice)
-                audio_data = b''
-                async for chunk in communicate.stream():
-                    if chunk["type"] == "audio":
-                        audio_data += chunk["data"]
-                return audio_data
-            
-            # Run async function
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            audio_data = loop.run_until_complete(generate_audio())
-            loop.close()
-            
-            if audio_data:
-                # Convert to base64
-                audio_content = base64.b64encode(audio_data).decode('utf-8')
-                
-                return Response({
-                    'audioContent': audio_content,
-                    'format': 'mp3'
-                })
-            else:
-                return Response({
-                    'error': 'No audio generated',
-                    'fallback': 'web-speech-api'
-                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-                
+            key, created = tts.get_or_create(text, voice, rate)
         except ImportError:
             # edge-tts not installed
             return Response({
                 'error': 'edge-tts library not installed. Run: pip install edge-tts',
                 'fallback': 'web-speech-api'
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except tts.TTSError:
+            return Response({
+                'error': 'No audio generated',
+                'fallback': 'web-speech-api'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         except Exception as e:
             return Response({
                 'error': f'TTS error: {str(e)}',
                 'fallback': 'web-speech-api'
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        
+        return Response({
+            'url': reverse('blog-tts-audio', args=[key]),
+            'format': 'mp3',
+            'cached': not created,
+        })
+
+
+class BlogTextToSpeechAudioView(View):
+    """
+    Cached TTS audio; the URL is content-addressed, so browsers may keep it forever.
+    Honors single byte ranges (206), which Safari/iOS <audio> requires.
+    """
+
+    def get(self, request, key):
+        # No tts.lookup() here: the POST that handed out this URL already marked it used
+        try:
+            audio = open(tts.audio_path(key), 'rb')
+        except (ValueError, FileNotFoundError):
+            # Bad key, or never created / evicted
+            raise Http404('Audio not found')
+        size = os.fstat(audio.fileno()).st_size
+        try:
+            byte_range = tts.byte_range(request.headers.get('Range'), size)
+        except ValueError:
+            audio.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if byte_range is None:
+            response = FileResponse(audio, content_type='audio/mpeg')
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(tts.read_range(audio, start, end), status=206, content_type='audio/mpeg')
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Accept-Ranges'] = 'bytes'
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
 
 
 class CmsPaymentListView(View):
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_asgi_application()
+
+# Load the typeahead index before the first keystroke arrives
+from core import suggest  # noqa: E402
+
+suggest.warm()
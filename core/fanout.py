@@ -0,0 +1,147 @@
+"""
+Run independent search scopes concurrently with a shared time budget.
+
+Scopes go to a process-wide ThreadPoolExecutor of SEARCH_MAX_WORKERS
+threads. Whatever hasn't finished after SEARCH_SCOPE_BUDGET seconds is
+reported as timed out, so a slow scope costs the response at most the budget.
+Worker threads open their own database connections and release them per task
+like a request would.
+
+A scope is only submitted when a worker is free; when all of them are busy
+it runs in the calling thread instead of queueing behind slow scopes, within
+what is left of the budget. Each scope's queries run under a statement timeout of the budget (PostgreSQL
+``statement_timeout``, an SQLite progress handler), so a scope that overruns
+is aborted and gives its thread back.
+
+Inside a transaction the scopes run one after another in the calling thread:
+other connections can't see its uncommitted rows.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, suppress
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, close_old_connections, connection
+from django.dispatch import receiver
+
+_executor = None
+_slots = None
+_executor_lock = threading.Lock()
+
+
+def get_budget():
+    return float(getattr(settings, "SEARCH_SCOPE_BUDGET", 2.0) or 0)
+
+
+def get_executor():
+    global _executor, _slots
+    with _executor_lock:
+        if _executor is None:
+            workers = max(1, int(getattr(settings, "SEARCH_MAX_WORKERS", 4) or 1))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search")
+            # One slot per worker thread: nothing ever waits in the executor's queue
+            _slots = threading.BoundedSemaphore(workers)
+    return _executor
+
+
+@contextmanager
+def statement_timeout(seconds):
+    """
+    Abort this thread's queries once ``seconds`` have passed (PostgreSQL and
+    SQLite). Applied at the first query, so a task that never queries pays nothing.
+    """
+    vendor = connection.vendor
+    if not seconds or vendor not in ("postgresql", "sqlite"):
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    applied = []
+
+    def apply(execute, sql, params, many, context):
+        if not applied:
+            if vendor == "postgresql":
+                remaining = max(1, int((deadline - time.monotonic()) * 1000))
+                # The driver's cursor, so this doesn't come back through the wrapper
+                context["cursor"].cursor.execute(f"SET statement_timeout = {remaining}")
+            else:
+                context["connection"].connection.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+            applied.append(True)
+        return execute(sql, params, many, context)
+
+    try:
+        with connection.execute_wrapper(apply):
+            yield
+    finally:
+        if applied and connection.connection is not None:
+            with suppress(DatabaseError):
+                if vendor == "postgresql":
+                    with connection.cursor() as cursor:
+                        cursor.execute("RESET statement_timeout")
+                else:
+                    connection.connection.set_progress_handler(None, 0)
+
+
+def _call(task, timeout):
+    close_old_connections()
+    try:
+        with statement_timeout(timeout):
+            return task()
+    finally:
+        close_old_connections()
+
+
+def run(tasks, budget=None):
+    """
+    Call every ``{name: callable}`` and return ({name: result}, [names that
+    ran out of time]). Exceptions from a task are raised here.
+    """
+    if len(tasks) <= 1 or connection.in_atomic_block:
+        return {name: task() for name, task in tasks.items()}, []
+    budget = get_budget() if budget is None else budget
+    deadline = time.monotonic() + budget if budget else None
+    executor = get_executor()
+    futures, inline = {}, []
+    for name, task in tasks.items():
+        if not _slots.acquire(blocking=False):
+            inline.append(name)  # every worker is busy
+            continue
+        future = executor.submit(_call, task, budget)
+        # Fires when the task finishes or is cancelled, never before
+        future.add_done_callback(lambda _, slots=_slots: slots.release())
+        futures[name] = future
+
+    results, timed_out = {}, []
+    for name in inline:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            timed_out.append(name)
+            continue
+        try:
+            with statement_timeout(remaining):
+                results[name] = tasks[name]()
+        except DatabaseError:
+            if deadline is None or time.monotonic() < deadline:
+                raise
+            timed_out.append(name)  # aborted by the statement timeout
+
+    remaining = None if deadline is None else max(0, deadline - time.monotonic())
+    done, _ = wait(futures.values(), timeout=remaining)
+    for name, future in futures.items():
+        if future in done:
+            results[name] = future.result()
+        else:
+            future.cancel()
+            timed_out.append(name)
+    return {name: results[name] for name in tasks if name in results}, [name for name in tasks if name in timed_out]
+
+
+@receiver(setting_changed)
+def _reset_executor(setting, **kwargs):
+    global _executor, _slots
+    if setting == "SEARCH_MAX_WORKERS":
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = _slots = None
@@ -0,0 +1,161 @@
+"""
+Result cache for /api/search/.
+
+- Queries are normalized (Unicode NFKC, case-folded, whitespace collapsed)
+  before they are searched or used as a key, so "Python  Tips" and
+  "python tips" share one entry.
+- Empty results are cached like any other (negative caching); results
+  marked ``truncated`` (a scope timed out or raised) are not cached, so a
+  transient error never turns into a cached "no results".
+- Each scope has a version counter in the cache, bumped when a change to its
+  models is committed (posts: Post, Tag, Category; bots: Question; reviews:
+  Review). An entry records the versions it was computed under and is stale
+  as soon as one of them moves, or after SEARCH_CACHE_TTL seconds.
+- A stale entry is recomputed by one worker at a time (a cache.add() lock);
+  the others keep serving the stale payload meanwhile, and only wait for the
+  lock holder when there is nothing to serve at all.
+"""
+import hashlib
+import time
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from blog.models import Category, Post, Tag
+from bots.models import Question, Review
+
+SCOPES = ("posts", "bots", "reviews")
+KEY_PREFIX = "search:result"
+VERSION_PREFIX = "search:version"
+LOCK_PREFIX = "search:lock"
+
+# How long a worker may hold the recompute lock (seconds)
+LOCK_TIMEOUT = 10
+# Waiting for another worker's result when there is no stale entry
+WAIT_TIMEOUT = 2.0
+WAIT_STEP = 0.05
+
+
+def get_ttl():
+    return int(getattr(settings, "SEARCH_CACHE_TTL", 600) or 0)
+
+
+def get_stale_ttl():
+    """How long an entry is kept (and may be served stale) after it expires"""
+    return int(getattr(settings, "SEARCH_CACHE_STALE_TTL", 300) or 0)
+
+
+def normalize_query(query):
+    return " ".join(unicodedata.normalize("NFKC", query or "").casefold().split())
+
+
+def scopes_for(scope):
+    return SCOPES if scope == "all" else tuple(s for s in SCOPES if s == scope)
+
+
+def get_versions(scopes):
+    keys = [f"{VERSION_PREFIX}:{scope}" for scope in scopes]
+    found = cache.get_many(keys)
+    return [found.get(key, 0) for key in keys]
+
+
+def bump_version(scope):
+    key = f"{VERSION_PREFIX}:{scope}"
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def cache_key(query, scope):
+    digest = hashlib.sha1(query.encode("utf-8")).hexdigest()
+    return f"{KEY_PREFIX}:{scope}:{digest}"
+
+
+def lock_key(key):
+    return key.replace(KEY_PREFIX, LOCK_PREFIX, 1)
+
+
+def _is_fresh(entry, versions):
+    return entry is not None and entry["versions"] == versions and entry["expires"] > time.time()
+
+
+def get_or_compute(query, scope, compute):
+    """
+    Cached ``compute(query, scope)`` for an already normalized query; see the
+    module docstring for when it is recomputed.
+    """
+    ttl = get_ttl()
+    if not ttl:
+        return compute(query, scope)
+    key = cache_key(query, scope)
+    versions = get_versions(scopes_for(scope))
+    entry = cache.get(key)
+    if _is_fresh(entry, versions):
+        return entry["payload"]
+
+    lock = lock_key(key)
+    if not cache.add(lock, 1, LOCK_TIMEOUT):
+        if entry is not None:
+            return entry["payload"]
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(WAIT_STEP)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry["payload"]
+        # The lock holder is slow or gone; compute without caching twice
+        return compute(query, scope)
+
+    try:
+        payload = compute(query, scope)
+        if payload.get("truncated"):
+            # A scope timed out or failed; don't keep partial results, the next request retries
+            return payload
+        cache.set(
+            key,
+            {"payload": payload, "versions": versions, "expires": time.time() + ttl},
+            ttl + get_stale_ttl(),
+        )
+        return payload
+    finally:
+        cache.delete(lock)
+
+
+# Version bumps ---------------------------------------------------------------------
+
+def _bump_on_commit(scope):
+    transaction.on_commit(lambda: bump_version(scope))
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def _posts_changed(sender, **kwargs):
+    _bump_on_commit("posts")
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+@receiver(m2m_changed, sender=Post.categories.through)
+def _post_terms_changed(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        _bump_on_commit("posts")
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def _questions_changed(sender, **kwargs):
+    _bump_on_commit("bots")
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def _reviews_changed(sender, **kwargs):
+    _bump_on_commit("reviews")
@@ -95,6 +95,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'analytics.context_processors.tracking',
             ],
         },
     },
@@ -185,6 +186,7 @@ REST_FRAMEWORK = {
     "DEFAULT_THROTTLE_RATES": {
         "anon": "60/min",
         "user": "120/min",
+        "suggest": "600/min",
     },
 }
 AUTH_USER_MODEL = "accounts.Student"
@@ -289,6 +291,105 @@ if _redis_url:
         "LOCATION": _redis_url,
     }
 
+# Analytics ingestion: "sync" saves each tracked hit inline, "buffered" queues
+# them in-process and bulk inserts by batch size or interval (analytics/ingest.py)
+ANALYTICS_INGEST_MODE = os.environ.get('ANALYTICS_INGEST_MODE', 'sync').strip().lower()
+ANALYTICS_BUFFER_SIZE = int(os.environ.get('ANALYTICS_BUFFER_SIZE', '100') or 100)
+ANALYTICS_BUFFER_FLUSH_INTERVAL = float(os.environ.get('ANALYTICS_BUFFER_FLUSH_INTERVAL', '5') or 5)
+
+# Offline IP-to-geo database built with `python manage.py build_geoip <csv>`.
+# The ip-api.com lookup (cached 24h) is only used as a fallback when enabled.
+ANALYTICS_GEOIP_PATH = os.environ.get('ANALYTICS_GEOIP_PATH', str(BASE_DIR / 'geoip.bin'))
+ANALYTICS_GEO_HTTP_FALLBACK = os.environ.get('ANALYTICS_GEO_HTTP_FALLBACK', 'False').lower() == 'true'
+
+# 'deferred' stores page views without geo and leaves it to `python manage.py
+# enrich_geo --loop`, which resolves IPs in batches (analytics/enrich.py).
+ANALYTICS_GEO_MODE = os.environ.get('ANALYTICS_GEO_MODE', 'inline').strip().lower()
+ANALYTICS_GEO_RESOLVER = os.environ.get('ANALYTICS_GEO_RESOLVER', 'analytics.enrich.OfflineResolver')
+ANALYTICS_GEO_BATCH_SIZE = int(os.environ.get('ANALYTICS_GEO_BATCH_SIZE', '1000') or 1000)
+ANALYTICS_GEO_BATCH_URL = os.environ.get('ANALYTICS_GEO_BATCH_URL', 'http://ip-api.com/batch')
+
+# Dashboard rollups: run `python manage.py rollup_analytics --loop` (or as a
+# scheduled task). ROLLUP_ON_DASHBOARD=True also folds in a few pending batches
+# on each dashboard load (handy without a scheduler, at the cost of page latency).
+ANALYTICS_ROLLUP_BATCH_SIZE = int(os.environ.get('ANALYTICS_ROLLUP_BATCH_SIZE', '5000') or 5000)
+ANALYTICS_ROLLUP_ON_DASHBOARD = os.environ.get('ANALYTICS_ROLLUP_ON_DASHBOARD', 'False').lower() == 'true'
+# Per-day top-K (Space-Saving) summaries behind the dashboard's top pages,
+# referrers, cities and bot IPs/paths; merged lists are cached between rollups.
+ANALYTICS_TOPK_CAPACITY = int(os.environ.get('ANALYTICS_TOPK_CAPACITY', '200') or 200)
+ANALYTICS_TOPK_CACHE_TIMEOUT = int(os.environ.get('ANALYTICS_TOPK_CACHE_TIMEOUT', '300') or 0)
+# /analytics/api/query/ answers are cached until the next rollup commit or this many seconds
+ANALYTICS_QUERY_CACHE_TIMEOUT = int(os.environ.get('ANALYTICS_QUERY_CACHE_TIMEOUT', '300') or 0)
+# Visits (bounce rate, pages per visit, entry/exit pages): `python manage.py
+# build_visits --loop`; minutes of inactivity that end a visit.
+ANALYTICS_VISIT_TIMEOUT = int(os.environ.get('ANALYTICS_VISIT_TIMEOUT', '30') or 30)
+# Conversion funnels (defined in the admin): `python manage.py build_funnels
+# --loop`; new or edited funnels are backfilled over this many days.
+ANALYTICS_FUNNEL_BACKFILL_DAYS = int(os.environ.get('ANALYTICS_FUNNEL_BACKFILL_DAYS', '30') or 30)
+
+# Extra crawler signatures (one per line) on top of the built-in list in
+# analytics/matching.py; ANALYTICS_EXCLUDE_PATHS may also be set here.
+ANALYTICS_BOT_SIGNATURES_FILE = os.environ.get('ANALYTICS_BOT_SIGNATURES_FILE', '')
+ANALYTICS_UA_CACHE_SIZE = int(os.environ.get('ANALYTICS_UA_CACHE_SIZE', '2048') or 0)
+
+# Per-process ID cache for the interned PageView dimensions (analytics/dimensions.py)
+ANALYTICS_DIMENSION_CACHE_SIZE = int(os.environ.get('ANALYTICS_DIMENSION_CACHE_SIZE', '10000') or 0)
+
+# Signed anonymous visitor-ID cookie used as the analytics visitor key.
+# Expires after COOKIE_AGE seconds of inactivity; IDs rotate after ID_ROTATE seconds.
+ANALYTICS_VISITOR_COOKIE = os.environ.get('ANALYTICS_VISITOR_COOKIE', 'pg_vid')
+ANALYTICS_VISITOR_COOKIE_AGE = int(os.environ.get('ANALYTICS_VISITOR_COOKIE_AGE', str(180 * 86400)))
+ANALYTICS_VISITOR_REFRESH = int(os.environ.get('ANALYTICS_VISITOR_REFRESH', '86400'))
+ANALYTICS_VISITOR_ID_ROTATE = int(os.environ.get('ANALYTICS_VISITOR_ID_ROTATE', str(365 * 86400)) or 0)
+
+# Retention: `python manage.py archive_analytics` moves PageView/BotVisit rows
+# older than RETENTION_DAYS into gzip NDJSON monthly files in ARCHIVE_DIR.
+ANALYTICS_RETENTION_DAYS = int(os.environ.get('ANALYTICS_RETENTION_DAYS', '90'))
+ANALYTICS_ARCHIVE_DIR = os.environ.get('ANALYTICS_ARCHIVE_DIR', str(BASE_DIR / 'analytics_archive'))
+# Rows fetched per round trip by /analytics/export/ and `manage.py export_analytics`
+ANALYTICS_EXPORT_CHUNK_SIZE = int(os.environ.get('ANALYTICS_EXPORT_CHUNK_SIZE', '2000') or 2000)
+
+# Client-side event beacon (static/js/analytics.js -> /analytics/collect/)
+ANALYTICS_COLLECT_MAX_EVENTS = int(os.environ.get('ANALYTICS_COLLECT_MAX_EVENTS', '50') or 50)
+ANALYTICS_COLLECT_MAX_BYTES = int(os.environ.get('ANALYTICS_COLLECT_MAX_BYTES', '65536') or 65536)
+
+# 'server': AnalyticsMiddleware records page views. 'beacon': static/js/analytics.js
+# reports them to /analytics/pageview/, so full-page cached responses are counted.
+ANALYTICS_TRACKING_MODE = os.environ.get('ANALYTICS_TRACKING_MODE', 'server').strip().lower()
+
+# "Active now" window (minutes) for the live counter kept in the cache
+ANALYTICS_ACTIVE_WINDOW = int(os.environ.get('ANALYTICS_ACTIVE_WINDOW', '5') or 5)
+# Crawl rate per client (IP + user agent), hits/minute: above LOG_THRESHOLD bot
+# hits are logged as one aggregated row per minute, above BLOCK_RATE (0 = off)
+# crawlers not on ANALYTICS_BOT_ALLOWLIST get a 429. 'cache' shares counters between workers
+ANALYTICS_BOT_LOG_THRESHOLD = int(os.environ.get('ANALYTICS_BOT_LOG_THRESHOLD', '60') or 0)
+ANALYTICS_BOT_BLOCK_RATE = int(os.environ.get('ANALYTICS_BOT_BLOCK_RATE', '0') or 0)
+ANALYTICS_RATE_BACKEND = os.environ.get('ANALYTICS_RATE_BACKEND', 'memory')
+
+# Blog full-text search (blog/search.py): most ranked matches /api/blog/posts/?search= returns
+BLOG_SEARCH_MAX_RESULTS = int(os.environ.get('BLOG_SEARCH_MAX_RESULTS', '200') or 200)
+# /api/search/ results (core/search_cache.py) are dropped when the searched content
+# changes; TTL bounds their age otherwise, STALE_TTL how long an expired entry may
+# still be served while one worker recomputes it (seconds, TTL 0 = no caching)
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', '600') or 0)
+SEARCH_CACHE_STALE_TTL = int(os.environ.get('SEARCH_CACHE_STALE_TTL', '300') or 0)
+# /api/search/ runs its scopes on a pool of MAX_WORKERS threads (in the request
+# thread when all are busy); scopes still running after SCOPE_BUDGET seconds come
+# back empty with "truncated": true, and their queries are cut off at the budget (core/fanout.py)
+SEARCH_MAX_WORKERS = int(os.environ.get('SEARCH_MAX_WORKERS', '4') or 1)
+SEARCH_SCOPE_BUDGET = float(os.environ.get('SEARCH_SCOPE_BUDGET', '2.0') or 0)
+# Blog text-to-speech audio cache under MEDIA_ROOT (blog/tts.py); least recently
+# played files are deleted beyond MAX_BYTES (0 = unbounded)
+BLOG_TTS_CACHE_DIR = os.environ.get('BLOG_TTS_CACHE_DIR', 'tts_cache')
+BLOG_TTS_CACHE_MAX_BYTES = int(os.environ.get('BLOG_TTS_CACHE_MAX_BYTES', str(500 * 1024 * 1024)) or 0)
+# Typeahead (/api/search/suggest/, core/suggest.py): post popularity window (days),
+# times a bot question must be asked before it is suggested, how often workers
+# check for changes made by other workers and rebuild everything (seconds)
+SEARCH_SUGGEST_POPULARITY_DAYS = int(os.environ.get('SEARCH_SUGGEST_POPULARITY_DAYS', '30') or 30)
+SEARCH_SUGGEST_MIN_QUESTION_COUNT = int(os.environ.get('SEARCH_SUGGEST_MIN_QUESTION_COUNT', '2') or 1)
+SEARCH_SUGGEST_CHECK_INTERVAL = int(os.environ.get('SEARCH_SUGGEST_CHECK_INTERVAL', '10') or 0)
+SEARCH_SUGGEST_MAX_AGE = int(os.environ.get('SEARCH_SUGGEST_MAX_AGE', '600') or 600)
+
 # Conditional GET
 USE_ETAGS = True
 
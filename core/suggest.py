@@ -0,0 +1,476 @@
+"""
+Typeahead suggestions for /api/search/suggest/, answered from memory.
+
+The index holds published post titles, tag and category names and bot
+questions that have been asked at least SEARCH_SUGGEST_MIN_QUESTION_COUNT
+times, each with a popularity score:
+
+- posts: page views of /blog/<slug>/ over the last SEARCH_SUGGEST_POPULARITY_DAYS
+  days, from the analytics rollups
+- tags / categories: number of published posts
+- questions: number of times the same (normalized) text was asked
+
+Lookups bisect a sorted list of (key, item) pairs, where an item has one key
+per word it contains (the normalized text from that word on), and scan the
+keys sharing the query prefix. One- and two-character prefixes match too
+much to scan, so their top results are kept precomputed. A keystroke is a
+binary search plus a short scan, with no database query.
+
+Each process builds the index when the server starts (or on first use) and patches it when a post, tag,
+category or question change is committed. The patch bumps a version in the
+cache; other processes compare it at most every SEARCH_SUGGEST_CHECK_INTERVAL
+seconds and rebuild when it moved. A new question only bumps it when it
+enters or leaves the index; other ask counts are left to the rebuild every
+process does after SEARCH_SUGGEST_MAX_AGE seconds, which also lets post
+popularity follow traffic. Those
+rebuilds run in a background thread, one at a time per process, while
+lookups keep answering from the old index.
+"""
+import datetime
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from analytics.models import TrafficRollup
+from blog.models import Category, Post, Tag
+from bots.models import Question
+
+POST = "post"
+TAG = "tag"
+CATEGORY = "category"
+QUESTION = "question"
+
+VERSION_KEY = "search:suggest:version"
+MAX_LIMIT = 20
+# Keys are truncated to this many characters (long questions)
+MAX_KEY_LENGTH = 60
+# Prefixes this short use the precomputed top results
+SHORT_PREFIX = 2
+# Most matching keys scanned for one lookup
+MAX_SCAN = 2000
+
+logger = logging.getLogger(__name__)
+
+NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def get_setting(name, default):
+    return getattr(settings, name, default)
+
+
+def normalize(text):
+    """Lowercase, accents stripped, words separated by single spaces"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return NON_WORD_RE.sub(" ", text.lower()).strip()
+
+
+def keys_for(text):
+    """The normalized text starting at each of its words"""
+    words = normalize(text).split()
+    return {" ".join(words[i:])[:MAX_KEY_LENGTH] for i in range(len(words))}
+
+
+class Suggestion:
+    __slots__ = ("kind", "text", "slug", "popularity")
+
+    def __init__(self, kind, text, slug="", popularity=0):
+        self.kind = kind
+        self.text = text
+        self.slug = slug
+        self.popularity = popularity
+
+    def rank(self):
+        return (self.popularity, -len(self.text))
+
+    def as_dict(self):
+        data = {"type": self.kind, "text": self.text}
+        if self.slug:
+            data["slug"] = self.slug
+        if self.kind == POST:
+            data["url"] = f"/blog/{self.slug}/"
+        return data
+
+
+class SuggestIndex:
+    """
+    Items keyed by (kind, id) with their sorted prefix keys. Readers never
+    lock: updates build a new index and swap it in.
+    """
+
+    def __init__(self, items=None, keys=None):
+        self.items = dict(items or {})
+        if keys is None:
+            keys = sorted((key, item_key) for item_key, item in self.items.items() for key in keys_for(item.text))
+        self.keys = keys
+        by_prefix = defaultdict(set)
+        for key, item_key in self.keys:
+            for length in range(1, SHORT_PREFIX + 1):
+                by_prefix[key[:length]].add(item_key)
+        self.short = {prefix: self._top(item_keys, MAX_LIMIT) for prefix, item_keys in by_prefix.items()}
+
+    def _matches(self, prefix, max_scan=None):
+        """Item keys whose text has a word starting with ``prefix``"""
+        found = set()
+        i = bisect_left(self.keys, (prefix,))
+        scanned = 0
+        while i < len(self.keys) and self.keys[i][0].startswith(prefix):
+            found.add(self.keys[i][1])
+            i += 1
+            scanned += 1
+            if max_scan and scanned >= max_scan:
+                break
+        return found
+
+    def _top(self, item_keys, limit):
+        return heapq.nlargest(limit, item_keys, key=lambda item_key: self.items[item_key].rank())
+
+    def _compute_short(self, prefix):
+        top = self._top(self._matches(prefix), MAX_LIMIT)
+        if top:
+            self.short[prefix] = top
+        else:
+            self.short.pop(prefix, None)
+
+    def lookup(self, query, limit=8):
+        prefix = normalize(query)[:MAX_KEY_LENGTH]
+        if not prefix:
+            return []
+        if len(prefix) <= SHORT_PREFIX:
+            top = self.short.get(prefix, [])[:limit]
+        else:
+            top = self._top(self._matches(prefix, MAX_SCAN), limit)
+        return [self.items[item_key] for item_key in top]
+
+    def patched(self, changes):
+        """A new index with ``changes`` ({(kind, id): Suggestion or None}) applied"""
+        items = dict(self.items)
+        removed = set()
+        added = []
+        for item_key, item in changes.items():
+            if item_key in items:
+                removed.add(item_key)
+            if item is None:
+                items.pop(item_key, None)
+            else:
+                items[item_key] = item
+                added.extend((key, item_key) for key in keys_for(item.text))
+        keys = [entry for entry in self.keys if entry[1] not in removed] if removed else list(self.keys)
+        for entry in added:
+            insort(keys, entry)
+
+        index = SuggestIndex.__new__(SuggestIndex)
+        index.items, index.keys, index.short = items, keys, dict(self.short)
+        touched = {key[:length] for key, _ in added for length in range(1, SHORT_PREFIX + 1)}
+        for prefix, top in self.short.items():
+            if removed.intersection(top) or any(item_key in changes for item_key in top):
+                touched.add(prefix)
+        for prefix in touched:
+            index._compute_short(prefix)
+        return index
+
+
+# Loading ----------------------------------------------------------------------
+
+def post_popularity(slugs=None):
+    """{slug: page views over the popularity window} from the analytics rollups"""
+    days = get_setting("SEARCH_SUGGEST_POPULARITY_DAYS", 30)
+    qs = TrafficRollup.objects.filter(
+        granularity=TrafficRollup.DAY,
+        dimension="path",
+        bucket__gte=timezone.now() - datetime.timedelta(days=days),
+    )
+    if slugs is not None:
+        qs = qs.filter(value__in=[f"/blog/{slug}/" for slug in slugs])
+    else:
+        qs = qs.filter(value__startswith="/blog/")
+    views = {}
+    for path, total in qs.values("value").annotate(total=Sum("count")).values_list("value", "total"):
+        slug = path[len("/blog/"):].strip("/")
+        if slug and "/" not in slug:
+            views[slug] = total or 0
+    return views
+
+
+def load_posts(ids=None):
+    qs = Post.objects.filter(status=Post.Status.PUBLISHED)
+    if ids is not None:
+        qs = qs.filter(id__in=ids)
+    rows = list(qs.values_list("id", "title", "slug"))
+    views = post_popularity([slug for _, _, slug in rows] if ids is not None else None)
+    return {(POST, pk): Suggestion(POST, title, slug, views.get(slug, 0)) for pk, title, slug in rows}
+
+
+def load_terms(model, kind, ids=None):
+    """Tags or categories with published posts; with ``ids``, the others among them map to None"""
+    qs = model.objects.annotate(published=Count("posts", filter=Q(posts__status=Post.Status.PUBLISHED)))
+    items = {}
+    if ids is not None:
+        qs = qs.filter(id__in=ids)
+        items = {(kind, pk): None for pk in ids}
+    for pk, name, slug, published in qs.filter(published__gt=0).values_list("id", "name", "slug", "published"):
+        items[(kind, pk)] = Suggestion(kind, name, slug, published)
+    return items
+
+
+def question_key(text):
+    return (QUESTION, normalize(text)[:200])
+
+
+def load_questions():
+    """Ask count and display text of every normalized question"""
+    counts = Counter()
+    labels = {}
+    # Counted per exact text in SQL; only the distinct texts come back to be normalized
+    rows = Question.objects.order_by().values("text").annotate(asked=Count("id")).values_list("text", "asked")
+    for text, asked in rows.iterator():
+        item_key = question_key(text)
+        if item_key[1]:
+            counts[item_key] += asked
+            labels.setdefault(item_key, text.strip()[:200])
+    return counts, labels
+
+
+def question_items(counts, labels):
+    minimum = get_setting("SEARCH_SUGGEST_MIN_QUESTION_COUNT", 2)
+    return {
+        item_key: Suggestion(QUESTION, labels[item_key], popularity=count)
+        for item_key, count in counts.items()
+        if count >= minimum
+    }
+
+
+# Process-wide state ----------------------------------------------------------------
+
+class _State:
+    def __init__(self):
+        self.index = None
+        self.version = None
+        self.built_at = 0.0
+        self.checked_at = 0.0
+        self.question_counts = Counter()
+        self.question_labels = {}
+        self.rebuilding = False
+        self.lock = threading.Lock()
+
+
+_state = _State()
+
+
+def get_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def bump_version():
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+        return 1
+
+
+def build():
+    """Load everything from the database and swap the new index in"""
+    version = get_version()
+    counts, labels = load_questions()
+    items = {}
+    items.update(load_posts())
+    items.update(load_terms(Tag, TAG))
+    items.update(load_terms(Category, CATEGORY))
+    items.update(question_items(counts, labels))
+    index = SuggestIndex(items)
+    with _state.lock:
+        _state.index = index
+        _state.question_counts, _state.question_labels = counts, labels
+        _state.version = version
+        _state.built_at = _state.checked_at = time.monotonic()
+    return index
+
+
+def _build_in_thread(name):
+    def run():
+        try:
+            build()
+        except Exception:
+            logger.exception("Could not build the search suggestion index")
+        finally:
+            _state.rebuilding = False
+            connection.close()
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+
+
+def warm():
+    """Build the index in a background thread (called when the server starts)"""
+    _build_in_thread("search-suggest-warm")
+
+
+def reset():
+    """Forget the index; the next lookup rebuilds it"""
+    with _state.lock:
+        _state.index = None
+        _state.version = None
+
+
+def get_index():
+    index = _state.index
+    if index is None:
+        return build()
+    now = time.monotonic()
+    if now - _state.built_at >= get_setting("SEARCH_SUGGEST_MAX_AGE", 600):
+        _rebuild_in_background()
+    elif now - _state.checked_at >= get_setting("SEARCH_SUGGEST_CHECK_INTERVAL", 10):
+        _state.checked_at = now
+        if get_version() != _state.version:
+            _rebuild_in_background()
+    return index
+
+
+def _rebuild_in_background():
+    # One rebuild per process at a time; keystrokes never wait for it
+    with _state.lock:
+        if _state.rebuilding:
+            return
+        _state.rebuilding = True
+        _state.built_at = _state.checked_at = time.monotonic()
+    _build_in_thread("search-suggest-rebuild")
+
+
+def suggest(query, limit=8):
+    return [item.as_dict() for item in get_index().lookup(query, max(1, min(MAX_LIMIT, limit)))]
+
+
+def apply_changes(changes, shared=True):
+    """Patch this process' index and, if ``shared``, tell the others to rebuild"""
+    with _state.lock:
+        if _state.index is not None:
+            _state.index = _state.index.patched(changes)
+    if not shared:
+        return
+    version = bump_version()
+    with _state.lock:
+        if _state.index is not None:
+            _state.version = version
+
+
+# Signals ----------------------------------------------------------------------
+
+def _on_commit(load):
+    def callback():
+        if _state.index is not None:
+            apply_changes(load())
+        else:
+            bump_version()
+    transaction.on_commit(callback)
+
+
+def _term_ids(post):
+    return list(post.tags.values_list("id", flat=True)), list(post.categories.values_list("id", flat=True))
+
+
+def _post_changes(pk, tags, categories):
+    changes = {(POST, pk): None}
+    changes.update(load_posts([pk]))
+    changes.update(load_terms(Tag, TAG, tags))
+    changes.update(load_terms(Category, CATEGORY, categories))
+    return changes
+
+
+@receiver(post_save, sender=Post)
+def _post_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        # Publishing or unpublishing changes the post counts of its tags and categories
+        tags, categories = _term_ids(instance)
+        _on_commit(lambda: _post_changes(instance.pk, tags, categories))
+
+
+@receiver(pre_delete, sender=Post)
+def _post_deleting(sender, instance, **kwargs):
+    instance._suggest_terms = _term_ids(instance)
+
+
+@receiver(post_delete, sender=Post)
+def _post_deleted(sender, instance, **kwargs):
+    tags, categories = getattr(instance, "_suggest_terms", ([], []))
+    _on_commit(lambda: _post_changes(instance.pk, tags, categories))
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+@receiver(m2m_changed, sender=Post.categories.through)
+def _post_terms_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            kind = TAG if isinstance(instance, Tag) else CATEGORY
+            _on_commit(lambda: load_terms(type(instance), kind, [instance.pk]))
+        return
+    kind = TAG if model is Tag else CATEGORY
+    if action == "pre_clear":
+        # post_clear has no pk_set; remember which terms lose the post
+        field = "tags" if model is Tag else "categories"
+        instance._suggest_cleared = list(getattr(instance, field).values_list("id", flat=True))
+    elif action in ("post_add", "post_remove", "post_clear"):
+        ids = list(pk_set or ()) if action != "post_clear" else getattr(instance, "_suggest_cleared", [])
+        _on_commit(lambda: load_terms(model, kind, ids))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Category)
+def _term_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        kind = TAG if sender is Tag else CATEGORY
+        _on_commit(lambda: load_terms(sender, kind, [instance.pk]))
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Category)
+def _term_deleted(sender, instance, **kwargs):
+    kind = TAG if sender is Tag else CATEGORY
+    _on_commit(lambda: {(kind, instance.pk): None})
+
+
+def _question_changes(text, delta):
+    """The question's new entry, and whether it entered or left the index"""
+    item_key = question_key(text)
+    if not item_key[1]:
+        return {}, False
+    with _state.lock:
+        counts = _state.question_counts
+        _state.question_labels.setdefault(item_key, text.strip()[:200])
+        listed = item_key in question_items({item_key: counts[item_key]}, _state.question_labels)
+        counts[item_key] = max(0, counts[item_key] + delta)
+        items = question_items({item_key: counts[item_key]}, _state.question_labels)
+    return {item_key: items.get(item_key)}, (item_key in items) != listed
+
+
+def _on_question_commit(text, delta):
+    def callback():
+        # Without an index there is nothing to patch; the next build counts it
+        if _state.index is not None:
+            changes, crossed = _question_changes(text, delta)
+            if changes:
+                apply_changes(changes, shared=crossed)
+    transaction.on_commit(callback)
+
+
+@receiver(post_save, sender=Question)
+def _question_saved(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        _on_question_commit(instance.text, 1)
+
+
+@receiver(post_delete, sender=Question)
+def _question_deleted(sender, instance, **kwargs):
+    _on_question_commit(instance.text, -1)
@@ -1,6 +1,21 @@
-from django.test import TestCase
+import threading
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
 from rest_framework.test import APIClient
 
+from analytics.models import TrafficRollup
+from blog.models import Post, Tag
+from bots.models import Question
+from payments.models import BotInstance
+
+from . import fanout, search_cache, suggest
+
 
 class SearchApiTests(TestCase):
     def setUp(self):
@@ -14,6 +29,8 @@ class SearchApiTests(TestCase):
         r = self.client.get("/api/search/?q=test&type=all")
         self.assertEqual(r.status_code, 200)
         self.assertIn("results", r.data)
+        self.assertEqual(set(r.data["results"]), {"posts", "bots", "reviews"})
+        self.assertFalse(r.data["truncated"])
 
     def test_app_ads_txt_is_plain_text_at_root(self):
         response = self.client.get("/app-ads.txt")
@@ -24,3 +41,200 @@ class SearchApiTests(TestCase):
             "google.com, pub-3679558664849483, DIRECT, f08c47fec0942fa0\n",
         )
 
+
+class SuggestApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        suggest.reset()
+        self.client = APIClient()
+        self.author = get_user_model().objects.create_user(username="sa", email="sa@example.com", password="pass12345")
+        self.quiet = self.make_post("Essay outlines that work")
+        self.popular = self.make_post("Essay writing with AI")
+        self.make_post("Essay draft", status=Post.Status.DRAFT)
+        self.popular.tags.add(Tag.objects.create(name="essays"))
+        TrafficRollup.objects.create(
+            granularity=TrafficRollup.DAY, bucket=timezone.now() - timedelta(days=1),
+            dimension="path", value=f"/blog/{self.popular.slug}/", count=40,
+        )
+        bot = BotInstance.objects.create(owner=self.author)
+        for text in ("How do I cite sources?", "how do I cite  sources", "How do I pass exams?"):
+            Question.objects.create(bot=bot, text=text)
+
+    def make_post(self, title, status=Post.Status.PUBLISHED):
+        return Post.objects.create(title=title, content="x", status=status, author=self.author)
+
+    def texts(self, query):
+        return [item["text"] for item in self.client.get("/api/search/suggest/", {"q": query}).data["suggestions"]]
+
+    def test_prefix_matches_ranked_by_popularity(self):
+        self.assertEqual(self.texts("ess"), ["Essay writing with AI", "essays", "Essay outlines that work"])
+        self.assertEqual(self.texts("writ"), ["Essay writing with AI"])
+        self.assertEqual(self.texts("e")[:2], ["Essay writing with AI", "essays"])
+        # Asked twice (after normalizing) vs once
+        self.assertEqual(self.texts("how do"), ["How do I cite sources?"])
+        self.assertEqual(self.texts(""), [])
+
+    def test_lookups_do_not_query_the_database(self):
+        self.texts("ess")
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/search/suggest/", {"q": "essay w"})
+        self.assertEqual(response.data["suggestions"][0]["url"], f"/blog/{self.popular.slug}/")
+
+    def test_index_is_patched_on_commit(self):
+        self.texts("ess")
+        with self.captureOnCommitCallbacks(execute=True):
+            post = self.make_post("Essay checklist")
+        self.assertIn("Essay checklist", self.texts("checklist"))
+        with self.captureOnCommitCallbacks(execute=True):
+            post.status = Post.Status.ARCHIVED
+            post.save()
+            self.popular.tags.clear()
+        self.assertEqual(self.texts("checklist"), [])
+        self.assertNotIn("essays", self.texts("ess"))
+        with self.captureOnCommitCallbacks(execute=True):
+            Question.objects.create(bot=BotInstance.objects.get(), text="How do I pass exams")
+        self.assertEqual(self.texts("how do i p"), ["How do I pass exams?"])
+
+    def test_questions_only_bump_the_version_when_they_enter_the_index(self):
+        self.texts("how")
+        version = suggest.get_version()
+        bot = BotInstance.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            Question.objects.create(bot=bot, text="How do I cite sources")
+            Question.objects.create(bot=bot, text="What is osmosis")
+        self.assertEqual(suggest.get_version(), version)
+        self.assertEqual(self.texts("how do"), ["How do I cite sources?"])
+        with self.captureOnCommitCallbacks(execute=True):
+            Question.objects.create(bot=bot, text="how do i pass exams")
+        self.assertNotEqual(suggest.get_version(), version)
+        self.assertEqual(self.texts("how do i"), ["How do I cite sources?", "How do I pass exams?"])
+
+    def test_other_workers_rebuild_in_the_background_when_the_version_moves(self):
+        index = suggest.get_index()
+        suggest.bump_version()
+        started, release = threading.Event(), threading.Event()
+
+        def slow_build():
+            started.set()
+            release.wait(1)
+
+        with patch("core.suggest.build", side_effect=slow_build) as build:
+            with self.settings(SEARCH_SUGGEST_CHECK_INTERVAL=0), self.assertNumQueries(0):
+                self.assertIs(suggest.get_index(), index)
+                self.assertTrue(started.wait(1))
+                self.assertIs(suggest.get_index(), index)  # already rebuilding
+            release.set()
+        self.assertEqual(build.call_count, 1)
+
+
+class SearchCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        owner = get_user_model().objects.create_user(username="sc", email="sc@example.com", password="pass12345")
+        self.bot = BotInstance.objects.create(owner=owner)
+
+    def search(self, q):
+        return self.client.get("/api/search/", {"q": q, "type": "bots"}).data
+
+    def test_variants_and_empty_results_are_cached(self):
+        self.assertEqual(self.search("  Photo  SYNTHESIS ")["q"], "photo synthesis")
+        with self.assertNumQueries(0):
+            data = self.search("photo synthesis")
+        self.assertEqual(data["results"], {"bots": []})
+
+    def test_failed_scope_is_flagged_and_not_cached(self):
+        with patch("core.views.SearchView.search_bots", side_effect=RuntimeError("no such table")):
+            with self.assertLogs("core.views", "ERROR"):
+                data = self.search("osmosis")
+        self.assertEqual(data["results"], {"bots": []})
+        self.assertTrue(data["truncated"])
+        self.assertEqual(data["failed_scopes"], ["bots"])
+        self.assertIsNone(cache.get(search_cache.cache_key("osmosis", "bots")))
+        self.assertEqual(self.search("osmosis")["failed_scopes"], [])
+
+    def test_content_changes_invalidate(self):
+        self.search("mitosis")
+        with self.captureOnCommitCallbacks(execute=True):
+            Question.objects.create(bot=self.bot, text="Explain mitosis")
+        self.assertEqual(len(self.search("Mitosis")["results"]["bots"]), 1)
+
+    def test_stale_entry_served_while_another_worker_recomputes(self):
+        calls = []
+
+        def compute(query, scope):
+            calls.append(query)
+            return {"n": len(calls)}
+
+        self.assertEqual(search_cache.get_or_compute("cells", "bots", compute), {"n": 1})
+        search_cache.bump_version("bots")
+        key = search_cache.cache_key("cells", "bots")
+        cache.add(search_cache.lock_key(key), 1)
+        self.assertEqual(search_cache.get_or_compute("cells", "bots", compute), {"n": 1})
+        cache.delete(search_cache.lock_key(key))
+        self.assertEqual(search_cache.get_or_compute("cells", "bots", compute), {"n": 2})
+        self.assertEqual(search_cache.get_or_compute("cells", "bots", compute), {"n": 2})
+
+
+class FanoutTests(SimpleTestCase):
+    def test_scopes_run_concurrently_within_the_budget(self):
+        release = threading.Event()
+        started = threading.Barrier(2, timeout=1)
+
+        def slow():
+            started.wait()
+            release.wait(1)
+            return "slow"
+
+        def fast():
+            started.wait()  # only passes if both tasks run at the same time
+            return "fast"
+
+        try:
+            results, timed_out = fanout.run({"fast": fast, "slow": slow}, budget=0.2)
+        finally:
+            release.set()
+        self.assertEqual(results, {"fast": "fast"})
+        self.assertEqual(timed_out, ["slow"])
+
+
+    @override_settings(SEARCH_MAX_WORKERS=2)
+    def test_scopes_run_inline_while_every_worker_is_busy(self):
+        release = threading.Event()
+
+        def slow():
+            release.wait(1)
+            return "slow"
+
+        try:
+            results, timed_out = fanout.run({"a": slow, "b": slow, "c": threading.get_ident}, budget=0.1)
+            self.assertEqual((results, timed_out), ({"c": threading.get_ident()}, ["a", "b"]))
+            # The overrunning scopes still hold both workers
+            self.assertEqual(fanout.run({"d": lambda: "d", "e": lambda: "e"}, budget=0.1), ({"d": "d", "e": "e"}, []))
+            # Inline scopes share what is left of the budget
+            results, timed_out = fanout.run({"f": slow, "g": lambda: "g"}, budget=0.1)
+            self.assertEqual((results, timed_out), ({"f": "slow"}, ["g"]))
+        finally:
+            release.set()
+        # Wait until the slow scopes have given both workers back
+        for _ in range(2):
+            self.assertTrue(fanout._slots.acquire(timeout=1))
+        for _ in range(2):
+            fanout._slots.release()
+        self.assertEqual(fanout.run({"d": lambda: "d", "e": lambda: "e"}), ({"d": "d", "e": "e"}, []))
+
+
+class FanoutTransactionTests(TestCase):
+    def test_runs_in_the_calling_thread_inside_a_transaction(self):
+        results, timed_out = fanout.run({"a": threading.get_ident, "b": threading.get_ident})
+        self.assertEqual(set(results.values()), {threading.get_ident()})
+        self.assertEqual(timed_out, [])
+
+    def test_statement_timeout_aborts_slow_queries(self):
+        endless = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT count(*) FROM n"
+        with fanout.statement_timeout(0.05), self.assertRaises(OperationalError):
+            with connection.cursor() as cursor:
+                cursor.execute(endless)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            self.assertEqual(cursor.fetchone(), (1,))
@@ -20,7 +20,7 @@ from django.contrib.auth import views as auth_views
 from django.views.generic import TemplateView
 from django.contrib.sitemaps.views import sitemap
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
-from .views import SearchView, PricingPageView, app_ads_txt
+from .views import SearchView, SuggestView, PricingPageView, app_ads_txt
 from .sitemaps import StaticViewSitemap, BlogPostSitemap
 from accounts.views import LoginPageView, SignupPageView, ProfilePageView, LogoutView, DashboardView
 from django.conf import settings
@@ -55,6 +55,7 @@ urlpatterns = [
     path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
     path('api/search/', SearchView.as_view(), name='global-search'),
+    path('api/search/suggest/', SuggestView.as_view(), name='search-suggest'),
     path('api/health/', lambda r: JsonResponse({'status': 'ok'}), name='health'),
 
     # Site routes (templates)
@@ -1,95 +1,134 @@
+import logging
+
 from rest_framework import views, status
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
-from django.db import models
 from django.views.generic import TemplateView
 from django.conf import settings
 from django.http import HttpResponse
+from rest_framework.throttling import ScopedRateThrottle
+
+from . import fanout, search_cache, suggest
 
+logger = logging.getLogger(__name__)
 
 class SearchView(views.APIView):
     permission_classes = [AllowAny]
 
     def get(self, request):
-        # Cache simple search results for 60s based on q and type
-        try:
-            from django.core.cache import cache
-            q = request.GET.get("q", "").strip()
-            t = (request.GET.get("type", "all").strip() or "all").lower()
-            cache_key = f"search:{t}:{q}"
-            cached = cache.get(cache_key)
-            if cached:
-                return Response(cached)
-        except Exception:
-            cache = None
-        query = request.query_params.get("q", "").strip()
+        query = search_cache.normalize_query(request.query_params.get("q", ""))
         scope = (request.query_params.get("type", "").strip() or "all").lower()
         if not query:
             return Response({"detail": "q is required"}, status=status.HTTP_400_BAD_REQUEST)
-
-        results = {}
-
-        if scope in ("all", "posts"):
-            try:
-                from blog.models import Post
-
-                posts_qs = (
-                    Post.objects.filter(status=Post.Status.PUBLISHED)
-                    .filter(
-                        models.Q(title__icontains=query)
-                        | models.Q(content__icontains=query)
-                        | models.Q(tags__name__icontains=query)
-                        | models.Q(categories__name__icontains=query)
-                    )
-                    .distinct()
-                )[:10]
-                results["posts"] = [
-                    {"id": p.id, "title": p.title, "slug": p.slug, "published_at": p.published_at}
-                    for p in posts_qs
-                ]
-            except Exception:
-                results["posts"] = []
-
-        if scope in ("all", "bots"):
-            try:
-                from bots.models import Question
-
-                qs = Question.objects.filter(text__icontains=query).select_related("bot")[:10]
-                results["bots"] = [
-                    {
-                        "bot_reference": str(q.bot.reference),
-                        "question_id": q.id,
-                        "question": q.text,
-                    }
-                    for q in qs
-                ]
-            except Exception:
-                results["bots"] = []
-
-        if scope in ("all", "reviews"):
-            try:
-                from bots.models import Review
-
-                rv = Review.objects.filter(comment__icontains=query).select_related("bot")[:10]
-                results["reviews"] = [
-                    {
-                        "id": r.id,
-                        "bot_id": r.bot_id,
-                        "rating": r.rating,
-                        "comment": r.comment,
-                    }
-                    for r in rv
-                ]
-            except Exception:
-                results["reviews"] = []
-
-        payload = {"q": query, "type": scope, "results": results}
+        # Cached per normalized query until the searched content changes (core/search_cache.py)
+        return Response(search_cache.get_or_compute(query, scope, self.search))
+
+    def search(self, query, scope):
+        """
+        Scopes run concurrently (core/fanout.py). One that exceeds the time
+        budget comes back empty and is listed in ``truncated_scopes``; one that
+        raises comes back empty and is listed in ``failed_scopes``. Either way
+        the payload is ``truncated`` and isn't cached.
+        """
+        searches = {
+            "posts": self.search_posts,
+            "bots": self.search_bots,
+            "reviews": self.search_reviews,
+        }
+        tasks = {
+            name: (lambda name=name, search=search: self.run_scope(name, search, query))
+            for name, search in searches.items()
+            if scope in ("all", name)
+        }
+        results, timed_out = fanout.run(tasks)
+        failed = [name for name in tasks if name in results and results[name] is None]
+        for name in timed_out + failed:
+            results[name] = []
+        return {
+            "q": query,
+            "type": scope,
+            "results": {name: results[name] for name in tasks},
+            "truncated": bool(timed_out or failed),
+            "truncated_scopes": timed_out,
+            "failed_scopes": failed,
+        }
+
+    @staticmethod
+    def run_scope(name, search, query):
+        """``search(query)``, or None when it raised (a DB error, a missing FTS table)"""
         try:
-            if cache and query:
-                cache.set(cache_key, payload, 60)
+            return search(query)
         except Exception:
-            pass
-        return Response(payload)
+            logger.exception("Search scope %s failed", name)
+            return None
+
+    @staticmethod
+    def search_posts(query):
+        from blog import search
+        from blog.models import Post
+
+        # Ranked by the full-text index (bm25 on SQLite, ts_rank_cd on Postgres)
+        hits = search.search_posts(query, limit=10)
+        posts = Post.objects.in_bulk([post_id for post_id, _, _ in hits])
+        return [
+            {
+                "id": p.id,
+                "title": p.title,
+                "slug": p.slug,
+                "published_at": p.published_at,
+                "snippet": snippet,
+                "rank": rank,
+            }
+            for p, rank, snippet in ((posts.get(post_id), rank, snippet) for post_id, rank, snippet in hits)
+            if p is not None
+        ]
+
+    @staticmethod
+    def search_bots(query):
+        from bots.models import Question
+
+        qs = Question.objects.filter(text__icontains=query).select_related("bot")[:10]
+        return [
+            {
+                "bot_reference": str(q.bot.reference),
+                "question_id": q.id,
+                "question": q.text,
+            }
+            for q in qs
+        ]
+
+    @staticmethod
+    def search_reviews(query):
+        from bots.models import Review
+
+        rv = Review.objects.filter(comment__icontains=query).select_related("bot")[:10]
+        return [
+            {
+                "id": r.id,
+                "bot_id": r.bot_id,
+                "rating": r.rating,
+                "comment": r.comment,
+            }
+            for r in rv
+        ]
+
+
+class SuggestView(views.APIView):
+    """Typeahead over post titles, tags, categories and popular questions, served from memory"""
+
+    permission_classes = [AllowAny]
+    # No session or user lookup, so a keystroke costs no database query
+    authentication_classes = []
+    throttle_classes = [ScopedRateThrottle]
+    throttle_scope = "suggest"
+
+    def get(self, request):
+        query = request.query_params.get("q", "")
+        try:
+            limit = int(request.query_params.get("limit", 8))
+        except ValueError:
+            limit = 8
+        return Response({"q": query, "suggestions": suggest.suggest(query, limit)})
 
 
 # Site views
@@ -0,0 +1,88 @@
+"""
+Microbenchmark: compiled analytics matchers vs. the original per-request loops.
+
+Usage: python scripts/bench_analytics_matching.py [--signatures 5000] [--number 20000]
+"""
+import argparse
+import os
+import random
+import re
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analytics.matching import (  # noqa: E402
+    DEFAULT_BOT_SIGNATURES,
+    DEFAULT_EXCLUDE_PATHS,
+    PathPrefixTrie,
+    SignatureMatcher,
+)
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "curl/8.4.0",
+]
+PATHS = ["/", "/pricing/", "/blog/how-to-study/", "/static/css/site.css", "/favicon.ico", "/api/search/"]
+OLD_EXCLUDE_PATTERNS = [
+    r'^/admin/', r'^/static/', r'^/media/', r'^/api/', r'^/cms/',
+    r'^/favicon\.ico$', r'^/app-ads\.txt$', r'^/robots\.txt$',
+]
+
+
+def loop_is_bot(user_agent, signatures):
+    user_agent_lower = user_agent.lower()
+    for pattern in signatures:
+        if pattern in user_agent_lower:
+            return True, pattern
+    return False, None
+
+
+def loop_is_excluded(path):
+    for pattern in OLD_EXCLUDE_PATTERNS:
+        if re.match(pattern, path):
+            return True
+    return False
+
+
+def random_signatures(count, seed=42):
+    rng = random.Random(seed)
+    return [
+        "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(6, 14))) + "crawl"
+        for _ in range(count)
+    ]
+
+
+def bench(label, func, number):
+    seconds = timeit.timeit(func, number=number)
+    print(f"  {label:<44} {seconds / number * 1e6:8.2f} us/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--signatures", type=int, default=5000, help="Extra random signatures for the large list")
+    parser.add_argument("--number", type=int, default=20000, help="Calls per measurement")
+    args = parser.parse_args()
+
+    large = DEFAULT_BOT_SIGNATURES + random_signatures(args.signatures)
+    for name, signatures in (("default list", DEFAULT_BOT_SIGNATURES), (f"{len(large)} signatures", large)):
+        matcher = SignatureMatcher(signatures)
+        for ua in USER_AGENTS:
+            assert matcher.search(ua) == loop_is_bot(ua, signatures)[1], ua
+        print(f"Bot detection, {name} ({len(USER_AGENTS)} user agents per call):")
+        bench("loop over substrings", lambda: [loop_is_bot(ua, signatures) for ua in USER_AGENTS], args.number)
+        bench(f"SignatureMatcher ({matcher.algorithm})", lambda: [matcher.search(ua) for ua in USER_AGENTS], args.number)
+
+    trie = PathPrefixTrie(DEFAULT_EXCLUDE_PATHS)
+    for path in PATHS:
+        assert trie.matches(path) == loop_is_excluded(path), path
+    print(f"Path exclusion ({len(PATHS)} paths per call):")
+    bench("re.match per pattern", lambda: [loop_is_excluded(p) for p in PATHS], args.number)
+    bench("prefix trie", lambda: [trie.matches(p) for p in PATHS], args.number)
+
+
+if __name__ == "__main__":
+    main()
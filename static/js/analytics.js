@@ -0,0 +1,98 @@
+// Batched client-side analytics collector.
+//
+//   pgAnalytics.track('click', 'CTA clicked', { button: 'Create Agent Now' });
+//
+// or declaratively: <a data-analytics-event="click" data-analytics-name="CTA clicked">.
+// Events are queued and POSTed to /analytics/collect/ as one JSON array per
+// batch with navigator.sendBeacon: when the queue is full, every few seconds,
+// and when the page is hidden. The time the page was visible is sent along as
+// a "timing" item, which fills in PageView.time_on_page.
+//
+// When the script tag has data-track-pageviews (ANALYTICS_TRACKING_MODE =
+// 'beacon'), the page view itself is reported to /analytics/pageview/ too, so
+// pages served from a full-page cache are still counted.
+(function (window, document) {
+  'use strict';
+
+  var ENDPOINT = '/analytics/collect/';
+  var PAGEVIEW_ENDPOINT = '/analytics/pageview/';
+  var MAX_BATCH = 20;
+  var FLUSH_DELAY = 5000;
+
+  var script = document.currentScript;
+
+  if (window.pgAnalytics || document.cookie.indexOf('exclude_analytics=true') !== -1) return;
+  if (/[?&]exclude_analytics=true(&|$)/.test(window.location.search)) return;
+
+  var queue = [];
+  var timer = null;
+  var visibleSince = document.visibilityState === 'visible' ? Date.now() : null;
+  var visibleMs = 0;
+
+  function send(items) {
+    var body = JSON.stringify(items);
+    try {
+      if (navigator.sendBeacon && navigator.sendBeacon(ENDPOINT, new Blob([body], { type: 'text/plain' }))) return;
+    } catch (e) {}
+    try {
+      fetch(ENDPOINT, { method: 'POST', body: body, keepalive: true, credentials: 'same-origin' }).catch(function () {});
+    } catch (e) {}
+  }
+
+  function flush() {
+    if (timer) {
+      clearTimeout(timer);
+      timer = null;
+    }
+    while (queue.length) send(queue.splice(0, MAX_BATCH));
+  }
+
+  function track(type, name, data) {
+    queue.push({ type: type, name: String(name), data: data || null, url: window.location.href });
+    if (queue.length >= MAX_BATCH) flush();
+    else if (!timer) timer = setTimeout(flush, FLUSH_DELAY);
+  }
+
+  function recordTiming() {
+    if (visibleSince !== null) {
+      visibleMs += Date.now() - visibleSince;
+      visibleSince = null;
+    }
+    queue.push({ type: 'timing', path: window.location.pathname, seconds: Math.round(visibleMs / 1000) });
+  }
+
+  function trackPageview() {
+    var view = {
+      path: window.location.pathname,
+      url: window.location.href,
+      title: document.title,
+      referrer: document.referrer
+    };
+    try {
+      if (navigator.sendBeacon && navigator.sendBeacon(PAGEVIEW_ENDPOINT, new Blob([JSON.stringify(view)], { type: 'text/plain' }))) return;
+    } catch (e) {}
+    // Pixel fallback
+    var query = 'p=' + encodeURIComponent(view.path) + '&u=' + encodeURIComponent(view.url) +
+      '&t=' + encodeURIComponent(view.title) + '&r=' + encodeURIComponent(view.referrer);
+    new Image(1, 1).src = PAGEVIEW_ENDPOINT + '?' + query;
+  }
+
+  document.addEventListener('visibilitychange', function () {
+    if (document.visibilityState === 'hidden') {
+      recordTiming();
+      flush();
+    } else if (visibleSince === null) {
+      visibleSince = Date.now();
+    }
+  });
+
+  document.addEventListener('click', function (e) {
+    var el = e.target && e.target.closest ? e.target.closest('[data-analytics-event]') : null;
+    if (!el) return;
+    track(el.getAttribute('data-analytics-event'), el.getAttribute('data-analytics-name') || el.textContent.trim().slice(0, 200));
+  });
+
+  if (script && script.hasAttribute('data-track-pageviews')) trackPageview();
+
+  window.pgAnalytics = { track: track, flush: flush };
+})(window, document);